@@ -1,19 +1,29 @@
 from __future__ import annotations
 
+import array
+import atexit
 import codecs
+import collections
+import collections.abc
+import errno
+import functools
 import io
 import logging
 import os
+import re
 import select
-import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
 import timeit
 import warnings
-from multiprocessing import Pipe
 from threading import Thread
-from typing import Any, Callable, Optional, Union
+from typing import TYPE_CHECKING, Any, Callable, Optional, Union
+
+if TYPE_CHECKING:
+    from procrunner.parsers import RecordParser
 
 #
 #  run() - A function to synchronously run an external process, supporting
@@ -22,7 +32,7 @@ from typing import Any, Callable, Optional, Union
 #    - runs an external process and waits for it to finish
 #    - does not deadlock, no matter the process stdout/stderr output behaviour
 #    - returns the exit code, stdout, stderr (separately) as a
-#      subprocess.CompletedProcess object
+#      CompletedProcess object, a subclass of subprocess.CompletedProcess
 #    - process can run in a custom environment, either as a modification of
 #      the current environment or in a new environment from scratch
 #    - stdin can be fed to the process
@@ -52,106 +62,1287 @@ logger = logging.getLogger("procrunner")
 logger.addHandler(logging.NullHandler())
 
 
+_console_lock = threading.Lock()
+
+
+def _codec_name(encoding):
+    """Return the normalized name of an encoding, or None if unknown."""
+    try:
+        return codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        return None
+
+
+def _stream_encodings(encoding, errors):
+    """
+    Return the (encoding, errors) settings for stdout and stderr. Settings
+    can be given for both streams, or separately in a dictionary. An encoding
+    of None selects binary mode, where the output is never decoded.
+    """
+    settings = []
+    for stream in ("stdout", "stderr"):
+        if isinstance(encoding, dict):
+            stream_encoding = encoding.get(stream, "utf-8")
+        else:
+            stream_encoding = encoding
+        stream_errors = (
+            errors.get(stream, "replace") if isinstance(errors, dict) else errors
+        )
+        if stream_encoding is not None:
+            name = _codec_name(stream_encoding)
+            if name is None:
+                raise ValueError(f"Unknown encoding {stream_encoding!r}")
+            # lines are split on the undecoded bytes
+            if "\r\n".encode(name) != b"\r\n":
+                raise ValueError(
+                    f"Encoding {stream_encoding!r} is not ASCII compatible"
+                )
+            try:
+                codecs.lookup_error(stream_errors)
+            except LookupError:
+                raise ValueError(f"Unknown error handler {stream_errors!r}") from None
+            stream_encoding = name
+        settings.append((stream_encoding, stream_errors))
+    return settings
+
+
+def _complete_utf8(data: bytes) -> bytes:
+    """
+    Replace an incomplete UTF-8 sequence at the end of the data, which would
+    otherwise combine with the start of the next write.
+    """
+    if not data or data[-1] < 0x80:
+        return data
+    for start in range(len(data) - 1, max(len(data) - 4, 0) - 1, -1):
+        lead = data[start]
+        if lead & 0xC0 != 0x80:
+            break
+    else:
+        return data
+    if lead >= 0xF0:
+        length = 4
+    elif lead >= 0xE0:
+        length = 3
+    elif lead >= 0xC0:
+        length = 2
+    else:
+        return data
+    if len(data) - start < length:
+        return data[:start] + "\ufffd".encode("utf-8")
+    return data
+
+
+class _ConsoleWriter:
+    """
+    Passes stream output through to a console stream (sys.stdout or
+    sys.stderr). Data is written in batches of complete lines. All writers
+    share a single lock, so lines from concurrent stream readers are never
+    interleaved. If the console uses the encoding of the output the bytes are
+    written to the underlying binary buffer without decoding them. UTF-8
+    output is written unchanged, except that an incomplete character at the
+    end of a write is replaced. Output in other encodings is checked, and
+    re-encoded if it contains invalid sequences. In binary mode, with
+    encoding None, bytes are always written directly where the console allows.
+    """
+
+    def __init__(self, name, encoding="utf-8"):
+        """
+        Create a writer for the named console stream. The stream is looked
+        up on every write so that replacing sys.stdout/sys.stderr is honoured.
+        """
+        self._name = name
+        self._encoding = encoding
+        self._warned = False
+
+    def write(self, data):
+        """Write a batch of complete lines, given as a byte string."""
+        stream = getattr(sys, self._name)
+        if stream is None:
+            return
+        with _console_lock:
+            buffer = getattr(stream, "buffer", None)
+            if buffer is not None and (
+                self._encoding is None
+                or _codec_name(getattr(stream, "encoding", None)) == self._encoding
+            ):
+                if self._encoding == "utf-8":
+                    data = _complete_utf8(data)
+                elif self._encoding is not None and not data.isascii():
+                    try:
+                        # check the data is valid, without re-encoding it
+                        str(data, self._encoding)
+                    except UnicodeDecodeError:
+                        # replace invalid sequences, which could break
+                        # consumers of the console stream
+                        data = data.decode(self._encoding, "replace").encode(
+                            self._encoding
+                        )
+                stream.flush()
+                buffer.write(data)
+                buffer.flush()
+                return
+            text = data.decode(self._encoding or "utf-8", "replace")
+            try:
+                stream.write(text)
+            except UnicodeEncodeError:
+                encoding = getattr(stream, "encoding", None) or "ascii"
+                stream.write(text.encode(encoding, "replace").decode(encoding))
+                if not self._warned:
+                    logger.warning("output encoding error, characters replaced")
+                    self._warned = True
+            stream.flush()
+
+
+_universal_newline = re.compile(rb"([^\r\n]*)(\r\n|\r|\n)")
+
+
+class PartialLine(str):
+    """A piece of an overlong line, which continues in the next line passed on."""
+
+
+class PartialLineBytes(bytes):
+    """A piece of an overlong line, which continues in the next line passed on."""
+
+
 class _LineAggregator:
     """
     Buffer that can be filled with stream data and will aggregate complete
-    lines. Lines can be printed or passed to an arbitrary callback function.
-    The lines passed to the callback function are UTF-8 decoded and do not
-    contain a trailing newline character.
+    lines. Lines can be printed or passed to arbitrary callback functions:
+
+      callback        is called for each line, decoded
+      callback_bytes  is called for each line as a byte string
+      callback_batch  is called once for each block of lines that was read
+                      with a list of lines. Depending on batch_type these are
+                      decoded strings ("str"), byte strings ("bytes"),
+                      or memoryview slices of the read data ("memoryview")
+
+    Lines are terminated by a newline character, or by any other delimiter
+    given as byte string. With the delimiter "universal" lines may end on
+    a newline, a carriage return, or both. If collapse_progress is set then
+    of a series of lines ending on a carriage return, such as the updates of
+    a progress bar, only the most recent line is passed on.
+
+    Lines passed to callback functions do not contain the delimiter.
+    Data is only decoded if a callback requires strings, using the given
+    encoding and error handler. Pure ASCII data skips the decoder. With
+    encoding None (binary mode) data is never decoded. Complete lines are
+    also fed to a procrunner.parsers.RecordParser object, if given.
+
+    If max_line_length is set then no more than that many bytes of a line
+    are held back or passed on at once. Longer lines are either split into
+    pieces ("split"), where every piece but the last is passed on as a
+    PartialLine or PartialLineBytes object, or cut short and marked with
+    the truncation_marker ("truncate"). UTF-8 encoded lines are split on
+    character boundaries where possible.
     """
 
-    def __init__(self, print_line=False, callback=None):
-        """Create aggregator object."""
-        self._buffer = ""
+    batch_types = ("str", "bytes", "memoryview")
+    overlong_line_modes = ("split", "truncate")
+    truncation_marker = b"[...]"
+
+    def __init__(
+        self,
+        print_line=False,
+        callback=None,
+        callback_bytes=None,
+        callback_batch=None,
+        batch_type="bytes",
+        delimiter=b"\n",
+        collapse_progress=False,
+        max_line_length=None,
+        overlong_lines="split",
+        parser=None,
+        encoding="utf-8",
+        errors="replace",
+    ):
+        """
+        Create aggregator object. print_line can be a boolean, to pass lines
+        through to sys.stdout, or a _ConsoleWriter object.
+        """
+        if batch_type not in self.batch_types:
+            raise ValueError(f"Unknown callback batch type {batch_type!r}")
+        if delimiter == "universal":
+            delimiter = None
+        elif isinstance(delimiter, str):
+            delimiter = delimiter.encode("utf-8")
+        if delimiter == b"":
+            raise ValueError("Line delimiter must not be empty")
+        if max_line_length is not None and max_line_length < 1:
+            raise ValueError("Maximum line length must be a positive number")
+        if overlong_lines not in self.overlong_line_modes:
+            raise ValueError(f"Unknown overlong line mode {overlong_lines!r}")
+        if encoding is None and (callback or (callback_batch and batch_type == "str")):
+            raise ValueError("Callbacks receiving strings require an encoding")
+        self._encoding = encoding
+        self._errors = errors
+        self._delimiter = delimiter
+        # whether the end of the delimiter can be the start of another one,
+        # as in b"\0\0", so that occurrences must be found from the left
+        self._overlapping = delimiter is not None and any(
+            delimiter[:n] == delimiter[-n:] for n in range(1, len(delimiter))
+        )
+        self._collapse = collapse_progress and delimiter is None
+        self._after_carriage_return = False
+        self._max_line_length = max_line_length
+        self._truncate = overlong_lines == "truncate"
+        self._pending = []
+        self._pending_length = 0
+        if print_line is True:
+            print_line = _ConsoleWriter("stdout", encoding)
         self._print = print_line
         self._callback = callback
-        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._callback_bytes = callback_bytes
+        self._callback_batch = callback_batch
+        self._batch_type = batch_type
+        self._parser = parser
+        if parser is not None:
+            parser.attach(encoding, errors)
 
     def add(self, data):
         """
-        Add a single character to buffer. If one or more full lines are found,
-        print them (if desired) and pass to callback function.
+        Add a chunk of stream data to buffer. If one or more full lines are
+        found, print them (if desired) and pass them to the callback functions.
         """
-        data = self._decoder.decode(data)
-        if not data:
+        if self._delimiter is None:
+            if not data:
+                return
+            if self._after_carriage_return and data[:1] == b"\n":
+                # second half of a \r\n line ending, split between two reads
+                data = data[1:]
+                if self._print:
+                    self._print.write(b"\n")
+            self._after_carriage_return = False
+            end = max(data.rfind(b"\r"), data.rfind(b"\n")) + 1
+        else:
+            if self._pending and len(self._delimiter) > 1:
+                # the delimiter may be split between two reads
+                carry = len(self._delimiter) - 1
+                last = self._pending.pop()
+                if len(last) > carry:
+                    self._pending.append(last[:-carry])
+                data = last[-carry:] + data
+                self._pending_length -= len(last[-carry:])
+            if self._overlapping:
+                # the pending data starts after a delimiter and holds none,
+                # so scanning from its start splits as the complete output
+                end = 0
+                found = data.find(self._delimiter)
+                while found != -1:
+                    end = found + len(self._delimiter)
+                    found = data.find(self._delimiter, end)
+            else:
+                end = data.rfind(self._delimiter)
+                end = end + len(self._delimiter) if end != -1 else 0
+        if not end:
+            if data:
+                self._pending.append(data)
+                self._pending_length += len(data)
+                if (
+                    self._max_line_length is not None
+                    and self._pending_length > self._max_line_length
+                ):
+                    self._limit_pending()
             return
-        self._buffer += data
-        if "\n" in data:
-            to_print, remainder = self._buffer.rsplit("\n")
+        if self._pending:
+            self._pending.append(data[:end])
+            lines = b"".join(self._pending)
+        else:
+            lines = data[:end]
+        self._pending = [data[end:]] if end < len(data) else []
+        self._pending_length = len(data) - end
+        if self._delimiter is None:
+            # a \n in the next read only completes a \r\n line ending if
+            # nothing follows the \r
+            self._after_carriage_return = end == len(data) and lines.endswith(b"\r")
+        self._emit(lines)
+
+    def _decode(self, data):
+        """Decode data, skipping the decoder for pure ASCII data."""
+        if data.isascii():
+            return data.decode("ascii")
+        return data.decode(self._encoding, self._errors)
+
+    def _cut(self, line):
+        """
+        Return the length of the first piece of an overlong line, avoiding
+        splitting a UTF-8 encoded character.
+        """
+        if self._encoding != "utf-8":
+            return self._max_line_length
+        cut = self._max_line_length
+        while cut > self._max_line_length - 3 and line[cut] & 0xC0 == 0x80:
+            cut -= 1
+        if cut and line[cut] & 0xC0 != 0x80:
+            return cut
+        return self._max_line_length
+
+    def _limit(self, line):
+        """Return the line split into pieces, or truncated, as configured."""
+        if len(line) <= self._max_line_length:
+            return [line]
+        if self._truncate:
+            return [line[: self._cut(line)] + self.truncation_marker]
+        pieces = []
+        while len(line) > self._max_line_length:
+            cut = self._cut(line)
+            pieces.append(PartialLineBytes(line[:cut]))
+            line = line[cut:]
+        pieces.append(line)
+        return pieces
+
+    def _limit_pending(self):
+        """Bound the size of an incomplete line held back."""
+        pending = b"".join(self._pending)
+        # keep the end of the data, which may be the start of a delimiter
+        keep = len(self._delimiter) - 1 if self._delimiter else 0
+        if self._truncate:
+            # keep just enough to know that the line will be truncated
+            pending = (
+                pending[: self._max_line_length + 1] + pending[len(pending) - keep :]
+            )
+        else:
+            pieces = []
+            while len(pending) - keep > self._max_line_length:
+                cut = self._cut(pending)
+                pieces.append(PartialLineBytes(pending[:cut]))
+                pending = pending[cut:]
             if self._print:
-                try:
-                    print(to_print)
-                except UnicodeEncodeError:
-                    print(to_print.encode(sys.getdefaultencoding(), errors="replace"))
-                    if not hasattr(self, "_warned"):
-                        logger.warning("output encoding error, characters replaced")
-                        setattr(self, "_warned", True)
+                self._print.write(b"".join(pieces))
+            self._pass_on(pieces)
+        self._pending = [pending]
+        self._pending_length = len(pending)
+
+    def _pass_on(self, lines):
+        """
+        Pass a list of lines, some of which may be PartialLineBytes objects,
+        to the callback functions.
+        """
+        if self._parser:
+            self._parser.feed(
+                [line for line in lines if not isinstance(line, PartialLineBytes)]
+            )
+        if self._callback_bytes:
+            for line in lines:
+                self._callback_bytes(line)
+        if self._callback_batch and self._batch_type == "bytes":
+            self._callback_batch(lines)
+        if self._callback_batch and self._batch_type == "memoryview":
+            self._callback_batch([memoryview(line) for line in lines])
+        if self._callback or (self._callback_batch and self._batch_type == "str"):
+            text_lines = [
+                (PartialLine if isinstance(line, PartialLineBytes) else str)(
+                    self._decode(line)
+                )
+                for line in lines
+            ]
+            if self._callback:
+                for line in text_lines:
+                    self._callback(line)
+            if self._callback_batch and self._batch_type == "str":
+                self._callback_batch(text_lines)
+
+    def _spans(self, lines):
+        """
+        Return the start and end offsets of the lines within a block of
+        complete lines, excluding the delimiters.
+        """
+        if self._delimiter is None:
+            matches = list(_universal_newline.finditer(lines))
+            if self._collapse:
+                # drop progress updates superseded by a further update
+                matches = [
+                    match
+                    for match, following in zip(matches, matches[1:] + [None])
+                    if match.group(2) != b"\r"
+                    or following is None
+                    or following.group(2) != b"\r"
+                ]
+            return [match.span(1) for match in matches]
+        spans = []
+        start = 0
+        end = lines.find(self._delimiter)
+        while end != -1:
+            spans.append((start, end))
+            start = end + len(self._delimiter)
+            end = lines.find(self._delimiter, start)
+        return spans
+
+    def _emit(self, lines):
+        """Print and pass on a block of complete lines."""
+        if self._max_line_length is not None and len(lines) > self._max_line_length:
+            spans = self._spans(lines)
+            if any(end - start > self._max_line_length for start, end in spans):
+                self._emit_overlong(lines, spans)
+                return
+        if self._print:
+            self._print.write(lines)
+        want_views = self._callback_batch and self._batch_type == "memoryview"
+        want_bytes = self._callback_bytes or (
+            self._callback_batch and self._batch_type == "bytes"
+        )
+        want_records = self._parser is not None
+        want_text = self._callback or (
+            self._callback_batch and self._batch_type == "str"
+        )
+        if self._delimiter is None or want_views:
+            spans = self._spans(lines)
+        if want_views:
+            view = memoryview(lines)
+            self._callback_batch([view[start:end] for start, end in spans])
+        if want_bytes or want_text or want_records:
+            if self._delimiter is None:
+                byte_lines = [lines[start:end] for start, end in spans]
+            else:
+                byte_lines = lines[: -len(self._delimiter)].split(self._delimiter)
+        if want_records:
+            self._parser.feed(byte_lines)
+        if want_bytes:
+            if self._callback_bytes:
+                for line in byte_lines:
+                    self._callback_bytes(line)
+            if self._callback_batch and self._batch_type == "bytes":
+                self._callback_batch(byte_lines)
+        if want_text:
+            if self._delimiter is not None and self._delimiter.isascii():
+                # lines end on an ASCII delimiter, so no multi-byte character
+                # is split here and the delimiter is decoded unchanged
+                delimiter = self._delimiter.decode("ascii")
+                text_lines = self._decode(lines)[: -len(delimiter)].split(delimiter)
+            else:
+                text_lines = [self._decode(line) for line in byte_lines]
             if self._callback:
-                self._callback(to_print)
-            self._buffer = remainder
+                for line in text_lines:
+                    self._callback(line)
+            if self._callback_batch and self._batch_type == "str":
+                self._callback_batch(text_lines)
+
+    def _emit_overlong(self, lines, spans):
+        """Print and pass on a block of lines, some of which are overlong."""
+        limited = []
+        for start, end in spans:
+            limited.extend(self._limit(lines[start:end]))
+        if self._print:
+            if self._truncate:
+                delimiter = self._delimiter or b"\n"
+                self._print.write(b"".join(line + delimiter for line in limited))
+            else:
+                self._print.write(lines)
+        self._pass_on(limited)
 
     def flush(self):
-        """Print/send any remaining data to callback function."""
-        self._buffer += self._decoder.decode(b"", final=True)
-        if self._buffer:
+        """Print/send any remaining data to callback functions."""
+        if not self._pending:
+            return
+        remainder = b"".join(self._pending)
+        self._pending = []
+        self._pending_length = 0
+        if self._max_line_length is not None and len(remainder) > self._max_line_length:
+            limited = self._limit(remainder)
             if self._print:
-                print(self._buffer)
+                self._print.write(b"".join(limited) + b"\n")
+            self._pass_on(limited)
+            return
+        if self._print:
+            self._print.write(remainder + b"\n")
+        if self._parser:
+            self._parser.feed([remainder])
+        if self._callback_batch:
+            if self._batch_type == "memoryview":
+                self._callback_batch([memoryview(remainder)])
+            elif self._batch_type == "bytes":
+                self._callback_batch([remainder])
+        if self._callback_bytes:
+            self._callback_bytes(remainder)
+        if self._callback or (self._callback_batch and self._batch_type == "str"):
+            text = self._decode(remainder)
             if self._callback:
-                self._callback(self._buffer)
-        self._buffer = ""
+                self._callback(text)
+            if self._callback_batch and self._batch_type == "str":
+                self._callback_batch([text])
+
+
+class CallbackDispatcher:
+    """
+    Calls the line callbacks of a run() from a separate thread, so that a
+    slow callback does not stop the process output from being read.
+
+    Lines are handed over through a queue holding at most maxsize entries.
+    The policy decides what happens to a new line when the queue is full:
+
+      block        wait until the callback thread has caught up
+      drop_oldest  discard the oldest queued line to make room
+      coalesce     merge the line into the most recent queue entry for the
+                   same callback. No line is lost and the reader never
+                   waits, but the size of the queued data is not bounded.
+
+    The dispatcher can be reused for further run() calls, and shared by
+    concurrent run() calls, which then use a single callback thread. The
+    counters 'dropped', 'coalesced' and 'max_depth' accumulate across runs,
+    'depth' gives the current number of queue entries.
+    """
+
+    policies = ("block", "drop_oldest", "coalesce")
+
+    def __init__(self, maxsize: int = 10000, policy: str = "block"):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown callback dispatch policy {policy!r}")
+        if maxsize < 1:
+            raise ValueError("Callback queue size must be at least 1")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self._queue: collections.deque = collections.deque()
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread: Optional[Thread] = None
+        # the number of runs using the dispatcher, and of queue entries
+        # added and finished, so that a run can wait for its own lines
+        self._users = 0
+        self._queued = 0
+        self._finished = 0
+
+    @property
+    def depth(self) -> int:
+        """The number of entries currently waiting in the queue."""
+        return len(self._queue)
+
+    def wrap(self, callback: Callable) -> Callable:
+        """Return a function that queues a line for the given callback."""
+        return functools.partial(self.put, callback)
+
+    def put(self, callback: Callable, line) -> None:
+        """Queue a line for the callback, applying the queue full policy."""
+        with self._condition:
+            if len(self._queue) >= self.maxsize:
+                if self.policy == "block":
+                    while len(self._queue) >= self.maxsize:
+                        self._condition.wait()
+                elif self.policy == "drop_oldest":
+                    self._queue.popleft()
+                    self._finished += 1
+                    self.dropped += 1
+                else:
+                    for entry in reversed(self._queue):
+                        if entry[0] is callback:
+                            entry[1].append(line)
+                            self.coalesced += 1
+                            return
+            self._queue.append((callback, [line]))
+            self._queued += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._condition.notify_all()
+
+    def start(self) -> None:
+        """
+        Start the thread calling the callbacks, unless it is already running
+        for another run. Every start() must be matched by a close().
+        """
+        with self._condition:
+            # wait for a thread that is being stopped by the last close()
+            while self._closing and self._thread is not None:
+                self._condition.wait()
+            self._users += 1
+            if self._thread is not None:
+                return
+            self._closing = False
+            self._thread = Thread(target=self._dispatch)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self) -> None:
+        """
+        Wait until all lines queued so far are processed. The thread is
+        stopped once every run using the dispatcher has closed it.
+        """
+        with self._condition:
+            if self._thread is None:
+                return
+            self._users -= 1
+            if self._users > 0:
+                queued = self._queued
+                while self._finished < queued:
+                    self._condition.wait()
+                return
+            self._closing = True
+            self._condition.notify_all()
+            thread = self._thread
+        thread.join()
+        with self._condition:
+            self._thread = None
+            self._condition.notify_all()
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closing:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                callback, lines = self._queue.popleft()
+                self._condition.notify_all()
+            for line in lines:
+                try:
+                    callback(line)
+                except Exception:
+                    logger.exception("Error in output callback function")
+            with self._condition:
+                self._finished += 1
+                self._condition.notify_all()
+
+
+class OutputIndex:
+    """
+    Records the order and time in which process output was received.
+
+    For every block of output read (or for every line or line fragment, if
+    granularity is "line") the index stores a time.monotonic() timestamp, the
+    stream, and the offset and length of the data within the captured output
+    of that stream. The entries are kept in compact arrays, and the output
+    itself is not copied: iterating over the index yields memoryview slices
+    of the captured stdout and stderr byte strings.
+    """
+
+    granularities = ("chunk", "line")
+    streams = ("stdout", "stderr")
+
+    def __init__(self, granularity: str = "chunk"):
+        if granularity not in self.granularities:
+            raise ValueError(f"Unknown output index granularity {granularity!r}")
+        self.granularity = granularity
+        self.start = time.monotonic()
+        self.timestamps = array.array("d")
+        self.stream_ids = array.array("B")
+        self.offsets = array.array("Q")
+        self.lengths = array.array("Q")
+        self._lock = threading.Lock()
+        self._output: tuple[bytes, ...] = (b"", b"")
+
+    def recorder(self, stream: str) -> Callable:
+        """Return a function recording data read from the named stream."""
+        return functools.partial(self.record, self.streams.index(stream))
+
+    def record(self, stream_id: int, offset: int, data: bytes) -> None:
+        """Add an index entry for a block of data read from a stream."""
+        timestamp = time.monotonic()
+        if self.granularity == "line":
+            ends = []
+            end = data.find(b"\n")
+            while end != -1:
+                ends.append(end + 1)
+                end = data.find(b"\n", end + 1)
+            if not ends or ends[-1] != len(data):
+                ends.append(len(data))
+        else:
+            ends = [len(data)]
+        with self._lock:
+            start = 0
+            for end in ends:
+                self.timestamps.append(timestamp)
+                self.stream_ids.append(stream_id)
+                self.offsets.append(offset + start)
+                self.lengths.append(end - start)
+                start = end
+
+    def attach(self, stdout: bytes, stderr: bytes) -> None:
+        """Attach the captured output the index entries refer to."""
+        self._output = (stdout, stderr)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        """
+        Iterate over the recorded output in the order it was received.
+        Yields tuples of (timestamp, stream name, memoryview of the data).
+        """
+        views = tuple(memoryview(output) for output in self._output)
+        for timestamp, stream_id, offset, length in zip(
+            self.timestamps, self.stream_ids, self.offsets, self.lengths
+        ):
+            yield (
+                timestamp,
+                self.streams[stream_id],
+                views[stream_id][offset : offset + length],
+            )
+
+    def combined(self) -> bytes:
+        """Return stdout and stderr as one byte string, in the order received."""
+        return b"".join(data for _, _, data in self)
+
+
+class _Reactor:
+    """
+    Services the pipes of any number of processes from a single background
+    thread using a selector (epoll on Linux), instead of running a reader or
+    writer thread for every pipe.
+
+    Data read from a pipe is passed to a function in the reactor thread, so
+    these functions must not block. Pipes are not supported on Windows.
+    """
+
+    def __init__(self):
+        import selectors
+
+        self._selector = selectors.DefaultSelector()
+        self._requests: collections.deque = collections.deque()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._thread = Thread(target=self._run, name="procrunner reactor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _call(self, function, *args):
+        """Run a function in the reactor thread."""
+        self._requests.append((function, args))
+        try:
+            os.write(self._wakeup_write, b"\0")
+        except BlockingIOError:
+            pass  # the reactor thread is due to wake up anyway
+
+    def add_reader(self, stream, on_data, on_close):
+        """
+        Read from a stream until it is closed. on_data is called with every
+        block of data read, on_close once the stream has been closed.
+        """
+        import selectors
+
+        os.set_blocking(stream.fileno(), False)
+        handler = functools.partial(self._read, on_data, on_close)
+        self._call(
+            self._selector.register, stream, selectors.EVENT_READ, (handler, on_close)
+        )
+
+    def close_reader(self, stream):
+        """Stop reading from a stream once no data is immediately available."""
+        self._call(self._close_reader, stream)
+
+    def add_writer(self, stream, data, on_written, on_close):
+        """
+        Write data to a stream and close it. on_written is called with the
+        number of bytes written, on_close once the stream has been closed.
+        """
+        import selectors
+
+        os.set_blocking(stream.fileno(), False)
+        handler = functools.partial(self._write, memoryview(data), on_written, on_close)
+        self._call(
+            self._selector.register, stream, selectors.EVENT_WRITE, (handler, on_close)
+        )
+
+    def _read(self, on_data, on_close, stream, drain=False):
+        while True:
+            try:
+                data = os.read(stream.fileno(), 65536)
+            except BlockingIOError:
+                if not drain:
+                    return
+                data = b""
+            except OSError as e:
+                # pseudo-terminals signal a closed terminal as EIO
+                if e.errno != errno.EIO:
+                    raise
+                data = b""
+            if not data:
+                self._selector.unregister(stream)
+                on_close()
+                return
+            on_data(data)
+            if not drain:
+                return
+
+    def _close_reader(self, stream):
+        try:
+            handler, _ = self._selector.get_key(stream).data
+        except KeyError:
+            return  # already closed
+        self._run_handler(functools.partial(handler, drain=True), stream)
+
+    def _write(self, data, on_written, on_close, stream):
+        import selectors
+
+        try:
+            written = os.write(stream.fileno(), data[:65536])
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            # process terminated without reading entire stdin
+            written = len(data)
+        else:
+            on_written(written)
+        remaining = data[written:]
+        if remaining:
+            handler = functools.partial(self._write, remaining, on_written, on_close)
+            self._selector.modify(stream, selectors.EVENT_WRITE, (handler, on_close))
+            return
+        self._selector.unregister(stream)
+        stream.close()
+        on_close()
+
+    def _run_handler(self, handler, stream):
+        try:
+            handler(stream)
+        except Exception:
+            logger.exception("Error handling process stream")
+            try:
+                on_close = self._selector.unregister(stream).data[1]
+            except KeyError:
+                return
+            on_close()
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is not None:
+                    self._run_handler(key.data[0], key.fileobj)
+                    continue
+                try:
+                    while os.read(self._wakeup_read, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                while self._requests:
+                    function, args = self._requests.popleft()
+                    try:
+                        function(*args)
+                    except Exception:
+                        logger.exception("Error in procrunner reactor")
+
+
+_reactor: Optional[_Reactor] = None
+_reactor_lock = threading.Lock()
+
+
+def _get_reactor():
+    """Return the process-wide reactor, starting it if required."""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = _Reactor()
+        return _reactor
+
+
+class _Notification:
+    """
+    A one-shot signal from a stream reader or writer to the thread waiting
+    for the process, sent when the stream has been closed.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def close(self):
+        """Send the signal."""
+        self._event.set()
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds for the signal, return whether it was sent."""
+        return self._event.wait(timeout)
+
+
+class _HeadTailBuffer:
+    """
+    Capture buffer which keeps only the beginning and the end of a stream.
+
+    The first 'head' bytes (or lines, if unit is "lines") are kept in a head
+    buffer, the last 'tail' bytes (or complete lines, followed by any
+    incomplete last line) in a fixed-size ring buffer.
+    Everything in between is counted in 'omitted' and discarded, so the memory
+    used does not depend on the amount of data written.
+
+    In lines mode no more than max_line_length bytes of an incomplete line
+    are kept: a head line exceeding this ends the head, and only the end of
+    an overlong last line is kept in the tail, without the lines before it.
+    """
+
+    units = ("bytes", "lines")
+
+    def __init__(
+        self, head: int, tail: int, unit: str = "bytes", max_line_length: int = 65536
+    ):
+        if unit not in self.units:
+            raise ValueError(f"Unknown capture unit {unit!r}")
+        if head < 0 or tail < 0:
+            raise ValueError("Capture sizes must not be negative")
+        if max_line_length < 1:
+            raise ValueError("Maximum line length must be a positive number")
+        self._head_size = head
+        self._tail_size = tail
+        self._lines = unit == "lines"
+        self._max_line_length = max_line_length
+        self._head = bytearray()
+        self._head_lines = 0
+        self._head_line_start = 0
+        if self._lines:
+            self._tail_lines: collections.deque = collections.deque(maxlen=tail)
+            self._tail_partial = bytearray()
+        else:
+            self._tail = bytearray(tail)
+            self._tail_pos = 0
+        self._tail_len = 0
+        self.size = 0
+
+    @property
+    def omitted(self) -> int:
+        """The number of bytes written but not retained."""
+        return self.size - len(self._head) - self._tail_len
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self._lines:
+            while self._head_lines < self._head_size and data:
+                end = data.find(b"\n") + 1
+                if not end:
+                    space = self._max_line_length - (
+                        len(self._head) - self._head_line_start
+                    )
+                    if len(data) <= space:
+                        self._head += data
+                        return
+                    self._head += data[:space]
+                    self._head_lines = self._head_size
+                    data = data[space:]
+                    break
+                self._head += data[:end]
+                self._head_lines += 1
+                self._head_line_start = len(self._head)
+                data = data[end:]
+            if data and self._tail_size:
+                self._write_tail_lines(data)
+            return
+        if len(self._head) < self._head_size:
+            take = self._head_size - len(self._head)
+            self._head += data[:take]
+            data = data[take:]
+        if not data or not self._tail_size:
+            return
+        if len(data) >= self._tail_size:
+            self._tail[:] = data[-self._tail_size :]
+            self._tail_pos = 0
+            self._tail_len = self._tail_size
+            return
+        first = min(len(data), self._tail_size - self._tail_pos)
+        self._tail[self._tail_pos : self._tail_pos + first] = data[:first]
+        self._tail[: len(data) - first] = data[first:]
+        self._tail_pos = (self._tail_pos + len(data)) % self._tail_size
+        self._tail_len = min(self._tail_size, self._tail_len + len(data))
+
+    def _write_tail_lines(self, data):
+        end = data.rfind(b"\n") + 1
+        if not end:
+            self._tail_partial += data
+            self._tail_len += len(data)
+        else:
+            # find the start of the last lines that can be retained
+            start = end - 1
+            for _ in range(self._tail_size):
+                start = data.rfind(b"\n", 0, start)
+                if start == -1:
+                    break
+            self._tail_len -= len(self._tail_partial)
+            if start == -1:
+                lines = bytes(self._tail_partial) + data[:end]
+            else:
+                lines = data[start + 1 : end]
+            self._tail_partial = bytearray(data[end:])
+            self._tail_len += len(self._tail_partial)
+            for line in lines[:-1].split(b"\n"):
+                if len(self._tail_lines) == self._tail_size:
+                    self._tail_len -= len(self._tail_lines[0])
+                self._tail_lines.append(line + b"\n")
+                self._tail_len += len(line) + 1
+        if len(self._tail_partial) > self._max_line_length:
+            # keep the tail contiguous: drop the complete lines together
+            # with the beginning of the overlong line following them
+            del self._tail_partial[: -self._max_line_length]
+            self._tail_lines.clear()
+            self._tail_len = len(self._tail_partial)
+
+    def _tail_bytes(self) -> bytes:
+        if self._lines:
+            return b"".join(self._tail_lines) + self._tail_partial
+        if self._tail_len < self._tail_size:
+            return bytes(self._tail[: self._tail_len])
+        return bytes(self._tail[self._tail_pos :] + self._tail[: self._tail_pos])
+
+    def getvalue(self) -> bytes:
+        """Return the retained head and tail of the data."""
+        return bytes(self._head) + self._tail_bytes()
+
+    def read_from(self, offset: int) -> tuple[bytes, int]:
+        """
+        Return the retained data from the given stream offset onwards, and
+        the stream offset following it. Omitted data is skipped.
+        """
+        data = bytes(self._head[offset:])
+        tail_start = self.size - self._tail_len
+        data += self._tail_bytes()[max(0, offset - tail_start) :]
+        return data, self.size
+
+
+class _CompressedBuffer:
+    """
+    Capture buffer which zlib-compresses the data as it is written, and
+    holds only the compressed data.
+    """
+
+    omitted = None
+
+    def __init__(self):
+        import zlib
+
+        self._compressor = zlib.compressobj()
+        self._chunks: list[bytes] = []
+        self._reader = None
+        self._reader_chunks = 0
+        self._reader_offset = 0
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._chunks.append(compressed)
+
+    def getvalue(self) -> bytes:
+        """Finish compression and return the compressed data."""
+        self._chunks.append(self._compressor.flush())
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self._compressor = self._reader = None
+        return data
+
+    def read_from(self, offset: int) -> tuple[bytes, int]:
+        """
+        Return the data compressed so far from the given stream offset onwards,
+        and the stream offset following it. Data still held in the compressor
+        is returned by a later call.
+        """
+        if self._compressor is None:
+            return b"", offset
+        if self._reader is None or offset < self._reader_offset:
+            import zlib
+
+            # restart decompression from the beginning
+            self._reader = zlib.decompressobj()
+            self._reader_chunks = 0
+            self._reader_offset = 0
+        data = b"".join(
+            self._reader.decompress(chunk)
+            for chunk in self._chunks[self._reader_chunks :]
+        )
+        self._reader_chunks = len(self._chunks)
+        start = offset - self._reader_offset
+        self._reader_offset += len(data)
+        return data[start:], self._reader_offset
+
+
+def _head_tail_buffers(head, tail, unit, max_line_length=None):
+    """
+    Create the _HeadTailBuffer objects for stdout and stderr. Sizes can be
+    given for both streams, or separately in a dictionary. Incomplete lines
+    are limited to max_line_length bytes, if given.
+    """
+    defaults = {"bytes": (65536, 1048576), "lines": (500, 5000)}
+    if unit not in defaults:
+        raise ValueError(f"Unknown capture unit {unit!r}")
+    if head is None:
+        head = defaults[unit][0]
+    if tail is None:
+        tail = defaults[unit][1]
+    buffers = []
+    for stream in ("stdout", "stderr"):
+        stream_head = head[stream] if isinstance(head, dict) else head
+        stream_tail = tail[stream] if isinstance(tail, dict) else tail
+        if max_line_length is None:
+            buffers.append(_HeadTailBuffer(stream_head, stream_tail, unit))
+        else:
+            buffers.append(
+                _HeadTailBuffer(stream_head, stream_tail, unit, max_line_length)
+            )
+    return buffers
+
+
+def _capture_buffers(
+    capture,
+    capture_compression,
+    capture_head,
+    capture_tail,
+    capture_unit,
+    capture_index,
+    max_line_length,
+):
+    """
+    Check the capture options of run(), and return the capture buffers for
+    stdout and stderr, or None for each if the output is captured in full.
+    """
+    if capture == "head_tail":
+        if capture_index:
+            raise ValueError("An output index requires the full output to be captured")
+        stdout_buffer, stderr_buffer = _head_tail_buffers(
+            capture_head, capture_tail, capture_unit, max_line_length
+        )
+    elif capture == "none":
+        if capture_index:
+            raise ValueError("An output index requires the full output to be captured")
+        stdout_buffer, stderr_buffer = _head_tail_buffers(0, 0, "bytes")
+    elif capture == "all":
+        stdout_buffer = stderr_buffer = None
+    else:
+        raise ValueError(f"Unknown capture policy {capture!r}")
+    if capture_compression == "zlib":
+        if capture != "all" or capture_index:
+            raise ValueError(
+                "Compressed capture can not be combined with other capture options"
+            )
+        stdout_buffer, stderr_buffer = _CompressedBuffer(), _CompressedBuffer()
+    elif capture_compression is not None:
+        raise ValueError(f"Unknown capture compression {capture_compression!r}")
+    return stdout_buffer, stderr_buffer
+
+
+def _combine_recorders(*recorders) -> Optional[Callable]:
+    """Return a record function calling all the given ones, if any."""
+    recorders = tuple(record for record in recorders if record is not None)
+    if len(recorders) < 2:
+        return recorders[0] if recorders else None
+
+    def record(offset, data):
+        for recorder in recorders:
+            recorder(offset, data)
+
+    return record
 
 
 class _NonBlockingStreamReader:
     """Reads a stream in a thread to avoid blocking/deadlocks"""
 
-    def __init__(self, stream, output=True, debug=False, notify=None, callback=None):
-        """Creates and starts a thread which reads from a stream."""
-        self._buffer = io.BytesIO()
+    def __init__(
+        self,
+        stream,
+        output=True,
+        debug=False,
+        notify=None,
+        callback=None,
+        callback_bytes=None,
+        callback_batch=None,
+        batch_type="bytes",
+        record=None,
+        reactor=None,
+        delimiter=b"\n",
+        collapse_progress=False,
+        max_line_length=None,
+        overlong_lines="split",
+        buffer=None,
+        parser=None,
+        encoding="utf-8",
+        errors="replace",
+    ):
+        """
+        Creates and starts a thread which reads from a stream, or registers
+        the stream with a _Reactor object to be read from its thread instead.
+        If a record function is given it is called with the stream offset and
+        the data of every block read from the stream. The data is captured in
+        a io.BytesIO object unless a different buffer, such as a
+        _HeadTailBuffer, is given.
+
+        If the output can not be decoded with the strict error handler the
+        error is kept in 'decode_error', and the stream is read to the end
+        without passing on any further lines.
+        """
+        self.decode_error: Optional[UnicodeDecodeError] = None
+        self._custom_buffer = buffer is not None
+        self._buffer = buffer if buffer is not None else io.BytesIO()
+        self._buffer_lock = threading.Lock()
+        self.bytes_read = 0
         self._closed = False
         self._closing = False
         self._debug = debug
+        self._finished = threading.Event()
+        self._reactor = reactor
         self._stream = stream
         self._terminated = False
+        self._max_block_len = 65536
+        if output or callback or callback_bytes or callback_batch or parser:
+            la = _LineAggregator(
+                print_line=output,
+                callback=callback,
+                callback_bytes=callback_bytes,
+                callback_batch=callback_batch,
+                batch_type=batch_type,
+                delimiter=delimiter,
+                collapse_progress=collapse_progress,
+                max_line_length=max_line_length,
+                overlong_lines=overlong_lines,
+                parser=parser,
+                encoding=encoding,
+                errors=errors,
+            )
+        else:
+            la = None  # nothing to do with lines, so do not look for them
 
-        def _thread_write_stream_to_buffer():
-            la = _LineAggregator(print_line=output, callback=callback)
-            char = True
-            while char:
-                if select.select([self._stream], [], [], 0.1)[0]:
-                    char = self._stream.read(1)
-                    if char:
-                        self._buffer.write(char)
-                        la.add(char)
-                else:
-                    if self._closing:
-                        break
+        def _pass_on(method, *args):
+            nonlocal la
+            try:
+                method(*args)
+            except UnicodeDecodeError as e:
+                # keep draining the pipe, so that the process is not blocked
+                logger.debug("Could not decode process output: %s", e)
+                self.decode_error = e
+                la = None
+
+        def _process(data):
+            with self._buffer_lock:
+                self._buffer.write(data)
+            if record:
+                record(self.bytes_read, data)
+            self.bytes_read += len(data)
+            if la:
+                _pass_on(la.add, data)
+
+        def _finish():
             self._stream.close()
+            if la:
+                _pass_on(la.flush)
             self._terminated = True
-            la.flush()
+            self._finished.set()
             if self._debug:
                 logger.debug("Stream reader terminated")
             if notify:
                 notify()
 
+        def _thread_write_stream_to_buffer():
+            # read1() returns whatever is available without waiting for more
+            read = getattr(self._stream, "read1", self._stream.read)
+            data = True
+            while data:
+                if select.select([self._stream], [], [], 0.1)[0]:
+                    data = read(self._max_block_len)
+                    if data:
+                        _process(data)
+                else:
+                    if self._closing:
+                        break
+            _finish()
+
         def _thread_write_stream_to_buffer_windows():
-            line = True
-            while line:
-                line = self._stream.readline()
-                if line:
-                    self._buffer.write(line)
-                    if output or callback:
-                        linedecode = line.decode("utf-8", "replace")
-                        if output:
-                            print(linedecode)
-                        if callback:
-                            callback(linedecode)
-            self._stream.close()
-            self._terminated = True
-            if self._debug:
-                logger.debug("Stream reader terminated")
-            if notify:
-                notify()
+            # select() does not support pipes on Windows, so block in read1(),
+            # which returns whatever is available once data has arrived, rather
+            # than handling the output line by line
+            read = getattr(self._stream, "read1", self._stream.read)
+            data = True
+            while data:
+                data = read(self._max_block_len)
+                if data:
+                    _process(data)
+            _finish()
 
+        if reactor is not None:
+            reactor.add_reader(self._stream, _process, _finish)
+            return
         if os.name == "nt":
             self._thread = Thread(target=_thread_write_stream_to_buffer_windows)
         else:
@@ -165,6 +1356,32 @@ class _NonBlockingStreamReader:
         """
         return self._terminated
 
+    @property
+    def omitted(self):
+        """
+        The number of bytes read but not retained by a head/tail capture
+        buffer, or None if no data is discarded.
+        """
+        if not self._custom_buffer:
+            return None
+        with self._buffer_lock:
+            return self._buffer.omitted
+
+    def read_from(self, offset):
+        """
+        Return the data read from the stream so far, starting at the given
+        offset, without waiting for the reading thread, and the offset
+        following that data.
+        """
+        with self._buffer_lock:
+            if self._custom_buffer:
+                return self._buffer.read_from(offset)
+            if self._closed:
+                return b"", offset
+            with self._buffer.getbuffer() as view:
+                data = bytes(view[offset:])
+            return data, offset + len(data)
+
     def get_output(self):
         """
         Retrieve the stored data in full.
@@ -176,7 +1393,12 @@ class _NonBlockingStreamReader:
                 # Main thread overtook stream reading thread.
                 underrun_debug_timer = timeit.default_timer()
                 logger.warning("NBSR underrun")
-            self._thread.join()
+            if self._reactor is not None:
+                # stop reading once no more data is immediately available
+                self._reactor.close_reader(self._stream)
+                self._finished.wait()
+            else:
+                self._thread.join()
             if not self.has_finished():
                 if self._debug:
                     logger.debug(
@@ -189,19 +1411,24 @@ class _NonBlockingStreamReader:
                     "NBSR underrun resolved after %f seconds",
                     timeit.default_timer() - underrun_debug_timer,
                 )
-        if self._closed:
-            raise Exception("streamreader double-closed")
-        self._closed = True
-        data = self._buffer.getvalue()
-        self._buffer.close()
+        with self._buffer_lock:
+            if self._closed:
+                raise Exception("streamreader double-closed")
+            self._closed = True
+            data = self._buffer.getvalue()
+            if not self._custom_buffer:
+                self._buffer.close()
         return data
 
 
 class _NonBlockingStreamWriter:
     """Writes to a stream in a thread to avoid blocking/deadlocks"""
 
-    def __init__(self, stream, data, debug=False, notify=None):
-        """Creates and starts a thread which writes data to stream."""
+    def __init__(self, stream, data, debug=False, notify=None, reactor=None):
+        """
+        Creates and starts a thread which writes data to stream, or registers
+        the stream with a _Reactor object to be written from its thread instead.
+        """
         self._buffer = data
         self._buffer_len = len(data)
         self._buffer_pos = 0
@@ -237,9 +1464,22 @@ class _NonBlockingStreamWriter:
             if notify:
                 notify()
 
-        self._thread = Thread(target=_thread_write_buffer_to_stream)
-        self._thread.daemon = True
-        self._thread.start()
+        if reactor is not None:
+
+            def _written(length):
+                self._buffer_pos += length
+
+            def _finish():
+                self._terminated = True
+                if notify:
+                    notify()
+
+            reactor.add_writer(self._stream, data, _written, _finish)
+            return
+
+        self._thread = Thread(target=_thread_write_buffer_to_stream)
+        self._thread.daemon = True
+        self._thread.start()
 
     def has_finished(self):
         """Returns whether the thread writing to the stream is still alive."""
@@ -280,6 +1520,8 @@ def _windows_resolve(command, path=None):
              correct extension. If the executable cannot be resolved for any
              reason the original command array is returned.
     """
+    import shutil
+
     if not command or not isinstance(command[0], str):
         return command
 
@@ -300,23 +1542,1324 @@ def _windows_resolve(command, path=None):
     return command
 
 
+def _process_environment(environment, environment_override):
+    """
+    Construct the execution environment for a process.
+
+    :param environment: The full execution environment, or None to start from
+                        the current environment.
+    :param environment_override: Environment variables to change from the
+                                 environment values.
+    :return: A dictionary with the process environment.
+    """
+    if environment is not None:
+        env = {key: _path_resolve(environment[key]) for key in environment}
+    else:
+        env = {key: value for key, value in os.environ.items()}
+    if environment_override:
+        env.update(
+            {
+                key: str(_path_resolve(environment_override[key]))
+                for key in environment_override
+            }
+        )
+    return env
+
+
+def _stdin_pipe(stdin):
+    """
+    Interpret the stdin argument of run().
+
+    :return: A tuple of the stdin argument for the subprocess call and the
+             bytes to be written to the process, if any.
+    """
+    if stdin is None:
+        return None, None
+    if isinstance(stdin, int):
+        assert (
+            stdin == subprocess.DEVNULL
+        ), "stdin argument only allows subprocess.DEVNULL as numeric argument"
+        return subprocess.DEVNULL, None
+    assert sys.platform != "win32", "stdin argument not supported on Windows"
+    return subprocess.PIPE, stdin
+
+
+def _resource_limits(limits):
+    """
+    Translate the limits argument of run() into resource module terms.
+
+    :param limits: A dictionary mapping resource names, such as "as", "cpu"
+                   or "nofile", to a limit value, which is used as both soft
+                   and hard limit, or to a tuple of (soft, hard) limit values.
+                   A single CPU time limit sets the hard limit one second
+                   above the soft limit.
+    :return: A list of (resource.RLIMIT_* value, (soft, hard)) tuples.
+    """
+    try:
+        import resource
+    except ImportError:
+        raise NotImplementedError(
+            "Resource limits are not supported on this platform"
+        ) from None
+    resolved = []
+    for name, value in limits.items():
+        rlimit = getattr(resource, "RLIMIT_" + name.upper(), None)
+        if rlimit is None:
+            raise ValueError(f"Unknown resource limit {name!r}")
+        if isinstance(value, int):
+            if rlimit == resource.RLIMIT_CPU:
+                # Allow for the soft limit signal, SIGXCPU, to be delivered
+                # before the kernel kills the process at the hard limit
+                value = (value, value + 1)
+            else:
+                value = (value, value)
+        resolved.append((rlimit, tuple(value)))
+    return resolved
+
+
+def _prlimit_available():
+    """Return whether resource limits can be set on another process."""
+    import resource
+
+    return hasattr(resource, "prlimit")
+
+
+def _apply_resource_limits(pid, limits):
+    """Set resource limits on a running process."""
+    import resource
+
+    for rlimit, value in limits:
+        try:
+            resource.prlimit(pid, rlimit, value)
+        except ProcessLookupError:
+            return  # the process has already finished
+
+
+def _resource_limit_preexec_fn(limits, preexec_fn=None):
+    """
+    Return a pre-execution function setting resource limits in the child.
+    This is only used on platforms where limits can not be set on another
+    process.
+    """
+    import resource
+
+    def _set_limits():
+        for rlimit, value in limits:
+            resource.setrlimit(rlimit, value)
+        if preexec_fn:
+            preexec_fn()
+
+    return _set_limits
+
+
+# Signals sent by the kernel when a process exceeds a soft resource limit
+_resource_limit_signals = {"SIGXCPU": "RLIMIT_CPU", "SIGXFSZ": "RLIMIT_FSIZE"}
+
+
+def _exceeded_resource_limit(returncode):
+    """
+    Return the name of the resource limit that terminated a process, based
+    on its exit code, or None.
+    """
+    import signal
+
+    for signal_name, limit_name in _resource_limit_signals.items():
+        signal_number = getattr(signal, signal_name, None)
+        if signal_number is not None and returncode == -signal_number:
+            return limit_name
+    return None
+
+
+def _parse_cpu_list(text):
+    """Parse a Linux CPU list, such as "0-3,8,10-11", into a list of CPUs."""
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+class CPUAllocator:
+    """
+    Hands out sets of CPU cores to concurrently running processes, so that
+    processes started with run() do not compete for the same cores.
+
+    Pass the allocator to run() as the cpu_affinity argument. Each process is
+    assigned the cpus_per_process least used cores, taken in round-robin order
+    from the CPUs available to this process. With numa=True all cores assigned
+    to a process are taken from the same NUMA node, choosing the least used
+    node. Cores are released when the process has finished.
+    """
+
+    def __init__(self, cpus_per_process: int = 1, numa: bool = False, cpus=None):
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0))
+        self.cpus = list(cpus)
+        if not 1 <= cpus_per_process <= len(self.cpus):
+            raise ValueError(
+                f"Can not allocate {cpus_per_process} out of {len(self.cpus)} CPUs"
+            )
+        self.cpus_per_process = cpus_per_process
+        self.nodes = self._numa_nodes() if numa else [self.cpus]
+        self._usage = {cpu: 0 for cpu in self.cpus}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _numa_nodes(self):
+        """Group the available CPUs by NUMA node."""
+        import glob
+
+        nodes = []
+        for cpulist in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+            with open(cpulist) as fh:
+                node = [cpu for cpu in _parse_cpu_list(fh.read()) if cpu in self.cpus]
+            if len(node) >= self.cpus_per_process:
+                nodes.append(node)
+        return nodes or [self.cpus]
+
+    def acquire(self) -> set[int]:
+        """Allocate a set of CPU cores."""
+        with self._lock:
+            node = min(self.nodes, key=lambda n: sum(self._usage[cpu] for cpu in n))
+            # rotate the starting point, so that ties are broken round-robin
+            self._next = (self._next + 1) % len(node)
+            candidates = node[self._next :] + node[: self._next]
+            allocated = sorted(candidates, key=lambda cpu: self._usage[cpu])[
+                : self.cpus_per_process
+            ]
+            for cpu in allocated:
+                self._usage[cpu] += 1
+            return set(allocated)
+
+    def release(self, cpus) -> None:
+        """Return a set of CPU cores previously allocated."""
+        with self._lock:
+            for cpu in cpus:
+                self._usage[cpu] -= 1
+
+
+_ionice_classes = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+# ioprio_set system call numbers, which are not exposed by the os module
+_ioprio_set_syscalls = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+
+
+def _set_io_priority(pid, ionice):
+    """
+    Set the I/O scheduling class and priority level of a process.
+
+    :param ionice: Either a scheduling class name ("realtime", "best-effort"
+                   or "idle") or a tuple of class name and priority level
+                   between 0 (highest) and 7 (lowest).
+    """
+    import ctypes
+
+    if isinstance(ionice, str):
+        ionice = (ionice, 4 if ionice != "idle" else 0)
+    io_class, level = ionice
+    if io_class not in _ionice_classes:
+        raise ValueError(f"Unknown I/O scheduling class {io_class!r}")
+    syscall = _ioprio_set_syscalls.get(os.uname().machine)
+    if syscall is None:
+        raise NotImplementedError("I/O priorities are not supported on this platform")
+    libc = ctypes.CDLL(None, use_errno=True)
+    IOPRIO_WHO_PROCESS = 1
+    if libc.syscall(
+        syscall, IOPRIO_WHO_PROCESS, pid, (_ionice_classes[io_class] << 13) | level
+    ):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _apply_scheduling(pid, cpu_affinity=None, nice=None, ionice=None):
+    """Set CPU affinity, scheduling priority and I/O priority of a process."""
+    try:
+        if cpu_affinity is not None:
+            os.sched_setaffinity(pid, cpu_affinity)
+        if nice is not None:
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        if ionice is not None:
+            _set_io_priority(pid, ionice)
+    except ProcessLookupError:
+        pass  # the process has already finished
+
+
+class OutputLines(collections.abc.Sequence):
+    """
+    A read-only sequence of the lines of a captured output, without line
+    endings. Lines are located through an index of line start offsets, and
+    are only decoded when accessed, so that picking single lines or the last
+    few lines does not require decoding or splitting the whole output.
+    """
+
+    def __init__(
+        self,
+        data: bytes,
+        starts: array.array,
+        text: bool = True,
+        encoding: str = "utf-8",
+        errors: str = "replace",
+    ):
+        self._data = data
+        self._starts = starts
+        self._text = text
+        self._encoding = encoding
+        self._errors = errors
+
+    @staticmethod
+    def index(data: bytes) -> array.array:
+        """Return an array of the start offsets of all lines in data."""
+        starts = array.array("Q")
+        if not data:
+            return starts
+        starts.append(0)
+        end = data.find(b"\n")
+        while end != -1 and end + 1 < len(data):
+            starts.append(end + 1)
+            end = data.find(b"\n", end + 1)
+        return starts
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[n] for n in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("line index out of range")
+        start = self._starts[item]
+        if item + 1 < len(self._starts):
+            end = self._starts[item + 1] - 1
+        elif self._data.endswith(b"\n"):
+            end = len(self._data) - 1
+        else:
+            end = len(self._data)
+        line = self._data[start:end]
+        return line.decode(self._encoding, self._errors) if self._text else line
+
+
+class CompletedProcess(subprocess.CompletedProcess):
+    """
+    The result of a process run with run().
+
+    In addition to the subprocess.CompletedProcess attributes this offers
+    the decoded output as 'stdout_text' and 'stderr_text', and line by line
+    access through lines(). These are computed on first use and cached.
+    The output is decoded with the encoding and error handler given to run(),
+    by default UTF-8 with invalid sequences replaced, and as UTF-8 for output
+    read in binary mode.
+    """
+
+    # The (encoding, errors) settings of the streams, set by ProcessHandle
+    encodings: dict[str, tuple[Optional[str], str]] = {}
+
+    def __init__(self, args, returncode, stdout=None, stderr=None):
+        super().__init__(args, returncode, stdout, stderr)
+        self._line_starts: dict[str, array.array] = {}
+
+    def _encoding(self, stream: str) -> tuple[str, str]:
+        encoding, errors = self.encodings.get(stream, ("utf-8", "replace"))
+        return encoding or "utf-8", errors
+
+    @functools.cached_property
+    def stdout_text(self) -> str:
+        """The process output on stdout, decoded."""
+        return self.stdout.decode(*self._encoding("stdout"))
+
+    @functools.cached_property
+    def stderr_text(self) -> str:
+        """The process output on stderr, decoded."""
+        return self.stderr.decode(*self._encoding("stderr"))
+
+    def lines(self, stream: str = "stdout", text: bool = True) -> OutputLines:
+        """
+        Return a sequence of the output lines of a stream.
+
+        :param stream: "stdout" (default) or "stderr"
+        :param text: Whether lines are returned as decoded strings
+                     (default) or as byte strings.
+        """
+        if stream not in ("stdout", "stderr"):
+            raise ValueError(f"Unknown stream {stream!r}")
+        data = getattr(self, stream)
+        if stream not in self._line_starts:
+            self._line_starts[stream] = OutputLines.index(data)
+        encoding, errors = self._encoding(stream)
+        return OutputLines(
+            data, self._line_starts[stream], text=text, encoding=encoding, errors=errors
+        )
+
+
+class CompressedCompletedProcess(CompletedProcess):
+    """
+    The result of a process whose output was captured compressed.
+
+    The compressed output is available as 'stdout_compressed' and
+    'stderr_compressed'. 'stdout' and 'stderr' are decompressed on first use.
+    """
+
+    def __init__(
+        self,
+        args,
+        returncode: int,
+        stdout_compressed: bytes,
+        stderr_compressed: bytes,
+        compression: str = "zlib",
+    ):
+        super().__init__(args, returncode)
+        self.compression = compression
+        self.stdout_compressed = stdout_compressed
+        self.stderr_compressed = stderr_compressed
+
+    @property
+    def stdout(self) -> bytes:
+        if self._stdout is None:
+            import zlib
+
+            self._stdout = zlib.decompress(self.stdout_compressed)
+        return self._stdout
+
+    @stdout.setter
+    def stdout(self, value):
+        self._stdout = value
+
+    @property
+    def stderr(self) -> bytes:
+        if self._stderr is None:
+            import zlib
+
+            self._stderr = zlib.decompress(self.stderr_compressed)
+        return self._stderr
+
+    @stderr.setter
+    def stderr(self, value):
+        self._stderr = value
+
+
+# Set by procrunner.journal.enable() to record every process run
+_journal = None
+
+# Set by procrunner.testing.record() to see the output of processes as read.
+# Returns None, or record functions for stdout and stderr, which are called
+# with the stream offset and every block of data read from that stream.
+_output_observer: Optional[Callable] = None
+
+# Processes started by procrunner which may still be running, mapped to
+# whether they lead their own process group, to be stopped by shutdown()
+_children: dict[subprocess.Popen, bool] = {}
+_children_lock = threading.Lock()
+
+
+def _register_child(process: subprocess.Popen, process_group: bool = False) -> None:
+    with _children_lock:
+        for finished in [p for p in _children if p.returncode is not None]:
+            del _children[finished]
+        _children[process] = process_group
+
+
+def _unregister_child(process: subprocess.Popen) -> None:
+    with _children_lock:
+        _children.pop(process, None)
+
+
+def _send_signal(
+    process: subprocess.Popen, signal_number: int, process_group: bool = False
+) -> None:
+    """Send a signal to a process, or to its process group."""
+    try:
+        if process_group:
+            os.killpg(process.pid, signal_number)
+        else:
+            process.send_signal(signal_number)
+    except ProcessLookupError:
+        pass
+
+
+def _signal_process(
+    process: subprocess.Popen, process_group: bool = False, kill: bool = False
+) -> None:
+    """Send a terminate or kill signal to a process, or to its process group."""
+    try:
+        if process_group:
+            os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+        elif kill:
+            process.kill()
+        else:
+            process.terminate()
+    except ProcessLookupError:
+        pass
+    if not kill and os.name != "nt":
+        # a suspended process only acts on the terminate signal once continued
+        _send_signal(process, signal.SIGCONT, process_group)
+
+
+class ProcessHandle:
+    """
+    A handle on an external process started with start().
+
+    The process output is read in the background, so a single thread can
+    supervise many processes by calling poll() or read_available() on each.
+    Calling result() waits for the process to finish and returns the same
+    CompletedProcess object that run() would return.
+
+    If a timeout was set, poll() and wait() send a terminate signal to the
+    process once the timeout is exceeded, and a kill signal if it is still
+    running 2 seconds later. result() then raises subprocess.TimeoutExpired.
+    The time a process spends stopped by suspend() does not count towards
+    the timeout, unless requested otherwise.
+    """
+
+    def __init__(
+        self,
+        args,
+        process,
+        stdout,
+        stderr,
+        thread_pipe_pool,
+        *,
+        timeout=None,
+        start_time=None,
+        cpu_allocator=None,
+        cpu_affinity=None,
+        callback_dispatcher=None,
+        output_index=None,
+        limits=None,
+        compression=None,
+        resource_usage=False,
+        executable=None,
+        working_directory=None,
+        process_group=False,
+        parsers=(None, None),
+        encodings=None,
+    ):
+        self.args = args
+        self._process = process
+        self._stdout = stdout
+        self._stderr = stderr
+        self._thread_pipe_pool = thread_pipe_pool
+        self._timeout = timeout
+        self._start_time = start_time
+        self._cpu_allocator = cpu_allocator
+        self._cpu_affinity = cpu_affinity
+        self._callback_dispatcher = callback_dispatcher
+        self._released = False
+        self._output_index = output_index
+        self._limits = limits
+        self._compression = compression
+        self._resource_usage = resource_usage
+        self._rusage = None
+        self._executable = executable
+        self._working_directory = working_directory
+        self._killed = False
+        self._process_group = process_group
+        self._parsers = parsers
+        self._encodings = encodings
+        self._suspended_since: Optional[float] = None
+        self._pause_timeout = True
+        self._paused_time = 0.0
+        self._start_timestamp = time.time() - (timeit.default_timer() - start_time)
+        self._read_positions = [0, 0]
+        self._result: Optional[CompletedProcess] = None
+        self._terminate_time: Optional[float] = None
+        self._timeout_encountered = False
+
+    @property
+    def pid(self) -> int:
+        """The process ID of the process."""
+        return self._process.pid
+
+    @property
+    def returncode(self) -> Optional[int]:
+        """The exit code of the process, or None if it is still running."""
+        return self._process.returncode
+
+    @property
+    def bytes_received(self) -> int:
+        """The number of bytes read from stdout and stderr so far."""
+        return self._stdout.bytes_read + self._stderr.bytes_read
+
+    def _poll_process(self) -> Optional[int]:
+        """
+        Check whether the process has finished. If resource usage is recorded
+        the process is reaped with wait4() to collect its resource usage.
+        """
+        p = self._process
+        if not self._resource_usage or p.returncode is not None:
+            p.poll()
+        else:
+            try:
+                pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+            except ChildProcessError:
+                # the process has been reaped elsewhere
+                p.poll()
+            else:
+                if pid:
+                    self._rusage = rusage
+                    p.returncode = os.waitstatus_to_exitcode(status)
+        if p.returncode is not None and self._suspended_since is not None:
+            self._end_suspension()
+        return p.returncode
+
+    def _deadline(self) -> float:
+        """
+        The time at which the timeout expires, excluding the time the process
+        spent suspended with pause_timeout set.
+        """
+        paused = self._paused_time
+        if self._suspended_since is not None and self._pause_timeout:
+            paused += timeit.default_timer() - self._suspended_since
+        return self._start_time + self._timeout + paused
+
+    def _reap(self, timeout: float) -> Optional[int]:
+        """
+        Wait up to timeout seconds for a signalled process to be reaped. Its
+        output streams can close slightly before the process has exited.
+        """
+        if not self._resource_usage:
+            try:
+                self._process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                pass
+            return self._process.returncode
+        deadline = timeit.default_timer() + timeout
+        while self._poll_process() is None and timeit.default_timer() < deadline:
+            time.sleep(0.01)
+        return self._process.returncode
+
+    def poll(self) -> Optional[int]:
+        """
+        Check whether the process has finished, without blocking.
+        Enforces the timeout, if one was set.
+
+        :return: The exit code of the process, or None if it is still running.
+        """
+        if self._poll_process() is None and self._timeout is not None:
+            now = timeit.default_timer()
+            if self._terminate_time is None:
+                if now >= self._deadline():
+                    logger.debug("timeout (T%.2fs)", now - self._start_time)
+                    self._timeout_encountered = True
+                    self._terminate_time = now
+                    self.terminate()
+            elif now >= self._terminate_time + 2:
+                self._killed = True
+                self.kill()
+        return self._process.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        """
+        Wait for the process to finish.
+
+        :param timeout: Stop waiting after this many seconds and raise a
+                        subprocess.TimeoutExpired exception. The process
+                        is not affected by this.
+        :return: The exit code of the process.
+        """
+        end_time = None if timeout is None else timeit.default_timer() + timeout
+        while self.poll() is None:
+            if end_time is None:
+                interval = 0.1
+            else:
+                interval = min(0.1, end_time - timeit.default_timer())
+                if interval <= 0:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+            if self._resource_usage:
+                # the process must be reaped by _poll_process()
+                time.sleep(interval)
+                continue
+            try:
+                self._process.wait(timeout=interval)
+            except subprocess.TimeoutExpired:
+                pass
+        return self._process.returncode
+
+    def terminate(self) -> None:
+        """
+        Send a terminate signal to the process, or to its process group if
+        it was started with new_process_group=True.
+        """
+        _signal_process(self._process, self._process_group)
+        if self._suspended_since is not None:
+            self._end_suspension()
+
+    def kill(self) -> None:
+        """
+        Send a kill signal to the process, or to its process group if it was
+        started with new_process_group=True.
+        """
+        _signal_process(self._process, self._process_group, kill=True)
+        if self._suspended_since is not None:
+            # the kill signal also ends a stopped process
+            self._end_suspension()
+
+    @property
+    def suspended(self) -> bool:
+        """
+        Whether the process is currently stopped by suspend(). This is reset
+        when the process is continued, terminated or killed, or has ended.
+        """
+        return self._suspended_since is not None
+
+    def suspend(self, pause_timeout: bool = True) -> None:
+        """
+        Stop the process, or its process group if it was started with
+        new_process_group=True, until resume() is called. The process keeps
+        its memory, and output it wrote before is still read.
+        Not supported on Windows.
+
+        :param pause_timeout: Do not count the time spent suspended towards
+                              the timeout (default).
+        """
+        if os.name == "nt":
+            raise NotImplementedError(
+                "Suspending processes is not supported on Windows"
+            )
+        if self._suspended_since is not None:
+            return
+        _send_signal(self._process, signal.SIGSTOP, self._process_group)
+        self._suspended_since = timeit.default_timer()
+        self._pause_timeout = pause_timeout
+
+    def resume(self) -> None:
+        """Continue a process stopped by suspend()."""
+        if self._suspended_since is None:
+            return
+        _send_signal(self._process, signal.SIGCONT, self._process_group)
+        self._end_suspension()
+
+    def _end_suspension(self) -> None:
+        if self._pause_timeout:
+            self._paused_time += timeit.default_timer() - self._suspended_since
+        self._suspended_since = None
+
+    def read_available(self) -> tuple[bytes, bytes]:
+        """
+        Return the stdout and stderr output received since the last call.
+        All output is still included in the final result.
+        """
+        if self._result is not None and self._stdout.omitted is None:
+            outputs = [
+                self._result.stdout[self._read_positions[0] :],
+                self._result.stderr[self._read_positions[1] :],
+            ]
+            self._read_positions[0] += len(outputs[0])
+            self._read_positions[1] += len(outputs[1])
+            return outputs[0], outputs[1]
+        outputs = []
+        for n, reader in enumerate((self._stdout, self._stderr)):
+            data, self._read_positions[n] = reader.read_from(self._read_positions[n])
+            outputs.append(data)
+        return outputs[0], outputs[1]
+
+    def _journal_entry(self, timeout_encountered: bool) -> dict[str, Any]:
+        """Describe the finished process for the run journal."""
+        entry = {
+            "command": [str(part) for part in self.args],
+            "executable": self._executable,
+            "working_directory": self._working_directory,
+            "start": self._start_timestamp,
+            "end": time.time(),
+            "runtime": timeit.default_timer() - self._start_time,
+            "returncode": self._process.returncode,
+            "timeout": timeout_encountered,
+            "killed": self._killed,
+            "stdout_bytes": self._stdout.bytes_read,
+            "stderr_bytes": self._stderr.bytes_read,
+        }
+        if self._rusage is not None:
+            entry["user_time"] = self._rusage.ru_utime
+            entry["system_time"] = self._rusage.ru_stime
+            # ru_maxrss is given in kilobytes, except on macOS
+            entry["max_rss"] = self._rusage.ru_maxrss * (
+                1 if sys.platform == "darwin" else 1024
+            )
+        return entry
+
+    def _attach_records(self, result) -> None:
+        """Attach the records collected by the output parsers."""
+        for stream, parser in zip(("stdout", "stderr"), self._parsers):
+            if parser is not None and parser.records is not None:
+                setattr(result, f"{stream}_records", parser.records)
+
+    def _release(self) -> None:
+        """
+        Stop tracking the process, and release its CPU cores and callback
+        dispatcher, once it has ended or the wait for it was abandoned.
+        """
+        if self._released:
+            return
+        self._released = True
+        _unregister_child(self._process)
+        if self._cpu_allocator:
+            self._cpu_allocator.release(self._cpu_affinity)
+        dispatcher = self._callback_dispatcher
+        if dispatcher is not None:
+            dispatcher.close()
+            if dispatcher.dropped or dispatcher.coalesced:
+                logger.debug(
+                    "Callback queue dropped %d and coalesced %d lines, maximum depth %d",
+                    dispatcher.dropped,
+                    dispatcher.coalesced,
+                    dispatcher.max_depth,
+                )
+
+    def result(self) -> CompletedProcess:
+        """
+        Wait for the process to finish, and collect its output.
+
+        :return: The exit code, stdout, stderr (separately, as byte strings)
+                 as a CompletedProcess object.
+        """
+        if self._result is not None:
+            return self._result
+
+        p = self._process
+        stdout = self._stdout
+        stderr = self._stderr
+        thread_pipe_pool = self._thread_pipe_pool
+        timeout = self._timeout
+        timeout_encountered = self._timeout_encountered
+        sleep_interval = 0.001
+
+        try:
+            while (p.returncode is None) and (
+                (timeout is None) or (timeit.default_timer() < self._deadline())
+            ):
+                # wait for some time or until a stream is closed
+                try:
+                    if thread_pipe_pool:
+                        # Wait for up to 0.5 seconds or for a signal on a remaining stream,
+                        # which could indicate that the process has terminated.
+                        if thread_pipe_pool[0].poll(0.5):
+                            # One-shot, so remove stream and watch remaining streams
+                            thread_pipe_pool.pop(0)
+                    else:
+                        # All streams are closed, so the process is most likely
+                        # exiting. Check again soon, backing off to 0.5 seconds.
+                        time.sleep(sleep_interval)
+                        sleep_interval = min(0.5, sleep_interval * 2)
+                except KeyboardInterrupt:
+                    self.kill()  # if user pressed Ctrl+C we won't be able to produce a proper report anyway
+                    # but at least make sure the child process dies with us
+                    raise
+
+                # check if process is still running
+                self._poll_process()
+
+            if p.returncode is None:
+                # timeout condition
+                timeout_encountered = True
+                logger.debug(
+                    "timeout (T%.2fs)", timeit.default_timer() - self._deadline()
+                )
+
+                # send terminate signal and wait some time for buffers to be read
+                self.terminate()
+                if thread_pipe_pool:
+                    thread_pipe_pool[0].poll(0.5)
+                if not stdout.has_finished() or not stderr.has_finished():
+                    time.sleep(2)
+                self._reap(0.5)
+
+            if p.returncode is None:
+                # thread still alive
+                # send kill signal and wait some more time for buffers to be read
+                self._killed = True
+                self.kill()
+                if thread_pipe_pool:
+                    thread_pipe_pool[0].poll(0.5)
+                if not stdout.has_finished() or not stderr.has_finished():
+                    time.sleep(5)
+                self._reap(5)
+
+            if p.returncode is None:
+                raise RuntimeError("Process won't terminate")
+
+            runtime = timeit.default_timer() - self._start_time
+            if timeout is not None:
+                logger.debug(
+                    "Process ended after %.1f seconds with exit code %d (T%.2fs)",
+                    runtime,
+                    p.returncode,
+                    timeit.default_timer() - self._deadline(),
+                )
+            else:
+                logger.debug(
+                    "Process ended after %.1f seconds with exit code %d",
+                    runtime,
+                    p.returncode,
+                )
+
+            output_stdout = stdout.get_output()
+            output_stderr = stderr.get_output()
+        finally:
+            self._release()
+
+        if self._output_index is not None:
+            self._output_index.attach(output_stdout, output_stderr)
+
+        if _journal is not None:
+            _journal.record(self._journal_entry(timeout_encountered))
+
+        for reader in (stdout, stderr):
+            if reader.decode_error is not None:
+                raise reader.decode_error
+
+        if timeout is not None and timeout_encountered:
+            if self._compression:
+                import zlib
+
+                output_stdout = zlib.decompress(output_stdout)
+                output_stderr = zlib.decompress(output_stderr)
+            exception = subprocess.TimeoutExpired(
+                cmd=self.args,
+                timeout=timeout,
+                output=output_stdout,
+                stderr=output_stderr,
+            )
+            if self._output_index is not None:
+                exception.output_index = self._output_index
+            self._attach_records(exception)
+            raise exception
+
+        if self._compression:
+            result = CompressedCompletedProcess(
+                args=self.args,
+                returncode=p.returncode,
+                stdout_compressed=output_stdout,
+                stderr_compressed=output_stderr,
+                compression=self._compression,
+            )
+        else:
+            result = CompletedProcess(
+                args=self.args,
+                returncode=p.returncode,
+                stdout=output_stdout,
+                stderr=output_stderr,
+            )
+        if self._output_index is not None:
+            result.output_index = self._output_index
+        if stdout.omitted is not None:
+            result.stdout_omitted = stdout.omitted
+            result.stderr_omitted = stderr.omitted
+        self._attach_records(result)
+        if self._encodings:
+            result.encodings = self._encodings
+        if self._resource_usage:
+            result.rusage = self._rusage
+        if self._limits:
+            result.limit_exceeded = _exceeded_resource_limit(p.returncode)
+            if result.limit_exceeded:
+                logger.warning("Process killed by %s", result.limit_exceeded)
+        self._result = result
+        return result
+
+
+def start(
+    command,
+    *,
+    timeout: Optional[float] = None,
+    callback_batch_type: str = "bytes",
+    callback_dispatcher: Optional[CallbackDispatcher] = None,
+    callback_stderr: Optional[Callable] = None,
+    callback_stderr_batch: Optional[Callable] = None,
+    callback_stderr_bytes: Optional[Callable] = None,
+    callback_stderr_records: Optional[Callable] = None,
+    callback_stdout: Optional[Callable] = None,
+    callback_stdout_batch: Optional[Callable] = None,
+    callback_stdout_bytes: Optional[Callable] = None,
+    callback_stdout_records: Optional[Callable] = None,
+    capture: str = "all",
+    capture_compression: Optional[str] = None,
+    capture_head: Optional[Union[int, dict[str, int]]] = None,
+    capture_index: Optional[str] = None,
+    capture_tail: Optional[Union[int, dict[str, int]]] = None,
+    capture_unit: str = "bytes",
+    collapse_progress: bool = False,
+    cpu_affinity: Optional[Union[set[int], CPUAllocator]] = None,
+    creationflags: int = 0,
+    encoding: Optional[Union[str, dict[str, Optional[str]]]] = "utf-8",
+    environment: Optional[dict[str, str]] = None,
+    environment_override: Optional[dict[str, str]] = None,
+    errors: Union[str, dict[str, str]] = "replace",
+    ionice: Optional[Union[str, tuple[str, int]]] = None,
+    limits: Optional[dict[str, Union[int, tuple[int, int]]]] = None,
+    line_delimiter: Union[bytes, str] = b"\n",
+    max_line_length: Optional[int] = None,
+    new_process_group: bool = False,
+    nice: Optional[int] = None,
+    overlong_lines: str = "split",
+    parse_stderr: Optional[Union[str, RecordParser]] = None,
+    parse_stdout: Optional[Union[str, RecordParser]] = None,
+    preexec_fn: Optional[Callable] = None,
+    print_stderr: bool = True,
+    print_stdout: bool = True,
+    pty: Union[bool, str] = False,
+    pty_size: tuple[int, int] = (24, 80),
+    reactor: bool = False,
+    resource_usage: bool = False,
+    stdin: Optional[Union[bytes, int]] = None,
+    win32resolve: bool = True,
+    working_directory: Optional[str] = None,
+) -> ProcessHandle:
+    """
+    Start an external process without waiting for it to finish.
+
+    This accepts the same arguments as run(), and returns a ProcessHandle
+    object to monitor and control the process. The timeout is counted from
+    the start of the process and enforced by the ProcessHandle methods.
+    """
+    logger.debug("Starting external process: %s", command)
+
+    if callback_batch_type not in _LineAggregator.batch_types:
+        raise ValueError(f"Unknown callback batch type {callback_batch_type!r}")
+    if not line_delimiter:
+        raise ValueError("Line delimiter must not be empty")
+    if max_line_length is not None and max_line_length < 1:
+        raise ValueError("Maximum line length must be a positive number")
+    if overlong_lines not in _LineAggregator.overlong_line_modes:
+        raise ValueError(f"Unknown overlong line mode {overlong_lines!r}")
+    stdout_buffer, stderr_buffer = _capture_buffers(
+        capture,
+        capture_compression,
+        capture_head,
+        capture_tail,
+        capture_unit,
+        capture_index,
+        max_line_length,
+    )
+    output_index = OutputIndex(capture_index) if capture_index else None
+    if parse_stdout is not None or parse_stderr is not None:
+        from procrunner import parsers
+
+        if parse_stdout is not None:
+            parse_stdout = parsers.create(parse_stdout, callback_stdout_records)
+        if parse_stderr is not None:
+            parse_stderr = parsers.create(parse_stderr, callback_stderr_records)
+    if (callback_stdout_records and parse_stdout is None) or (
+        callback_stderr_records and parse_stderr is None
+    ):
+        raise ValueError("Record callbacks require a record format to be set")
+    (stdout_encoding, stdout_errors), (stderr_encoding, stderr_errors) = (
+        _stream_encodings(encoding, errors)
+    )
+    for stream_encoding, callback, callback_batch in (
+        (stdout_encoding, callback_stdout, callback_stdout_batch),
+        (stderr_encoding, callback_stderr, callback_stderr_batch),
+    ):
+        if stream_encoding is None and (
+            callback or (callback_batch and callback_batch_type == "str")
+        ):
+            raise ValueError("Callbacks receiving strings require an encoding")
+    resource_limits = _resource_limits(limits) if limits else None
+    if resource_limits and not _prlimit_available():
+        # limits can not be set from outside, so set them in the child process
+        preexec_fn = _resource_limit_preexec_fn(resource_limits, preexec_fn)
+        resource_limits = None
+
+    stdin_pipe, stdin = _stdin_pipe(stdin)
+
+    start_time = timeit.default_timer()
+
+    env = _process_environment(environment, environment_override)
+
+    command = tuple(_path_resolve(part) for part in command)
+    if win32resolve and sys.platform == "win32":
+        command = _windows_resolve(command)
+
+    if pty not in (False, True, "stdout", "both"):
+        raise ValueError(f"Unknown pseudo-terminal mode {pty!r}")
+    if pty and os.name == "nt":
+        raise NotImplementedError("Pseudo-terminals are not supported on Windows")
+    if resource_usage and not hasattr(os, "wait4"):
+        raise NotImplementedError("Resource usage is not available on this platform")
+    if new_process_group and os.name == "nt":
+        raise NotImplementedError("Process groups are not supported on Windows")
+    if _journal is not None:
+        import shutil
+
+        executable = shutil.which(command[0], path=env.get("PATH")) or command[0]
+        journal_directory = os.path.abspath(working_directory or os.curdir)
+        if _journal.resource_usage and hasattr(os, "wait4"):
+            resource_usage = True
+    else:
+        executable = journal_directory = None
+    terminals = []
+    stdout_target = stderr_target = subprocess.PIPE
+    if pty:
+        stdout_stream, stdout_target = _open_pty(pty_size)
+        terminals.append(stdout_target)
+    if pty == "both":
+        stderr_stream, stderr_target = _open_pty(pty_size)
+        terminals.append(stderr_target)
+
+    try:
+        p = subprocess.Popen(
+            command,
+            shell=False,
+            cwd=working_directory,
+            env=env,
+            stdin=stdin_pipe,
+            stdout=stdout_target,
+            stderr=stderr_target,
+            creationflags=creationflags,
+            preexec_fn=preexec_fn,
+            start_new_session=new_process_group,
+        )
+    except BaseException:
+        if pty:
+            stdout_stream.close()
+        if pty == "both":
+            stderr_stream.close()
+        raise
+    finally:
+        # The terminal side is now held by the child process only
+        for terminal in terminals:
+            os.close(terminal)
+    _register_child(p, new_process_group)
+    if not pty:
+        stdout_stream = p.stdout
+    if pty != "both":
+        stderr_stream = p.stderr
+    if isinstance(cpu_affinity, CPUAllocator):
+        cpu_allocator = cpu_affinity
+        cpu_affinity = cpu_allocator.acquire()
+    else:
+        cpu_allocator = None
+    try:
+        if resource_limits:
+            _apply_resource_limits(p.pid, resource_limits)
+        if cpu_affinity is not None or nice is not None or ionice is not None:
+            _apply_scheduling(p.pid, cpu_affinity, nice=nice, ionice=ionice)
+    except BaseException:
+        p.kill()
+        p.wait()
+        if cpu_allocator:
+            cpu_allocator.release(cpu_affinity)
+        raise
+
+    if callback_dispatcher is not None:
+        callback_dispatcher.start()
+        if callback_stdout:
+            callback_stdout = callback_dispatcher.wrap(callback_stdout)
+        if callback_stderr:
+            callback_stderr = callback_dispatcher.wrap(callback_stderr)
+        if callback_stdout_bytes:
+            callback_stdout_bytes = callback_dispatcher.wrap(callback_stdout_bytes)
+        if callback_stderr_bytes:
+            callback_stderr_bytes = callback_dispatcher.wrap(callback_stderr_bytes)
+        if callback_stdout_batch:
+            callback_stdout_batch = callback_dispatcher.wrap(callback_stdout_batch)
+        if callback_stderr_batch:
+            callback_stderr_batch = callback_dispatcher.wrap(callback_stderr_batch)
+
+    if output_index is not None:
+        record_stdout = output_index.recorder("stdout")
+        record_stderr = output_index.recorder("stderr")
+    else:
+        record_stdout = record_stderr = None
+    observers = _output_observer() if _output_observer is not None else None
+    if observers is not None:
+        record_stdout = _combine_recorders(record_stdout, observers[0])
+        record_stderr = _combine_recorders(record_stderr, observers[1])
+
+    if reactor and os.name != "nt":
+        stream_reactor = _get_reactor()
+    else:
+        stream_reactor = None
+
+    thread_pipe_pool = []
+    notification = _Notification()
+    thread_pipe_pool.append(notification)
+    stdout = _NonBlockingStreamReader(
+        stdout_stream,
+        output=_ConsoleWriter("stdout", stdout_encoding) if print_stdout else None,
+        notify=notification.close,
+        callback=callback_stdout,
+        callback_bytes=callback_stdout_bytes,
+        callback_batch=callback_stdout_batch,
+        batch_type=callback_batch_type,
+        record=record_stdout,
+        reactor=stream_reactor,
+        delimiter=line_delimiter,
+        collapse_progress=collapse_progress,
+        max_line_length=max_line_length,
+        overlong_lines=overlong_lines,
+        buffer=stdout_buffer,
+        parser=parse_stdout,
+        encoding=stdout_encoding,
+        errors=stdout_errors,
+    )
+    notification = _Notification()
+    thread_pipe_pool.append(notification)
+    stderr = _NonBlockingStreamReader(
+        stderr_stream,
+        output=_ConsoleWriter("stderr", stderr_encoding) if print_stderr else None,
+        notify=notification.close,
+        callback=callback_stderr,
+        callback_bytes=callback_stderr_bytes,
+        callback_batch=callback_stderr_batch,
+        batch_type=callback_batch_type,
+        record=record_stderr,
+        reactor=stream_reactor,
+        delimiter=line_delimiter,
+        collapse_progress=collapse_progress,
+        max_line_length=max_line_length,
+        overlong_lines=overlong_lines,
+        buffer=stderr_buffer,
+        parser=parse_stderr,
+        encoding=stderr_encoding,
+        errors=stderr_errors,
+    )
+    if stdin is not None:
+        notification = _Notification()
+        thread_pipe_pool.append(notification)
+        _NonBlockingStreamWriter(
+            p.stdin, data=stdin, notify=notification.close, reactor=stream_reactor
+        )
+
+    return ProcessHandle(
+        command,
+        p,
+        stdout,
+        stderr,
+        thread_pipe_pool,
+        timeout=timeout,
+        start_time=start_time,
+        cpu_allocator=cpu_allocator,
+        cpu_affinity=cpu_affinity,
+        callback_dispatcher=callback_dispatcher,
+        output_index=output_index,
+        limits=limits,
+        compression=capture_compression,
+        resource_usage=resource_usage,
+        executable=executable,
+        working_directory=journal_directory,
+        process_group=new_process_group,
+        parsers=(parse_stdout, parse_stderr),
+        encodings={
+            "stdout": (stdout_encoding, stdout_errors),
+            "stderr": (stderr_encoding, stderr_errors),
+        },
+    )
+
+
+class _PtyStream:
+    """
+    File object for reading from the controlling side of a pseudo-terminal.
+    Once the process has closed the terminal, reading returns an empty byte
+    string rather than raising an EIO error.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self.closed = False
+
+    def fileno(self):
+        return self._fd
+
+    def read1(self, size=65536):
+        try:
+            return os.read(self._fd, size)
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            return b""
+
+    read = read1
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            os.close(self._fd)
+
+
+def _open_pty(size):
+    """
+    Open a pseudo-terminal to connect to a process output stream.
+
+    The terminal does not translate newlines into carriage return/newline
+    pairs, so output is captured the same way as through a pipe.
+
+    :param size: The terminal window size as tuple of (rows, columns).
+    :return: A tuple of a _PtyStream object to read from, and the file
+             descriptor to pass to the process.
+    """
+    import fcntl
+    import pty
+    import struct
+    import termios
+
+    controller, terminal = pty.openpty()
+    attributes = termios.tcgetattr(terminal)
+    attributes[1] &= ~termios.ONLCR  # output flags
+    termios.tcsetattr(terminal, termios.TCSANOW, attributes)
+    rows, columns = size
+    fcntl.ioctl(terminal, termios.TIOCSWINSZ, struct.pack("HHHH", rows, columns, 0, 0))
+    return _PtyStream(controller), terminal
+
+
 def run(
     command,
     *,
     timeout: Optional[float] = None,
+    callback_batch_type: str = "bytes",
+    callback_dispatcher: Optional[CallbackDispatcher] = None,
     callback_stderr: Optional[Callable] = None,
+    callback_stderr_batch: Optional[Callable] = None,
+    callback_stderr_bytes: Optional[Callable] = None,
+    callback_stderr_records: Optional[Callable] = None,
     callback_stdout: Optional[Callable] = None,
+    callback_stdout_batch: Optional[Callable] = None,
+    callback_stdout_bytes: Optional[Callable] = None,
+    callback_stdout_records: Optional[Callable] = None,
+    capture: str = "all",
+    capture_compression: Optional[str] = None,
+    capture_head: Optional[Union[int, dict[str, int]]] = None,
+    capture_index: Optional[str] = None,
+    capture_tail: Optional[Union[int, dict[str, int]]] = None,
+    capture_unit: str = "bytes",
+    collapse_progress: bool = False,
+    cpu_affinity: Optional[Union[set[int], CPUAllocator]] = None,
     creationflags: int = 0,
+    encoding: Optional[Union[str, dict[str, Optional[str]]]] = "utf-8",
     environment: Optional[dict[str, str]] = None,
     environment_override: Optional[dict[str, str]] = None,
+    errors: Union[str, dict[str, str]] = "replace",
+    ionice: Optional[Union[str, tuple[str, int]]] = None,
+    limits: Optional[dict[str, Union[int, tuple[int, int]]]] = None,
+    line_delimiter: Union[bytes, str] = b"\n",
+    max_line_length: Optional[int] = None,
+    new_process_group: bool = False,
+    nice: Optional[int] = None,
+    overlong_lines: str = "split",
+    parse_stderr: Optional[Union[str, RecordParser]] = None,
+    parse_stdout: Optional[Union[str, RecordParser]] = None,
     preexec_fn: Optional[Callable] = None,
     print_stderr: bool = True,
     print_stdout: bool = True,
+    pty: Union[bool, str] = False,
+    pty_size: tuple[int, int] = (24, 80),
     raise_timeout_exception: Any = ...,
+    reactor: bool = False,
+    resource_usage: bool = False,
     stdin: Optional[Union[bytes, int]] = None,
     win32resolve: bool = True,
     working_directory: Optional[str] = None,
-) -> subprocess.CompletedProcess:
+) -> CompletedProcess:
     """
     Run an external process.
 
@@ -333,11 +2876,138 @@ def run(
                             stdout line.
     :param callback_stderr: Optional function which is called for each
                             stderr line.
+    :param callback_stdout_bytes: Optional function which is called for each
+                                  stdout line as a byte string.
+    :param callback_stderr_bytes: Optional function which is called for each
+                                  stderr line as a byte string.
+    :param callback_stdout_batch: Optional function which is called with a
+                                  list of stdout lines for each block of
+                                  output read from the process.
+    :param callback_stderr_batch: Optional function which is called with a
+                                  list of stderr lines for each block of
+                                  output read from the process.
+    :param callback_stdout_records: Optional function which is called for each
+                                    record parsed from stdout, see
+                                    'parse_stdout'.
+    :param callback_stderr_records: Optional function which is called for each
+                                    record parsed from stderr.
+    :param callback_batch_type: The type of the lines passed to the batch
+                                callback functions: "str", "bytes" (default),
+                                or "memoryview" for slices of the read data.
+    :param callback_dispatcher: Optional CallbackDispatcher object. If given,
+                                the stdout/stderr callback functions are
+                                called from a separate thread, so that slow
+                                callbacks do not hold up the process.
+    :param capture: Which process output to keep. "all" (the default),
+                    "head_tail" to keep only the beginning and the end of
+                    each stream in constant memory, or "none". The number of
+                    bytes discarded is attached to the result as
+                    'stdout_omitted' and 'stderr_omitted'.
+    :param capture_compression: Set to "zlib" to compress the process output
+                                as it is captured. The result is then a
+                                CompressedCompletedProcess object, which
+                                decompresses stdout and stderr on first use
+                                and provides the compressed data as
+                                'stdout_compressed' and 'stderr_compressed'.
+    :param capture_head: With capture="head_tail", the amount of output kept
+                         from the beginning of each stream. Either a number,
+                         or a dictionary with separate numbers for "stdout"
+                         and "stderr".
+    :param capture_index: If set to "chunk" or "line", record the time and
+                          order in which the process output was received in
+                          an OutputIndex object, which is attached to the
+                          result as 'output_index'.
+    :param capture_tail: With capture="head_tail", the amount of output kept
+                         from the end of each stream, given like capture_head.
+    :param capture_unit: Whether capture_head and capture_tail count "bytes"
+                         (the default) or "lines". With "lines", no more than
+                         max_line_length bytes (64 KiB if not set) of an
+                         incomplete line are kept.
+    :param boolean collapse_progress: With the "universal" line delimiter,
+                                      only pass on the most recent of a series
+                                      of lines ending on a carriage return,
+                                      such as progress bar updates.
+    :param cpu_affinity: Restrict the process to a set of CPU cores, or to
+                         the cores handed out by a CPUAllocator object.
+                         Linux only.
     :param creationflags: flags that will be passed to subprocess call
+    :param encoding: The encoding of the process output, used to decode lines
+                     for the callback functions and the text attributes of
+                     the result. Either one encoding for both streams, or a
+                     dictionary with separate encodings for "stdout" and
+                     "stderr". Defaults to "utf-8". None selects binary mode,
+                     where the output is never decoded and is printed
+                     unchanged. Only ASCII compatible encodings are supported.
     :param dict environment: The full execution environment for the command.
     :param dict environment_override: Change environment variables from the
                                       current values for command execution.
+    :param errors: The error handler for decoding the output, eg. "strict",
+                   given like encoding. Defaults to "replace". With "strict",
+                   a UnicodeDecodeError is raised once the process has ended
+                   if its output could not be decoded.
+    :param ionice: I/O scheduling class of the process, one of "realtime",
+                   "best-effort" or "idle", or a tuple of class and priority
+                   level (0-7). Linux only.
+    :param line_delimiter: The delimiter on which output is split into
+                           lines for the callback functions. This can be any
+                           byte string, eg. b"\\0", or "universal" to split
+                           on newlines, carriage returns, or both.
+                           Defaults to b"\\n".
+    :param int max_line_length: Limit the length of lines passed to the
+                                callback functions to this many bytes. The
+                                data of longer lines is not held back in
+                                memory, but passed on or dropped as set by
+                                'overlong_lines'.
+    :param boolean new_process_group: Start the process in a new session and
+                                      process group, so that a timeout, the
+                                      ProcessHandle terminate() and kill()
+                                      methods, and shutdown() signal all
+                                      processes in the group, including any
+                                      processes it started. The process then
+                                      no longer receives signals sent to the
+                                      terminal, eg. by Ctrl+C.
+                                      Not supported on Windows.
+    :param int nice: Scheduling priority (nice value) of the process.
+                     Not supported on Windows.
+    :param overlong_lines: What to do with lines exceeding max_line_length.
+                           "split" (the default) passes them on in pieces,
+                           all but the last of which are PartialLine (or
+                           PartialLineBytes) objects. "truncate" cuts them
+                           short and marks them with "[...]".
+    :param dict limits: Resource limits for the process, as a dictionary of
+                        resource names (eg. "as", "cpu", "nofile", see the
+                        RLIMIT_* constants of the resource module) to either
+                        a limit value or a tuple of (soft, hard) limits.
+                        If a limit terminates the process its name is set as
+                        the 'limit_exceeded' attribute of the result.
+                        Not supported on Windows.
+    :param parse_stdout: Parse the stdout lines into records as they are read,
+                         with a format from procrunner.parsers: "json" for
+                         JSON lines, "keyvalue" for key=value pairs, "csv"
+                         for comma separated values, or a RecordParser
+                         object. Unless callback_stdout_records is set the
+                         records are attached to the result as a list
+                         'stdout_records'.
+    :param parse_stderr: Parse the stderr lines into records, attached to the
+                         result as 'stderr_records'.
     :param preexec_fn: pre-execution function, will be passed to subprocess call
+    :param pty: Connect the process stdout to a pseudo-terminal rather than
+                a pipe, so that the process flushes its output line by line,
+                as it would when run interactively. Set to "both" to also
+                connect stderr to a (separate) pseudo-terminal.
+                Not supported on Windows.
+    :param pty_size: Window size of the pseudo-terminal, as tuple of
+                     (rows, columns).
+    :param boolean reactor: Service the process pipes from a single
+                            background thread shared by all processes using
+                            this option, rather than from a thread per pipe.
+                            Callback functions are then called from that
+                            thread and should not block; consider passing a
+                            CallbackDispatcher. Ignored on Windows.
+    :param boolean resource_usage: Collect the CPU time, maximum resident set
+                                   size and other resource usage of the process
+                                   with os.wait4(), attached to the result as
+                                   'rusage'. Not supported on Windows.
     :param boolean win32resolve: If on Windows, find the appropriate executable
                                  first. This allows running of .bat, .cmd, etc.
                                  files without explicitly specifying their
@@ -346,26 +3016,10 @@ def run(
                                      within this working directory.
     :param boolean raise_timeout_exception: Deprecated compatibility flag.
     :return: The exit code, stdout, stderr (separately, as byte strings)
-             as a subprocess.CompletedProcess object.
+             as a CompletedProcess object, a subclass of
+             subprocess.CompletedProcess.
     """
 
-    logger.debug("Starting external process: %s", command)
-
-    if stdin is None:
-        stdin_pipe = None
-    elif isinstance(stdin, int):
-        assert (
-            stdin == subprocess.DEVNULL
-        ), "stdin argument only allows subprocess.DEVNULL as numeric argument"
-        stdin_pipe = subprocess.DEVNULL
-        stdin = None
-    else:
-        assert sys.platform != "win32", "stdin argument not supported on Windows"
-        stdin_pipe = subprocess.PIPE
-
-    start_time = timeit.default_timer()
-    if timeout is not None:
-        max_time = start_time + timeout
     if not raise_timeout_exception:
         warnings.warn(
             "Using procrunner with raise_timeout_exception=False is no longer supported",
@@ -379,151 +3033,291 @@ def run(
             stacklevel=3,
         )
 
-    if environment is not None:
-        env = {key: _path_resolve(environment[key]) for key in environment}
-    else:
-        env = {key: value for key, value in os.environ.items()}
-    if environment_override:
-        env.update(
-            {
-                key: str(_path_resolve(environment_override[key]))
-                for key in environment_override
-            }
-        )
-
-    command = tuple(_path_resolve(part) for part in command)
-    if win32resolve and sys.platform == "win32":
-        command = _windows_resolve(command)
-
-    p = subprocess.Popen(
+    return start(
         command,
-        shell=False,
-        cwd=working_directory,
-        env=env,
-        stdin=stdin_pipe,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        timeout=timeout,
+        callback_batch_type=callback_batch_type,
+        callback_dispatcher=callback_dispatcher,
+        callback_stderr=callback_stderr,
+        callback_stderr_batch=callback_stderr_batch,
+        callback_stderr_bytes=callback_stderr_bytes,
+        callback_stderr_records=callback_stderr_records,
+        callback_stdout=callback_stdout,
+        callback_stdout_batch=callback_stdout_batch,
+        callback_stdout_bytes=callback_stdout_bytes,
+        callback_stdout_records=callback_stdout_records,
+        capture=capture,
+        capture_compression=capture_compression,
+        capture_head=capture_head,
+        capture_index=capture_index,
+        capture_tail=capture_tail,
+        capture_unit=capture_unit,
+        collapse_progress=collapse_progress,
+        cpu_affinity=cpu_affinity,
         creationflags=creationflags,
+        encoding=encoding,
+        environment=environment,
+        environment_override=environment_override,
+        errors=errors,
+        ionice=ionice,
+        limits=limits,
+        line_delimiter=line_delimiter,
+        max_line_length=max_line_length,
+        new_process_group=new_process_group,
+        nice=nice,
+        overlong_lines=overlong_lines,
+        parse_stderr=parse_stderr,
+        parse_stdout=parse_stdout,
         preexec_fn=preexec_fn,
-    )
+        print_stderr=print_stderr,
+        print_stdout=print_stdout,
+        pty=pty,
+        pty_size=pty_size,
+        reactor=reactor,
+        resource_usage=resource_usage,
+        stdin=stdin,
+        win32resolve=win32resolve,
+        working_directory=working_directory,
+    ).result()
 
-    thread_pipe_pool = []
-    notifyee, notifier = Pipe(False)
-    thread_pipe_pool.append(notifyee)
-    stdout = _NonBlockingStreamReader(
-        p.stdout,
-        output=print_stdout,
-        notify=notifier.close,
-        callback=callback_stdout,
-    )
-    notifyee, notifier = Pipe(False)
-    thread_pipe_pool.append(notifyee)
-    stderr = _NonBlockingStreamReader(
-        p.stderr,
-        output=print_stderr,
-        notify=notifier.close,
-        callback=callback_stderr,
-    )
-    if stdin is not None:
-        notifyee, notifier = Pipe(False)
-        thread_pipe_pool.append(notifyee)
-        _NonBlockingStreamWriter(p.stdin, data=stdin, notify=notifier.close)
 
-    timeout_encountered = False
+class CompletedPipeline(subprocess.CompletedProcess):
+    """
+    The result of a pipeline() call.
 
-    while (p.returncode is None) and (
-        (timeout is None) or (timeit.default_timer() < max_time)
-    ):
-        # wait for some time or until a stream is closed
-        try:
-            if thread_pipe_pool:
-                # Wait for up to 0.5 seconds or for a signal on a remaining stream,
-                # which could indicate that the process has terminated.
-                try:
-                    event = thread_pipe_pool[0].poll(0.5)
-                except BrokenPipeError as e:
-                    # on Windows this raises "BrokenPipeError: [Errno 109] The pipe has been ended"
-                    # which is for all intents and purposes equivalent to a True return value.
-                    if e.winerror != 109:
-                        raise
-                    event = True
-                if event:
-                    # One-shot, so remove stream and watch remaining streams
-                    thread_pipe_pool.pop(0)
-            else:
-                time.sleep(0.5)
-        except KeyboardInterrupt:
-            p.kill()  # if user pressed Ctrl+C we won't be able to produce a proper report anyway
-            # but at least make sure the child process dies with us
-            raise
+    This is a subprocess.CompletedProcess object where args holds the commands
+    of all stages, stdout is the output of the final stage, and stderr is the
+    error output of all stages concatenated. returncode is the exit code of
+    the last stage that failed, or 0 if all stages succeeded, which is the
+    behaviour of 'set -o pipefail' in bash. The exit codes and error outputs
+    of the individual stages are available as returncodes and stderrs.
+    """
 
-        # check if process is still running
-        p.poll()
+    def __init__(self, args, returncodes, stdout, stderrs):
+        returncode = next((rc for rc in reversed(returncodes) if rc), 0)
+        super().__init__(
+            args=args, returncode=returncode, stdout=stdout, stderr=b"".join(stderrs)
+        )
+        self.returncodes = returncodes
+        self.stderrs = stderrs
 
-    if p.returncode is None:
-        # timeout condition
-        timeout_encountered = True
-        logger.debug("timeout (T%.2fs)", timeit.default_timer() - max_time)
 
-        # send terminate signal and wait some time for buffers to be read
-        p.terminate()
-        if thread_pipe_pool:
-            try:
-                thread_pipe_pool[0].poll(0.5)
-            except BrokenPipeError as e:
-                # on Windows this raises "BrokenPipeError: [Errno 109] The pipe has been ended"
-                # which is for all intents and purposes equivalent to a True return value.
-                if e.winerror != 109:
-                    raise
-                thread_pipe_pool.pop(0)
-        if not stdout.has_finished() or not stderr.has_finished():
-            time.sleep(2)
-        p.poll()
-
-    if p.returncode is None:
-        # thread still alive
-        # send kill signal and wait some more time for buffers to be read
-        p.kill()
-        if thread_pipe_pool:
+def _stop_processes(processes, grace_period=2, process_groups=()):
+    """
+    Terminate a group of processes, and kill those that do not exit within
+    a grace period. All processes are signalled at once, so the total time
+    taken does not depend on the number of processes. Processes listed in
+    process_groups are signalled together with their process group, which
+    is killed even if the process itself exited after the terminate signal.
+    """
+    for kill, wait_period in ((False, grace_period), (True, 5)):
+        running = [p for p in processes if p.poll() is None]
+        if kill:
+            # remaining members of process groups whose leader has exited
+            for p in process_groups:
+                if p not in running:
+                    _signal_process(p, process_group=True, kill=True)
+        if not running:
+            return
+        for p in running:
+            _signal_process(p, p in process_groups, kill=kill)
+        deadline = timeit.default_timer() + wait_period
+        for p in running:
             try:
-                thread_pipe_pool[0].poll(0.5)
-            except BrokenPipeError as e:
-                # on Windows this raises "BrokenPipeError: [Errno 109] The pipe has been ended"
-                # which is for all intents and purposes equivalent to a True return value.
-                if e.winerror != 109:
-                    raise
-                thread_pipe_pool.pop(0)
-        if not stdout.has_finished() or not stderr.has_finished():
-            time.sleep(5)
-        p.poll()
-
-    if p.returncode is None:
+                p.wait(timeout=max(0, deadline - timeit.default_timer()))
+            except subprocess.TimeoutExpired:
+                pass
+    if any(p.poll() is None for p in processes):
         raise RuntimeError("Process won't terminate")
 
-    runtime = timeit.default_timer() - start_time
-    if timeout is not None:
-        logger.debug(
-            "Process ended after %.1f seconds with exit code %d (T%.2fs)",
-            runtime,
-            p.returncode,
-            timeit.default_timer() - max_time,
-        )
-    else:
-        logger.debug(
-            "Process ended after %.1f seconds with exit code %d", runtime, p.returncode
+
+def pipeline(
+    *commands,
+    timeout: Optional[float] = None,
+    callback_stderr: Optional[Callable] = None,
+    callback_stdout: Optional[Callable] = None,
+    environment: Optional[dict[str, str]] = None,
+    environment_override: Optional[dict[str, str]] = None,
+    print_stderr: bool = True,
+    print_stdout: bool = True,
+    stdin: Optional[Union[bytes, int]] = None,
+    win32resolve: bool = True,
+    working_directory: Optional[str] = None,
+) -> CompletedPipeline:
+    """
+    Run a chain of external processes, where the stdout of each process is
+    connected to the stdin of the next, as in 'tool_a | filter | compress'.
+
+    The processes are connected directly by operating system pipes, so data
+    passed between the stages does not go through Python. Only the output of
+    the final stage and the error output of all stages are captured.
+
+    :param commands: Command lines to be run, each specified as an array.
+    :param timeout: Terminate all processes after this many seconds.
+    :param stdin: Optional bytestring that is passed to the stdin of the first
+                  process, or subprocess.DEVNULL to disable stdin.
+    :param boolean print_stdout: Pass stdout of the final process through to
+                                 sys.stdout.
+    :param boolean print_stderr: Pass stderr of all processes through to
+                                 sys.stderr.
+    :param callback_stdout: Optional function which is called for each
+                            stdout line of the final process.
+    :param callback_stderr: Optional function which is called for each
+                            stderr line of any process.
+    :param dict environment: The full execution environment for the commands.
+    :param dict environment_override: Change environment variables from the
+                                      current values for command execution.
+    :param boolean win32resolve: If on Windows, find the appropriate executables
+                                 first.
+    :param string working_directory: If specified, run the executables from
+                                     within this working directory.
+    :return: A CompletedPipeline object with the exit codes of all processes,
+             the stdout of the final process, and the stderr of all processes.
+    """
+    if not commands:
+        raise ValueError("A pipeline requires at least one command")
+    logger.debug("Starting external pipeline: %s", commands)
+
+    stdin_pipe, stdin = _stdin_pipe(stdin)
+    env = _process_environment(environment, environment_override)
+    resolved = []
+    for command in commands:
+        command = tuple(_path_resolve(part) for part in command)
+        if win32resolve and sys.platform == "win32":
+            command = _windows_resolve(command)
+        resolved.append(command)
+    commands = tuple(resolved)
+
+    start_time = timeit.default_timer()
+    processes: list[subprocess.Popen] = []
+    try:
+        for command in commands:
+            p = subprocess.Popen(
+                command,
+                shell=False,
+                cwd=working_directory,
+                env=env,
+                stdin=processes[-1].stdout if processes else stdin_pipe,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            _register_child(p)
+            if processes:
+                # The pipe is now held by the next stage. Closing our copy
+                # means the previous stage sees a broken pipe should the next
+                # stage exit early.
+                processes[-1].stdout.close()
+            processes.append(p)
+    except BaseException:
+        for p in processes:
+            p.kill()
+            p.wait()
+        raise
+
+    stderr_output = _ConsoleWriter("stderr") if print_stderr else None
+    stderr_readers = [
+        _NonBlockingStreamReader(
+            p.stderr, output=stderr_output, callback=callback_stderr
         )
+        for p in processes
+    ]
+    stdout_reader = _NonBlockingStreamReader(
+        processes[-1].stdout,
+        output=_ConsoleWriter("stdout") if print_stdout else None,
+        callback=callback_stdout,
+    )
+    if stdin is not None:
+        _NonBlockingStreamWriter(processes[0].stdin, data=stdin)
 
-    output_stdout = stdout.get_output()
-    output_stderr = stderr.get_output()
+    timeout_encountered = False
+    try:
+        for p in processes:
+            if timeout is None:
+                p.wait()
+            else:
+                p.wait(timeout=max(0, start_time + timeout - timeit.default_timer()))
+    except subprocess.TimeoutExpired:
+        timeout_encountered = True
+        logger.debug("pipeline timeout (T%.2fs)", timeit.default_timer() - start_time)
+        _stop_processes(processes)
+    except KeyboardInterrupt:
+        for p in processes:
+            p.kill()
+        raise
+
+    returncodes = [p.returncode for p in processes]
+    for p in processes:
+        _unregister_child(p)
+    logger.debug(
+        "Pipeline ended after %.1f seconds with exit codes %s",
+        timeit.default_timer() - start_time,
+        returncodes,
+    )
+
+    output_stdout = stdout_reader.get_output()
+    output_stderrs = [reader.get_output() for reader in stderr_readers]
 
     if timeout is not None and timeout_encountered:
         raise subprocess.TimeoutExpired(
-            cmd=command, timeout=timeout, output=output_stdout, stderr=output_stderr
+            cmd=commands,
+            timeout=timeout,
+            output=output_stdout,
+            stderr=b"".join(output_stderrs),
         )
 
-    return subprocess.CompletedProcess(
-        args=command,
-        returncode=p.returncode,
+    return CompletedPipeline(
+        args=commands,
+        returncodes=returncodes,
         stdout=output_stdout,
-        stderr=output_stderr,
+        stderrs=output_stderrs,
     )
+
+
+def shutdown(grace: float = 2.0) -> int:
+    """
+    Stop all processes started by procrunner that are still running.
+
+    All processes are sent a terminate signal at once, and those still running
+    after the grace period are killed, so the total time taken does not depend
+    on the number of processes. Processes started with new_process_group=True
+    are signalled together with their process group.
+    This function is called when the Python interpreter exits.
+
+    :param grace: Seconds to wait after the terminate signal before the
+                  remaining processes are killed.
+    :return: The number of processes that were still running.
+    """
+    with _children_lock:
+        children = dict(_children)
+        _children.clear()
+    running = [p for p in children if p.poll() is None]
+    if running:
+        logger.debug("Stopping %d running processes", len(running))
+        try:
+            _stop_processes(
+                running,
+                grace_period=grace,
+                process_groups={p for p in running if children[p]},
+            )
+        except RuntimeError:
+            logger.warning(
+                "Processes %s won't terminate",
+                ", ".join(str(p.pid) for p in running if p.returncode is None),
+            )
+    return len(running)
+
+
+atexit.register(shutdown)
+
+
+def benchmark(command, **kwargs):
+    """
+    Run a command repeatedly and report statistics of its wall time, CPU time
+    and memory usage. See procrunner.benchmarking.benchmark() for the
+    arguments.
+
+    :return: A list of procrunner.benchmarking.BenchmarkResult objects.
+    """
+    from procrunner.benchmarking import benchmark
+
+    return benchmark(command, **kwargs)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import argparse
+import sys
+
+from procrunner import benchmarking, journal
+
+
+def _parameter(value: str) -> tuple[str, list[str]]:
+    name, separator, values = value.partition("=")
+    if not separator or not name:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE,... not {value!r}")
+    return name, values.split(",")
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m procrunner")
+    commands = parser.add_subparsers(dest="action", required=True)
+
+    bench = commands.add_parser(
+        "bench", help="run a command repeatedly and report timing statistics"
+    )
+    bench.add_argument("--runs", "-r", type=int, default=10, help="measured runs")
+    bench.add_argument(
+        "--warmup", "-w", type=int, default=1, help="runs before the measured runs"
+    )
+    bench.add_argument(
+        "--parameter",
+        "-p",
+        action="append",
+        type=_parameter,
+        default=[],
+        metavar="NAME=VALUE,...",
+        help="substitute {NAME} in the command with each of the values",
+    )
+    bench.add_argument(
+        "--show-output", action="store_true", help="print the command output"
+    )
+    bench.add_argument(
+        "--ignore-failure", "-i", action="store_true", help="ignore non-zero exit codes"
+    )
+    bench.add_argument("--export-json", metavar="FILE", help="write results as JSON")
+    bench.add_argument("command", nargs=argparse.REMAINDER)
+
+    summary = commands.add_parser(
+        "journal", help="summarize run journal files by executable"
+    )
+    summary.add_argument("files", nargs="+", metavar="FILE")
+    summary.add_argument(
+        "--limit", "-n", type=int, default=20, help="number of executables to list"
+    )
+    summary.add_argument(
+        "--slowest",
+        type=int,
+        default=0,
+        metavar="N",
+        help="also list the N slowest runs",
+    )
+
+    options = parser.parse_args(args)
+    if options.action == "journal":
+        entries = journal.load(*options.files)
+        print(journal.format_summary(journal.summarize(entries), limit=options.limit))
+        if options.slowest:
+            print()
+            for entry in journal.slowest(entries, options.slowest):
+                print(f"{entry['runtime']:>9.3f}s  {' '.join(entry['command'])}")
+        return 0
+
+    command = options.command
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        parser.error("no command given")
+
+    results = benchmarking.benchmark(
+        command,
+        discard_output=not options.show_output,
+        export_json=options.export_json,
+        ignore_failure=options.ignore_failure,
+        parameters=dict(options.parameter) or None,
+        runs=options.runs,
+        warmup=options.warmup,
+    )
+    for result in results:
+        print(benchmarking.format_result(result))
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
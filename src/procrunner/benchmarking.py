@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import itertools
+import json
+import logging
+import math
+import os
+import sys
+import time
+from typing import Optional
+
+import procrunner
+
+#
+#  benchmark() - runs a command repeatedly with procrunner.run() and reports
+#                statistics of its wall time, CPU time and memory usage:
+#
+#    - warmup runs before the measured runs
+#    - parameter sweeps, substituting {name} placeholders in the command
+#    - output is discarded in constant memory by default
+#    - mean, standard deviation, minimum, maximum and percentiles of the
+#      wall time, user and system CPU time and maximum resident set size
+#      as reported by wait4()
+#    - JSON export
+#
+#  Usage example:
+#
+# import procrunner
+# results = procrunner.benchmark(["gzip", "-{level}", "-k", "-f", "data"],
+#                                runs=20, parameters={"level": [1, 6, 9]})
+# for result in results:
+#     print(result.parameters, result.mean, result.stddev)
+#
+#  or from the command line:
+#
+# python -m procrunner bench --runs 20 --parameter level=1,6,9 -- gzip -{level} -k -f data
+
+logger = logging.getLogger("procrunner.benchmarking")
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Return a percentile of a list of values, interpolating linearly."""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * percent / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class BenchmarkResult:
+    """
+    The measurements of the runs of one command.
+
+    'times' holds the wall time of each run in seconds, 'user_times' and
+    'system_times' the CPU times, and 'max_rss' the maximum resident set size
+    in bytes. The resource usage lists are empty where wait4() is not
+    available. Runs for which no resource usage could be collected, eg.
+    because the process was stopped on timeout or reaped elsewhere, are
+    left out of these lists and counted in 'missing_rusage'.
+    """
+
+    percentiles = (50, 90, 95, 99)
+
+    def __init__(self, command, parameters: Optional[dict] = None):
+        self.command = command
+        self.parameters = parameters or {}
+        self.times: list[float] = []
+        self.user_times: list[float] = []
+        self.system_times: list[float] = []
+        self.max_rss: list[int] = []
+        self.returncodes: list[int] = []
+        self.missing_rusage = 0
+
+    @property
+    def mean(self) -> float:
+        return sum(self.times) / len(self.times)
+
+    @property
+    def stddev(self) -> float:
+        """The sample standard deviation of the wall time."""
+        if len(self.times) < 2:
+            return 0.0
+        mean = self.mean
+        return math.sqrt(
+            sum((t - mean) ** 2 for t in self.times) / (len(self.times) - 1)
+        )
+
+    @property
+    def min(self) -> float:
+        return min(self.times)
+
+    @property
+    def max(self) -> float:
+        return max(self.times)
+
+    def percentile(self, percent: float) -> float:
+        """Return a percentile of the wall time."""
+        return percentile(self.times, percent)
+
+    def to_dict(self) -> dict:
+        """Return the measurements and statistics as a JSON serialisable dict."""
+        summary = {
+            "command": " ".join(map(str, self.command)),
+            "parameters": self.parameters,
+            "mean": self.mean,
+            "stddev": self.stddev,
+            "min": self.min,
+            "max": self.max,
+            "percentiles": {
+                str(percent): self.percentile(percent) for percent in self.percentiles
+            },
+            "times": self.times,
+            "exit_codes": self.returncodes,
+        }
+        if self.user_times:
+            summary["user"] = sum(self.user_times) / len(self.user_times)
+            summary["system"] = sum(self.system_times) / len(self.system_times)
+            summary["max_rss"] = max(self.max_rss)
+            summary["user_times"] = self.user_times
+            summary["system_times"] = self.system_times
+            summary["max_rss_values"] = self.max_rss
+        if self.missing_rusage:
+            summary["missing_rusage"] = self.missing_rusage
+        return summary
+
+    def __repr__(self):
+        return (
+            f"<BenchmarkResult {self.command!r} {self.parameters!r}: "
+            f"{self.mean:.4f}s ± {self.stddev:.4f}s over {len(self.times)} runs>"
+        )
+
+
+def _substitute(command, parameters: dict) -> list:
+    """Replace {name} placeholders in the command arguments."""
+    substituted = []
+    for part in command:
+        part = os.fspath(part)
+        for name, value in parameters.items():
+            part = part.replace("{" + name + "}", str(value))
+        substituted.append(part)
+    return substituted
+
+
+def benchmark(
+    command,
+    *,
+    discard_output: bool = True,
+    export_json: Optional[str] = None,
+    ignore_failure: bool = False,
+    parameters: Optional[dict[str, list]] = None,
+    runs: int = 10,
+    warmup: int = 1,
+    **kwargs,
+) -> list[BenchmarkResult]:
+    """
+    Run a command repeatedly and measure its wall time, CPU time and memory
+    usage.
+
+    :param array command: Command line to be run, specified as array.
+                          Arguments may contain {name} placeholders for
+                          parameter sweeps.
+    :param boolean discard_output: Do not print or keep the process output
+                                   (default). Otherwise the output is printed
+                                   as usual.
+    :param export_json: Write the results to this file as JSON.
+    :param boolean ignore_failure: Continue if a run has a non-zero exit code.
+                                   By default a subprocess.CalledProcessError
+                                   is raised.
+    :param dict parameters: Benchmark the command for every combination of
+                            these parameter values, eg. {"threads": [1, 2, 4]}.
+    :param int runs: The number of measured runs.
+    :param int warmup: The number of runs before the measured runs.
+    :param kwargs: Any further arguments are passed to procrunner.run().
+    :return: A list of BenchmarkResult objects, one per parameter combination.
+    """
+    if runs < 1:
+        raise ValueError("At least one run is required")
+    if discard_output:
+        kwargs.setdefault("print_stdout", False)
+        kwargs.setdefault("print_stderr", False)
+        kwargs.setdefault("capture", "head_tail")
+        kwargs.setdefault("capture_head", 0)
+        kwargs.setdefault("capture_tail", 0)
+    resource_usage = hasattr(os, "wait4")
+    # ru_maxrss is given in kilobytes, except on macOS
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+
+    names = list(parameters or {})
+    combinations = itertools.product(*(parameters[name] for name in names))
+    results = []
+    for values in combinations:
+        result = BenchmarkResult(command, dict(zip(names, values)))
+        substituted = _substitute(command, result.parameters)
+        logger.debug("Benchmarking %s", substituted)
+        for n in range(warmup + runs):
+            start = time.perf_counter()
+            run = procrunner.run(substituted, resource_usage=resource_usage, **kwargs)
+            runtime = time.perf_counter() - start
+            if run.returncode and not ignore_failure:
+                run.check_returncode()
+            if n < warmup:
+                continue
+            result.times.append(runtime)
+            result.returncodes.append(run.returncode)
+            if resource_usage and getattr(run, "rusage", None) is None:
+                logger.debug("No resource usage recorded for run %d", n - warmup)
+                result.missing_rusage += 1
+            elif resource_usage:
+                result.user_times.append(run.rusage.ru_utime)
+                result.system_times.append(run.rusage.ru_stime)
+                result.max_rss.append(run.rusage.ru_maxrss * rss_unit)
+        results.append(result)
+
+    if export_json:
+        with open(export_json, "w") as fh:
+            json.dump({"results": [r.to_dict() for r in results]}, fh, indent=2)
+    return results
+
+
+def _format_time(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.1f} ms"
+    return f"{seconds:.3f} s"
+
+
+def format_result(result: BenchmarkResult) -> str:
+    """Return a human readable summary of a benchmark result."""
+    name = " ".join(map(str, _substitute(result.command, result.parameters)))
+    lines = [
+        f"Benchmark: {name}",
+        f"  Time (mean ± σ):  {_format_time(result.mean)} ± "
+        f"{_format_time(result.stddev)}",
+        f"  Range (min … max): {_format_time(result.min)} … "
+        f"{_format_time(result.max)}    {len(result.times)} runs",
+        "  Percentiles:        "
+        + ", ".join(
+            f"p{percent} {_format_time(result.percentile(percent))}"
+            for percent in result.percentiles
+        ),
+    ]
+    if result.user_times:
+        summary = result.to_dict()
+        lines.append(
+            f"  CPU (mean):         User: {_format_time(summary['user'])}, "
+            f"System: {_format_time(summary['system'])}"
+        )
+        lines.append(f"  Max RSS:            {summary['max_rss'] / 2**20:.1f} MiB")
+    if result.missing_rusage:
+        lines.append(
+            f"  No resource usage for {result.missing_rusage} of "
+            f"{len(result.times)} runs"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,340 @@
+from __future__ import annotations
+
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import procrunner
+
+#
+#  ResultCache - returns stored results for repeated deterministic commands
+#                instead of running them again:
+#
+#    - results are keyed on a hash of the command, the identity of the
+#      executable (path, modification time and size), selected environment
+#      variables, the working directory, stdin, and the run() arguments which
+#      determine how the output is captured, decoded and parsed
+#    - results are stored on local disk, one file per result
+#    - the least recently used results are evicted once the cache exceeds
+#      its size limit, results older than max_age are discarded
+#
+#  Usage example:
+#
+# from procrunner.cache import ResultCache
+# cache = ResultCache(max_size=100 * 2**20, max_age=7 * 86400)
+# result = cache.run(["dials.version"])
+# print(cache.hits, cache.misses, cache.evictions)
+
+logger = logging.getLogger("procrunner.cache")
+
+# run() arguments which change the result returned for the same output
+_output_arguments = (
+    "capture",
+    "capture_compression",
+    "capture_head",
+    "capture_tail",
+    "capture_unit",
+    "collapse_progress",
+    "encoding",
+    "errors",
+    "limits",
+    "line_delimiter",
+    "max_line_length",
+    "overlong_lines",
+    "parse_stderr",
+    "parse_stdout",
+    "pty",
+    "pty_size",
+)
+_output_defaults = {
+    name: parameter.default
+    for name, parameter in inspect.signature(procrunner.run).parameters.items()
+    if name in _output_arguments
+}
+
+# Result attributes which are stored with the output, where set
+_result_attributes = (
+    "encodings",
+    "limit_exceeded",
+    "stderr_omitted",
+    "stderr_records",
+    "stdout_omitted",
+    "stdout_records",
+)
+
+
+def _default_directory() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "procrunner")
+
+
+def _output_settings(kwargs) -> Optional[list]:
+    """
+    Return the values of the run() arguments that shape the result, or None
+    if they can not be reproduced from a stored result.
+    """
+    if kwargs.get("capture_index") or kwargs.get("resource_usage"):
+        return None
+    settings = []
+    for name in _output_arguments:
+        value = kwargs.get(name, _output_defaults[name])
+        if name.startswith("parse_") and not (value is None or isinstance(value, str)):
+            # records are collected in the parser object
+            return None
+        if isinstance(value, dict):
+            value = sorted(value.items())
+        if name == "line_delimiter" and isinstance(value, str) and value != "universal":
+            value = value.encode("utf-8")
+        settings.append((name, value))
+    return settings
+
+
+def _executable_identity(executable, path: Optional[str]) -> tuple:
+    """
+    Return the resolved path, modification time and size of an executable,
+    or just its name if it can not be found.
+    """
+    resolved = shutil.which(executable, path=path)
+    if resolved is None:
+        return (executable,)
+    resolved = os.path.realpath(resolved)
+    stat = os.stat(resolved)
+    return (resolved, stat.st_mtime_ns, stat.st_size)
+
+
+class ResultCache:
+    """
+    Runs commands with procrunner.run(), and stores their results on disk to
+    be returned for later calls with the same command, executable, selected
+    environment variables, working directory, stdin and output settings,
+    without starting a process.
+
+    Only use this for commands whose output is determined by these inputs.
+    A cached result is not printed, and callback functions are not called.
+    Results with a non-zero exit code are only stored if cache_failures is set.
+
+    The cache holds at most max_size bytes, evicting the least recently used
+    results first. Results stored more than max_age seconds ago are not
+    returned, and are removed however recently they were used.
+    The counters 'hits', 'misses' and 'evictions' accumulate over the lifetime
+    of the object.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        *,
+        cache_failures: bool = False,
+        environment_keys: tuple[str, ...] = ("PATH", "LANG", "LC_ALL"),
+        max_age: Optional[float] = None,
+        max_size: int = 2**30,
+    ):
+        self.directory = os.fspath(directory) if directory else _default_directory()
+        self.cache_failures = cache_failures
+        self.environment_keys = tuple(environment_keys)
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """The cache counters and the current size of the cache in bytes."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": sum(size for _, size, _, _ in self._entries()),
+        }
+
+    def key(self, command, **kwargs) -> Optional[str]:
+        """
+        Return the cache key for a run() call, or None if the call can not be
+        cached, eg. because stdin is read from a file, or because an output
+        index, resource usage or records in a parser object are requested.
+        """
+        stdin = kwargs.get("stdin")
+        if stdin is not None and stdin != subprocess.DEVNULL:
+            if not isinstance(stdin, bytes):
+                return None
+        settings = _output_settings(kwargs)
+        if settings is None:
+            return None
+        command = [os.fspath(part) for part in command]
+        environment = procrunner._process_environment(
+            kwargs.get("environment"), kwargs.get("environment_override")
+        )
+        working_directory = kwargs.get("working_directory")
+        if working_directory:
+            working_directory = os.path.abspath(os.fspath(working_directory))
+        else:
+            working_directory = os.getcwd()
+        digest = hashlib.sha256()
+        for part in (
+            command,
+            _executable_identity(command[0], environment.get("PATH")),
+            [(key, environment.get(key)) for key in self.environment_keys],
+            working_directory,
+            stdin,
+            settings,
+        ):
+            digest.update(repr(part).encode("utf-8", "surrogateescape"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def run(self, command, **kwargs) -> procrunner.CompletedProcess:
+        """
+        Return the stored result for a command, or run it with
+        procrunner.run() and store the result.
+
+        :param array command: Command line to be run, specified as array.
+        :param kwargs: Any further arguments are passed to procrunner.run().
+        :return: A procrunner.CompletedProcess object, or a
+                 CompressedCompletedProcess object if capture_compression is
+                 set. Stored results have the attribute 'cached' set.
+        """
+        key = self.key(command, **kwargs)
+        if key is not None:
+            result = self._load(key)
+            if result is not None:
+                with self._lock:
+                    self.hits += 1
+                logger.debug("Returning cached result for %s", command)
+                return result
+        with self._lock:
+            self.misses += 1
+        result = procrunner.run(command, **kwargs)
+        if key is not None and (result.returncode == 0 or self.cache_failures):
+            self._store(key, result)
+        return result
+
+    def clear(self) -> None:
+        """Remove all stored results."""
+        for path, _, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".result")
+
+    def _load(self, key: str) -> Optional[procrunner.CompletedProcess]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                entry = pickle.load(fh)
+                modified = os.fstat(fh.fileno()).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Discarding unreadable cache entry %s: %s", path, e)
+            self._remove(path)
+            return None
+        if self.max_age is not None and time.time() - entry["created"] > self.max_age:
+            self._remove(path)
+            return None
+        try:
+            # record the access for least recently used eviction, keeping the
+            # modification time as the time the result was stored
+            os.utime(path, ns=(time.time_ns(), modified))
+        except FileNotFoundError:
+            pass
+        if "compression" in entry:
+            result = procrunner.CompressedCompletedProcess(
+                args=entry["args"],
+                returncode=entry["returncode"],
+                stdout_compressed=entry["stdout_compressed"],
+                stderr_compressed=entry["stderr_compressed"],
+                compression=entry["compression"],
+            )
+        else:
+            result = procrunner.CompletedProcess(
+                args=entry["args"],
+                returncode=entry["returncode"],
+                stdout=entry["stdout"],
+                stderr=entry["stderr"],
+            )
+        for name, value in entry.get("attributes", {}).items():
+            setattr(result, name, value)
+        result.cached = True
+        return result
+
+    def _store(self, key: str, result: procrunner.CompletedProcess) -> None:
+        entry = {
+            "args": result.args,
+            "returncode": result.returncode,
+            "created": time.time(),
+            "attributes": {
+                name: vars(result)[name]
+                for name in _result_attributes
+                if name in vars(result)
+            },
+        }
+        if isinstance(result, procrunner.CompressedCompletedProcess):
+            entry["compression"] = result.compression
+            entry["stdout_compressed"] = result.stdout_compressed
+            entry["stderr_compressed"] = result.stderr_compressed
+        else:
+            entry["stdout"] = result.stdout
+            entry["stderr"] = result.stderr
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                pickle.dump(entry, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self._evict()
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self.evictions += 1
+
+    def _entries(self) -> list[tuple[str, int, float, float]]:
+        """
+        Return path, size, last access time and creation time of all stored
+        results. Results are written once, so their modification time is the
+        time they were stored.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".result"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_atime, stat.st_mtime))
+        return entries
+
+    def _evict(self) -> None:
+        """Remove expired and least recently used results over the size limit."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _, _ in entries)
+        now = time.time()
+        for path, size, _, created in entries:
+            expired = self.max_age is not None and now - created > self.max_age
+            if total <= self.max_size and not expired:
+                continue
+            self._remove(path)
+            total -= size
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import atexit
+import collections
+import json
+import logging
+import os
+import threading
+from typing import Iterable, Optional
+
+import procrunner
+from procrunner.benchmarking import percentile
+
+#
+#  An append-only journal of all processes run by procrunner, to find out
+#  where the time goes across many workers:
+#
+#    - enable() records every process started through procrunner.run() or
+#      procrunner.start() in a JSON lines file, one entry per process with
+#      the command, executable, working directory, start and end timestamps,
+#      runtime, exit code, timeout and kill status, bytes per output stream
+#      and, where wait4() is available, CPU time and maximum resident set size
+#    - entries are written in batches by a background thread, so finishing a
+#      process never waits for the disk
+#    - load(), slowest(), and summarize() help to analyse the journal files
+#
+#  Usage example:
+#
+# from procrunner import journal
+# journal.enable("/var/log/worker/procrunner.jsonl")
+# ...
+# entries = journal.load("/var/log/worker/procrunner.jsonl")
+# for executable, summary in journal.summarize(entries).items():
+#     print(executable, summary["count"], summary["p95"], summary["timeout_rate"])
+#
+#  or from the command line:
+#
+# python -m procrunner journal /var/log/worker/procrunner.jsonl
+
+logger = logging.getLogger("procrunner.journal")
+
+
+class Journal:
+    """
+    Appends entries to a JSON lines file from a background thread.
+
+    record() never blocks. Entries are written at least every flush_interval
+    seconds, or as soon as batch_size entries are waiting. If more than
+    max_queue entries are waiting, or the journal is closed, further entries
+    are dropped and counted in 'dropped'.
+
+    While the journal is enabled, the resource usage of every process is
+    collected for its entry, unless resource_usage is False.
+    """
+
+    def __init__(
+        self,
+        path,
+        *,
+        flush_interval: float = 1.0,
+        batch_size: int = 100,
+        max_queue: int = 100000,
+        resource_usage: bool = True,
+    ):
+        self.path = os.fspath(path)
+        self.resource_usage = resource_usage
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue: collections.deque = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(
+            target=self._write_batches, name="procrunner journal", daemon=True
+        )
+        self._writer.start()
+
+    def record(self, entry: dict) -> None:
+        """Queue an entry for writing."""
+        with self._condition:
+            if self._closed or len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._queue.append(entry)
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify()
+
+    def _write_batches(self) -> None:
+        while True:
+            with self._condition:
+                if not self._closed and len(self._queue) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                batch = list(self._queue)
+                self._queue.clear()
+                closed = self._closed
+            if batch:
+                self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch: list[dict]) -> None:
+        data = "".join(
+            json.dumps(entry, separators=(",", ":")) + "\n" for entry in batch
+        )
+        try:
+            # a single write per batch, so that concurrent writers using the
+            # same file do not interleave within lines
+            with open(self.path, "a") as fh:
+                fh.write(data)
+        except OSError as e:
+            logger.warning(
+                "Could not write %d entries to journal %s: %s", len(batch), self.path, e
+            )
+            self.dropped += len(batch)
+
+    def close(self) -> None:
+        """Write all queued entries and stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._writer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def enable(path, **kwargs) -> Journal:
+    """
+    Record all processes run by procrunner in a journal file.
+
+    A journal enabled earlier is closed first. The journal is closed when
+    the interpreter exits, or by calling disable().
+
+    Unless resource_usage=False is given, processes are run with
+    resource_usage set where wait4() is available, so that their CPU time and
+    memory use are recorded, and their results carry 'rusage'.
+
+    :param path: The JSON lines file entries are appended to.
+    :param kwargs: Any further arguments are passed to Journal().
+    :return: The Journal object.
+    """
+    disable()
+    procrunner._journal = Journal(path, **kwargs)
+    atexit.register(procrunner._journal.close)
+    return procrunner._journal
+
+
+def disable() -> None:
+    """Stop recording processes, and write any queued entries."""
+    journal, procrunner._journal = procrunner._journal, None
+    if journal is not None:
+        atexit.unregister(journal.close)
+        journal.close()
+
+
+def load(*paths) -> list[dict]:
+    """
+    Read the entries from one or more journal files.
+
+    Incomplete lines, eg. from a worker that was killed while writing, are
+    skipped.
+    """
+    entries = []
+    for path in paths:
+        with open(path) as fh:
+            for line in fh:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.debug("Skipping invalid line in journal %s", path)
+    return entries
+
+
+def slowest(entries: Iterable[dict], n: int = 10) -> list[dict]:
+    """Return the n entries with the longest runtime, slowest first."""
+    return sorted(entries, key=lambda entry: entry["runtime"], reverse=True)[:n]
+
+
+def _by_executable(entries: Iterable[dict]) -> dict[str, list[dict]]:
+    grouped = collections.defaultdict(list)
+    for entry in entries:
+        grouped[entry["executable"] or entry["command"][0]].append(entry)
+    return grouped
+
+
+def summarize(entries: Iterable[dict]) -> dict[str, dict]:
+    """
+    Summarize journal entries per executable.
+
+    :return: A dictionary mapping each executable to a dictionary with the
+             number of runs ('count'), total, median and 95th percentile
+             runtime in seconds ('total', 'p50', 'p95'), the fraction of
+             runs that timed out ('timeout_rate'), and the total CPU time
+             in seconds ('cpu', where recorded), ordered by total runtime.
+    """
+    summaries = {}
+    for executable, runs in _by_executable(entries).items():
+        runtimes = [entry["runtime"] for entry in runs]
+        summary = {
+            "count": len(runs),
+            "total": sum(runtimes),
+            "p50": percentile(runtimes, 50),
+            "p95": percentile(runtimes, 95),
+            "timeout_rate": sum(1 for entry in runs if entry["timeout"]) / len(runs),
+        }
+        if any("user_time" in entry for entry in runs):
+            summary["cpu"] = sum(
+                entry.get("user_time", 0) + entry.get("system_time", 0)
+                for entry in runs
+            )
+        summaries[executable] = summary
+    return dict(
+        sorted(summaries.items(), key=lambda item: item[1]["total"], reverse=True)
+    )
+
+
+def format_summary(summaries: dict[str, dict], limit: Optional[int] = None) -> str:
+    """Return a human readable table of the output of summarize()."""
+    lines = [
+        f"{'runs':>7} {'total':>10} {'p50':>9} {'p95':>9} {'timeouts':>8}  executable"
+    ]
+    for executable, summary in list(summaries.items())[:limit]:
+        lines.append(
+            f"{summary['count']:>7} {summary['total']:>9.1f}s "
+            f"{summary['p50']:>8.3f}s {summary['p95']:>8.3f}s "
+            f"{summary['timeout_rate']:>8.1%}  {executable}"
+        )
+    return "\n".join(lines)
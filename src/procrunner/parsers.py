@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import abc
+import csv
+import json
+import re
+from typing import Any, Callable, Optional, Union
+
+#
+#  Streaming parsers for structured process output. A parser is passed to
+#  procrunner.run() as 'parse_stdout' or 'parse_stderr', and is fed the
+#  complete lines of the stream as byte strings while the process runs:
+#
+#    - "json": JSON lines, one JSON document per line
+#    - "keyvalue": lines of key=value pairs, eg. 'step=3 loss=0.25 msg="ok"'
+#    - "csv": comma separated values, with the first line as header
+#
+#  Each line is parsed once, directly from the bytes read, and decoded with
+#  the encoding and error handler of the stream it was read from. The records
+#  are passed to a callback function, or collected and attached to the result
+#  as 'stdout_records' and 'stderr_records'. Empty lines and lines that can
+#  not be parsed are skipped, and counted in 'invalid_lines'.
+#
+#  Usage example:
+#
+# result = procrunner.run(["tool", "--json"], parse_stdout="json", capture="none")
+# for record in result.stdout_records:
+#     ...
+
+
+class RecordParser(abc.ABC):
+    """
+    Base class of the streaming record parsers. Subclasses implement
+    parse_line(), which returns the record for a line given as byte string
+    or raises ValueError. Text is decoded with 'encoding' and 'errors', which
+    are set to those of the stream the parser is attached to.
+
+    :param callback: Optional function which is called with each record.
+    :param boolean collect: Keep the records in the 'records' list.
+    """
+
+    def __init__(self, callback: Optional[Callable] = None, collect: bool = True):
+        self.callback = callback
+        self.records: Optional[list] = [] if collect else None
+        self.invalid_lines = 0
+        self.encoding = "utf-8"
+        self.errors = "replace"
+
+    def attach(self, encoding: Optional[str], errors: str) -> None:
+        """
+        Decode lines with the encoding and error handler of a stream. Output
+        read in binary mode, with encoding None, is decoded as UTF-8.
+        """
+        self.encoding = encoding or "utf-8"
+        self.errors = errors
+
+    @abc.abstractmethod
+    def parse_line(self, line: bytes) -> Any:
+        """Return the record for a line, or raise ValueError."""
+
+    def parse(self, lines: list[bytes]) -> list:
+        """Return the records of a list of non-empty lines."""
+        records = []
+        for line in lines:
+            try:
+                records.append(self.parse_line(line))
+            except ValueError:
+                self.invalid_lines += 1
+        return records
+
+    def feed(self, lines: list[bytes]) -> None:
+        """Parse a list of lines and pass on the records."""
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return
+        records = self.parse(lines)
+        if self.records is not None:
+            self.records.extend(records)
+        if self.callback:
+            for record in records:
+                self.callback(record)
+
+
+class JSONLinesParser(RecordParser):
+    """Parses lines holding one JSON document each."""
+
+    def parse_line(self, line: bytes) -> Any:
+        if self.encoding == "utf-8":
+            # the JSON decoder reads UTF-8 byte strings directly
+            return json.loads(line)
+        return json.loads(line.decode(self.encoding, self.errors))
+
+
+_key_value_pair = re.compile(rb'([^\s=]+)=("(?:[^"\\]|\\.)*"|\S*)')
+_escaped_character = re.compile(r"\\(.)")
+
+
+class KeyValueParser(RecordParser):
+    """
+    Parses lines of whitespace separated key=value pairs into dictionaries
+    of strings. Values may be enclosed in double quotes, with backslash
+    escapes. Lines without any key=value pair are not valid.
+    """
+
+    def parse_line(self, line: bytes) -> dict[str, str]:
+        pairs = _key_value_pair.findall(line)
+        if not pairs:
+            raise ValueError(f"No key=value pairs found in {line!r}")
+        record = {}
+        for key, value in pairs:
+            value = value.decode(self.encoding, self.errors)
+            if value[:1] == '"':
+                value = _escaped_character.sub(r"\1", value[1:-1])
+            record[key.decode(self.encoding, self.errors)] = value
+        return record
+
+
+class CSVParser(RecordParser):
+    """
+    Parses lines of comma separated values. With header set, the first line
+    holds the field names and records are dictionaries, otherwise records
+    are lists of strings. Quoted values can not span several lines.
+
+    :param boolean header: Read the field names from the first line.
+    :param delimiter: The field separator.
+    """
+
+    def __init__(
+        self,
+        callback: Optional[Callable] = None,
+        collect: bool = True,
+        *,
+        header: bool = True,
+        delimiter: str = ",",
+    ):
+        super().__init__(callback=callback, collect=collect)
+        self.delimiter = delimiter
+        self.fieldnames: Optional[list[str]] = None
+        self._header = header
+
+    def _record(self, row: list[str]) -> Any:
+        if not self._header:
+            return row
+        if self.fieldnames is None:
+            raise ValueError("No header line has been read")
+        if len(row) != len(self.fieldnames):
+            raise ValueError(f"Expected {len(self.fieldnames)} fields, not {len(row)}")
+        return dict(zip(self.fieldnames, row))
+
+    def parse_line(self, line: bytes) -> Any:
+        (row,) = csv.reader(
+            [line.decode(self.encoding, self.errors)], delimiter=self.delimiter
+        )
+        return self._record(row)
+
+    def parse(self, lines: list[bytes]) -> list:
+        # a single reader for all lines read at once
+        rows = csv.reader(
+            (line.decode(self.encoding, self.errors) for line in lines),
+            delimiter=self.delimiter,
+        )
+        if not self._header:
+            return list(rows)
+        records = []
+        for row in rows:
+            if self.fieldnames is None:
+                self.fieldnames = row
+                continue
+            try:
+                records.append(self._record(row))
+            except ValueError:
+                self.invalid_lines += 1
+        return records
+
+
+formats = {"json": JSONLinesParser, "keyvalue": KeyValueParser, "csv": CSVParser}
+
+
+def create(
+    parser: Union[str, RecordParser], callback: Optional[Callable] = None
+) -> RecordParser:
+    """
+    Return a parser for a format name, or a parser object as is. Records
+    are collected by parsers created here unless a callback is given.
+
+    :param parser: A name from 'formats', or a RecordParser object.
+    :param callback: Optional function which is called with each record.
+    """
+    if isinstance(parser, RecordParser):
+        if callback:
+            raise ValueError("Set the callback function on the parser object")
+        return parser
+    if parser not in formats:
+        raise ValueError(f"Unknown record format {parser!r}")
+    return formats[parser](callback=callback, collect=callback is None)
@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import os
+import threading
+import timeit
+from typing import Optional
+
+import procrunner
+
+#
+#  Scheduler - runs batches of commands with procrunner.run(), admitting new
+#              processes based on the current load of the machine:
+#
+#    - the number of runnable processes, from /proc/loadavg
+#    - the available memory, from /proc/meminfo
+#    - the declared CPU and memory weight of each job
+#    - job priorities, with higher priority jobs being started first
+#    - suspending running jobs to make room for more important work, and
+#      resuming them later without losing the work they have done
+#
+#  Usage example:
+#
+# from procrunner.scheduler import Scheduler
+# with Scheduler() as scheduler:
+#     futures = [scheduler.submit(command, cpu=1, memory=2**30) for command in commands]
+# results = [future.result() for future in futures]
+
+logger = logging.getLogger("procrunner.scheduler")
+
+
+def _runnable_processes() -> Optional[int]:
+    """
+    Return the number of currently runnable processes/threads on the system,
+    or None if this can not be determined.
+    """
+    try:
+        with open("/proc/loadavg") as fh:
+            return int(fh.read().split()[3].split("/")[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _available_memory() -> Optional[int]:
+    """
+    Return the memory available for starting new processes in bytes, or None
+    if this can not be determined.
+    """
+    try:
+        with open("/proc/meminfo") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+class _Job:
+    """A command waiting to be run, and the future for its result."""
+
+    def __init__(self, command, cpu, memory, priority, kwargs):
+        self.command = command
+        self.cpu = cpu
+        self.memory = memory
+        self.priority = priority
+        self.kwargs = kwargs
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.started: Optional[float] = None
+        self.handle: Optional[procrunner.ProcessHandle] = None
+
+
+class Scheduler:
+    """
+    Runs commands with procrunner.start() concurrently, starting new processes
+    only while the machine has capacity for them.
+
+    A job is started when the number of runnable processes on the system plus
+    the declared CPU weight of the job does not exceed cpu_capacity, and the
+    available memory minus memory_reserve covers the declared memory of the
+    job. Jobs started within the last settle_time seconds are accounted for
+    by their declared weights, as their load does not show up in the system
+    measurements straight away. Where the measurements are not available the
+    declared weights of all running jobs are used instead.
+
+    Regardless of load at least min_parallel and at most max_parallel jobs
+    are run at the same time. Jobs stopped with suspend() do not count
+    towards the CPU load.
+    """
+
+    def __init__(
+        self,
+        *,
+        cpu_capacity: Optional[float] = None,
+        max_parallel: Optional[int] = None,
+        memory_reserve: int = 0,
+        min_parallel: int = 1,
+        poll_interval: float = 0.5,
+        settle_time: float = 2,
+    ):
+        if cpu_capacity is None:
+            if hasattr(os, "sched_getaffinity"):
+                cpu_capacity = len(os.sched_getaffinity(0))
+            else:
+                cpu_capacity = os.cpu_count() or 1
+        self.cpu_capacity = cpu_capacity
+        self.max_parallel = max_parallel or 4 * cpu_capacity
+        self.memory_reserve = memory_reserve
+        self.min_parallel = min_parallel
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self._condition = threading.Condition()
+        self._pending: list = []
+        self._running: set = set()
+        self._suspended: set = set()
+        self._sequence = itertools.count()
+        self._shutdown = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        """The number of jobs waiting to be started."""
+        return len(self._pending)
+
+    @property
+    def running(self) -> int:
+        """The number of jobs currently running, including suspended jobs."""
+        return len(self._running)
+
+    @property
+    def suspended(self) -> int:
+        """The number of jobs currently suspended."""
+        with self._condition:
+            self._forget_continued()
+            return len(self._suspended)
+
+    def submit(
+        self,
+        command,
+        *,
+        cpu: float = 1,
+        memory: int = 0,
+        priority: int = 0,
+        **kwargs,
+    ) -> concurrent.futures.Future:
+        """
+        Queue a command to be run.
+
+        :param array command: Command line to be run, specified as array.
+        :param cpu: The number of CPU cores the command is expected to keep busy.
+        :param memory: The amount of memory the command is expected to use,
+                       in bytes.
+        :param priority: Jobs with a higher priority are started first.
+        :param kwargs: Any further arguments are passed to procrunner.start().
+        :return: A concurrent.futures.Future object for the result of
+                 procrunner.run().
+        """
+        job = _Job(command, cpu, memory, priority, kwargs)
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Can not submit jobs after shutdown")
+            heapq.heappush(self._pending, (-priority, next(self._sequence), job))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._schedule)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+        return job.future
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop accepting new jobs. Jobs already submitted are still run.
+        If wait is set then block until all jobs have finished.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+            thread = self._thread
+        if wait and thread:
+            thread.join()
+
+    def suspend(self, below_priority: Optional[int] = None) -> int:
+        """
+        Suspend running jobs, eg. to make room for a more important job.
+        Suspended jobs keep their memory, but their timeouts are paused and
+        they do not count towards the CPU load, so that other jobs can be
+        started in their place. Not supported on Windows.
+
+        :param below_priority: Only suspend jobs with a lower priority.
+        :return: The number of jobs suspended.
+        """
+        with self._condition:
+            jobs = [
+                job
+                for job in self._running
+                if job.handle is not None
+                and job not in self._suspended
+                and (below_priority is None or job.priority < below_priority)
+            ]
+            for job in jobs:
+                job.handle.suspend()
+                self._suspended.add(job)
+            self._condition.notify_all()
+        return len(jobs)
+
+    def resume(self) -> int:
+        """
+        Continue all jobs stopped by suspend().
+
+        :return: The number of jobs resumed.
+        """
+        with self._condition:
+            self._forget_continued()
+            jobs = list(self._suspended)
+            for job in jobs:
+                job.handle.resume()
+            self._suspended.clear()
+        return len(jobs)
+
+    def _forget_continued(self) -> None:
+        """Stop tracking jobs whose processes were killed or have ended."""
+        self._suspended = {job for job in self._suspended if job.handle.suspended}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown(wait=True)
+
+    def _admissible(self, job) -> bool:
+        """Check whether there is capacity to start a job now."""
+        if len(self._running) < self.min_parallel:
+            return True
+        if len(self._running) >= self.max_parallel:
+            return False
+        self._forget_continued()
+        now = timeit.default_timer()
+        settling = [
+            running
+            for running in self._running
+            if now - running.started < self.settle_time
+        ]
+        runnable = _runnable_processes()
+        if runnable is None:
+            cpu_load = sum(
+                running.cpu
+                for running in self._running
+                if running not in self._suspended
+            )
+        else:
+            # do not count the scheduling process itself
+            cpu_load = max(0, runnable - 1) + sum(
+                running.cpu for running in settling if running not in self._suspended
+            )
+        if cpu_load + job.cpu > self.cpu_capacity:
+            return False
+        if job.memory:
+            available = _available_memory()
+            if available is None:
+                return True
+            committed = sum(running.memory for running in settling)
+            if available - self.memory_reserve - committed < job.memory:
+                return False
+        return True
+
+    def _schedule(self):
+        with self._condition:
+            while self._pending or self._running or not self._shutdown:
+                if self._pending and self._admissible(self._pending[0][2]):
+                    job = heapq.heappop(self._pending)[2]
+                    if job.future.set_running_or_notify_cancel():
+                        job.started = timeit.default_timer()
+                        self._running.add(job)
+                        logger.debug(
+                            "Starting job %s with %d jobs running, %d pending",
+                            job.command,
+                            len(self._running) - 1,
+                            len(self._pending),
+                        )
+                        thread = threading.Thread(target=self._run, args=(job,))
+                        thread.daemon = True
+                        thread.start()
+                    continue
+                # Wait for a job to finish, a new job, or for the load to change
+                self._condition.wait(self.poll_interval if self._pending else None)
+
+    def _run(self, job):
+        try:
+            job.handle = procrunner.start(job.command, **job.kwargs)
+            result = job.handle.result()
+        except BaseException as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+        finally:
+            with self._condition:
+                self._running.discard(job)
+                self._suspended.discard(job)
+                self._condition.notify_all()
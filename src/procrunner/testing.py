@@ -0,0 +1,371 @@
+from __future__ import annotations
+
+import base64
+import inspect
+import io
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import procrunner
+from procrunner import parsers
+
+#
+#  Record and replay procrunner.run() calls, so that test suites can run
+#  without starting the real processes:
+#
+#    - record() runs the real processes and stores the command, selected
+#      environment variables, stdin, the output in the order and with the
+#      timing it was received, and the exit code in a JSON fixture file
+#    - replay() answers procrunner.run() calls from the fixture file without
+#      starting a process. Output is printed and passed to the callback
+#      functions as it would be for a real process, immediately or at the
+#      original or an accelerated speed
+#    - calls that do not match a recorded run raise UnmatchedCommandError, as
+#      do procrunner.start() and procrunner.pipeline() calls, including those
+#      made by a procrunner.scheduler.Scheduler, which can not be replayed
+#
+#  Usage example:
+#
+# from procrunner import testing
+# with testing.record("tests/fixtures/tools.json"):
+#     function_under_test()
+# ...
+# with testing.replay("tests/fixtures/tools.json"):
+#     function_under_test()
+
+logger = logging.getLogger("procrunner.testing")
+
+_fixture_version = 1
+
+
+class UnmatchedCommandError(AssertionError):
+    """
+    A procrunner.run() call during replay did not match any recorded run, or
+    a process was started in a way that can not be replayed.
+    """
+
+
+def _encode(data: Optional[bytes]) -> Optional[str]:
+    return None if data is None else base64.b64encode(data).decode("ascii")
+
+
+def _decode(data: Optional[str]) -> Optional[bytes]:
+    return None if data is None else base64.b64decode(data)
+
+
+def _match_key(command, stdin, environment: dict) -> str:
+    """Return the parts of a run() call that identify a recorded run."""
+    return json.dumps(
+        [[os.fspath(part) for part in command], _encode(stdin), environment],
+        sort_keys=True,
+    )
+
+
+def _selected_environment(kwargs: dict, environment_keys) -> dict:
+    environment = procrunner._process_environment(
+        kwargs.get("environment"), kwargs.get("environment_override")
+    )
+    return {key: environment.get(key) for key in environment_keys}
+
+
+class _Patch:
+    """Replaces procrunner.run() while used as context manager."""
+
+    def __init__(self):
+        self._original_run = None
+
+    def __enter__(self):
+        self._original_run = procrunner.run
+        procrunner.run = self._run
+        return self
+
+    def __exit__(self, *args):
+        procrunner.run = self._original_run
+
+    def _run(self, command, **kwargs):
+        raise NotImplementedError
+
+
+class Recorder(_Patch):
+    """
+    Runs processes through procrunner.run() and records them to a fixture
+    file, which is written when the context manager exits. Existing runs in
+    the file are kept.
+    """
+
+    def __init__(self, path, environment_keys: tuple[str, ...] = ()):
+        super().__init__()
+        self.path = os.fspath(path)
+        self.environment_keys = tuple(environment_keys)
+        self.runs: list[dict] = []
+        self._lock = threading.Lock()
+        self._observers = threading.local()
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                self.runs = json.load(fh)["runs"]
+
+    def __enter__(self):
+        procrunner._output_observer = self._observe
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        procrunner._output_observer = None
+        with open(self.path, "w") as fh:
+            json.dump({"version": _fixture_version, "runs": self.runs}, fh, indent=1)
+
+    def _observe(self):
+        """
+        Return the record functions for the process started by a run() call
+        being recorded in this thread, if any.
+        """
+        observers = getattr(self._observers, "pending", None)
+        self._observers.pending = None
+        return observers
+
+    def _run(self, command, **kwargs):
+        stdin = kwargs.get("stdin")
+        if stdin is not None and not isinstance(stdin, bytes):
+            raise ValueError("Only runs with stdin given as bytes can be recorded")
+        # the output is recorded as read, whatever is captured in the result
+        output = []
+        start = time.monotonic()
+
+        def observer(stream):
+            def record(offset, data):
+                output.append([time.monotonic() - start, stream, _encode(data)])
+
+            return record
+
+        self._observers.pending = (observer("stdout"), observer("stderr"))
+        try:
+            result = self._original_run(command, **kwargs)
+        finally:
+            self._observers.pending = None
+        run = {
+            "command": [os.fspath(part) for part in command],
+            "environment": _selected_environment(kwargs, self.environment_keys),
+            "stdin": _encode(stdin),
+            "output": sorted(output, key=lambda chunk: chunk[0]),
+            "returncode": result.returncode,
+        }
+        with self._lock:
+            self.runs = [
+                recorded
+                for recorded in self.runs
+                if _match_key(
+                    recorded["command"],
+                    _decode(recorded["stdin"]),
+                    recorded["environment"],
+                )
+                != _match_key(command, stdin, run["environment"])
+            ]
+            self.runs.append(run)
+        return result
+
+
+class Replayer(_Patch):
+    """
+    Answers procrunner.run() calls from a fixture file without starting
+    processes. Output is replayed immediately if speed is None, otherwise
+    with the recorded timing divided by speed. The commands replayed are
+    listed in 'calls'. procrunner.start() and procrunner.pipeline() raise
+    UnmatchedCommandError while replaying.
+    """
+
+    def __init__(
+        self,
+        path,
+        environment_keys: tuple[str, ...] = (),
+        speed: Optional[float] = None,
+    ):
+        super().__init__()
+        self.path = os.fspath(path)
+        self.environment_keys = tuple(environment_keys)
+        self.speed = speed
+        self.calls: list[list[str]] = []
+        with open(self.path) as fh:
+            fixture = json.load(fh)
+        self._runs = {}
+        for run in fixture["runs"]:
+            key = _match_key(run["command"], _decode(run["stdin"]), run["environment"])
+            self._runs[key] = run
+        self._original_start = None
+        self._original_pipeline = None
+
+    def __enter__(self):
+        self._original_start = procrunner.start
+        self._original_pipeline = procrunner.pipeline
+        procrunner.start = self._unsupported("start")
+        procrunner.pipeline = self._unsupported("pipeline")
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        procrunner.start = self._original_start
+        procrunner.pipeline = self._original_pipeline
+
+    @staticmethod
+    def _unsupported(name: str):
+        def replace(*commands, **kwargs):
+            raise UnmatchedCommandError(
+                f"Can not replay procrunner.{name}() calls, only procrunner.run() "
+                f"calls are recorded: {commands!r}"
+            )
+
+        return replace
+
+    def _run(self, command, **kwargs):
+        arguments = inspect.signature(self._original_run).bind(command, **kwargs)
+        arguments.apply_defaults()
+        options = arguments.arguments
+        if options["stdin"] is not None and not isinstance(options["stdin"], bytes):
+            raise UnmatchedCommandError(
+                f"Can not replay {command!r}: stdin must be given as bytes"
+            )
+        environment = _selected_environment(options, self.environment_keys)
+        run = self._runs.get(_match_key(command, options["stdin"], environment))
+        if run is None:
+            recorded = "\n".join(
+                f"  {run['command']!r} with environment {run['environment']!r}"
+                for run in self._runs.values()
+            )
+            raise UnmatchedCommandError(
+                f"No recorded run matches {command!r} with stdin "
+                f"{options['stdin']!r} and environment {environment!r}.\n"
+                f"Recorded runs in {self.path}:\n{recorded}"
+            )
+        self.calls.append([os.fspath(part) for part in command])
+        logger.debug("Replaying recorded run of %s", command)
+
+        encodings = dict(
+            zip(
+                ("stdout", "stderr"),
+                procrunner._stream_encodings(options["encoding"], options["errors"]),
+            )
+        )
+        aggregators = {}
+        record_parsers = {}
+        for stream in ("stdout", "stderr"):
+            encoding, errors = encodings[stream]
+            if options[f"parse_{stream}"] is not None:
+                record_parsers[stream] = parsers.create(
+                    options[f"parse_{stream}"], options[f"callback_{stream}_records"]
+                )
+            aggregators[stream] = procrunner._LineAggregator(
+                print_line=(
+                    procrunner._ConsoleWriter(stream, encoding)
+                    if options[f"print_{stream}"]
+                    else None
+                ),
+                callback=options[f"callback_{stream}"],
+                callback_bytes=options[f"callback_{stream}_bytes"],
+                callback_batch=options[f"callback_{stream}_batch"],
+                batch_type=options["callback_batch_type"],
+                delimiter=options["line_delimiter"],
+                collapse_progress=options["collapse_progress"],
+                max_line_length=options["max_line_length"],
+                overlong_lines=options["overlong_lines"],
+                parser=record_parsers.get(stream),
+                encoding=encoding,
+                errors=errors,
+            )
+        buffers = dict(
+            zip(
+                ("stdout", "stderr"),
+                procrunner._capture_buffers(
+                    options["capture"],
+                    options["capture_compression"],
+                    options["capture_head"],
+                    options["capture_tail"],
+                    options["capture_unit"],
+                    options["capture_index"],
+                    options["max_line_length"],
+                ),
+            )
+        )
+        for stream, buffer in buffers.items():
+            if buffer is None:
+                buffers[stream] = io.BytesIO()
+        output_index = (
+            procrunner.OutputIndex(options["capture_index"])
+            if options["capture_index"]
+            else None
+        )
+        start = time.monotonic()
+        for timestamp, stream, data in run["output"]:
+            if self.speed:
+                delay = start + timestamp / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            data = _decode(data)
+            if output_index is not None:
+                output_index.record(
+                    output_index.streams.index(stream), buffers[stream].tell(), data
+                )
+            buffers[stream].write(data)
+            aggregators[stream].add(data)
+        for aggregator in aggregators.values():
+            aggregator.flush()
+
+        args = tuple(os.fspath(part) for part in command)
+        stdout = buffers["stdout"].getvalue()
+        stderr = buffers["stderr"].getvalue()
+        if options["capture_compression"]:
+            result = procrunner.CompressedCompletedProcess(
+                args=args,
+                returncode=run["returncode"],
+                stdout_compressed=stdout,
+                stderr_compressed=stderr,
+                compression=options["capture_compression"],
+            )
+        else:
+            result = procrunner.CompletedProcess(
+                args=args, returncode=run["returncode"], stdout=stdout, stderr=stderr
+            )
+        if output_index is not None:
+            output_index.attach(stdout, stderr)
+            result.output_index = output_index
+        if options["capture"] != "all":
+            result.stdout_omitted = buffers["stdout"].omitted
+            result.stderr_omitted = buffers["stderr"].omitted
+        result.encodings = encodings
+        for stream, parser in record_parsers.items():
+            if parser.records is not None:
+                setattr(result, f"{stream}_records", parser.records)
+        result.replayed = True
+        return result
+
+
+def record(path, environment_keys: tuple[str, ...] = ()) -> Recorder:
+    """
+    Record the procrunner.run() calls made within a 'with' block.
+
+    :param path: The JSON fixture file to write.
+    :param environment_keys: Names of environment variables whose values are
+                             recorded, and must match during replay.
+    """
+    return Recorder(path, environment_keys=environment_keys)
+
+
+def replay(
+    path, environment_keys: tuple[str, ...] = (), speed: Optional[float] = None
+) -> Replayer:
+    """
+    Answer the procrunner.run() calls made within a 'with' block from a
+    fixture file, without starting any processes.
+
+    :param path: The JSON fixture file written by record().
+    :param environment_keys: Names of environment variables which must match
+                             the recorded values.
+    :param speed: Replay the output with the recorded timing, sped up by this
+                  factor (1 for the original speed). By default all output
+                  is replayed immediately.
+    :raises UnmatchedCommandError: for calls not matching a recorded run, and
+                                   for procrunner.start() and pipeline() calls.
+    """
+    return Replayer(path, environment_keys=environment_keys, speed=speed)
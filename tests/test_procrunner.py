@@ -3,7 +3,9 @@ from __future__ import annotations
 import copy
 import os
 import pathlib
+import re
 import sys
+import zlib
 from unittest import mock
 
 import pytest
@@ -14,11 +16,10 @@ import procrunner
 @mock.patch("procrunner._NonBlockingStreamReader")
 @mock.patch("procrunner.time")
 @mock.patch("procrunner.subprocess")
-@mock.patch("procrunner.Pipe")
+@mock.patch("procrunner._Notification")
 def test_run_command_aborts_after_timeout_legacy(
-    mock_pipe, mock_subprocess, mock_time, mock_streamreader
+    mock_notification, mock_subprocess, mock_time, mock_streamreader
 ):
-    mock_pipe.return_value = mock.Mock(), mock.Mock()
     mock_process = mock.Mock()
     mock_process.returncode = None
     mock_subprocess.Popen.return_value = mock_process
@@ -36,11 +37,10 @@ def test_run_command_aborts_after_timeout_legacy(
 @mock.patch("procrunner._NonBlockingStreamReader")
 @mock.patch("procrunner.time")
 @mock.patch("procrunner.subprocess")
-@mock.patch("procrunner.Pipe")
+@mock.patch("procrunner._Notification")
 def test_run_command_aborts_after_timeout(
-    mock_pipe, mock_subprocess, mock_time, mock_streamreader
+    mock_notification, mock_subprocess, mock_time, mock_streamreader
 ):
-    mock_pipe.return_value = mock.Mock(), mock.Mock()
     mock_process = mock.Mock()
     mock_process.returncode = None
     mock_subprocess.Popen.return_value = mock_process
@@ -62,6 +62,8 @@ def test_run_command_runs_command_and_directs_pipelines(
     (mock_stdout, mock_stderr) = (mock.Mock(), mock.Mock())
     mock_stdout.get_output.return_value = mock.sentinel.proc_stdout
     mock_stderr.get_output.return_value = mock.sentinel.proc_stderr
+    mock_stdout.omitted = mock_stderr.omitted = None
+    mock_stdout.decode_error = mock_stderr.decode_error = None
     (stream_stdout, stream_stderr) = (mock.sentinel.stdout, mock.sentinel.stderr)
     mock_process = mock.Mock()
     mock_process.stdout = stream_stdout
@@ -96,25 +98,49 @@ def test_run_command_runs_command_and_directs_pipelines(
                 output=mock.ANY,
                 notify=mock.ANY,
                 callback=mock.sentinel.callback_stdout,
+                callback_bytes=None,
+                callback_batch=None,
+                batch_type="bytes",
+                record=None,
+                reactor=None,
+                delimiter=b"\n",
+                collapse_progress=False,
+                max_line_length=None,
+                overlong_lines="split",
+                buffer=None,
+                parser=None,
+                encoding="utf-8",
+                errors="replace",
             ),
             mock.call(
                 stream_stderr,
                 output=mock.ANY,
                 notify=mock.ANY,
                 callback=mock.sentinel.callback_stderr,
+                callback_bytes=None,
+                callback_batch=None,
+                batch_type="bytes",
+                record=None,
+                reactor=None,
+                delimiter=b"\n",
+                collapse_progress=False,
+                max_line_length=None,
+                overlong_lines="split",
+                buffer=None,
+                parser=None,
+                encoding="utf-8",
+                errors="replace",
             ),
         ],
         any_order=True,
     )
     assert not mock_process.terminate.called
     assert not mock_process.kill.called
-    assert actual == mock_subprocess.CompletedProcess.return_value
-    mock_subprocess.CompletedProcess.assert_called_once_with(
-        args=tuple(command),
-        returncode=mock_process.returncode,
-        stdout=mock.sentinel.proc_stdout,
-        stderr=mock.sentinel.proc_stderr,
-    )
+    assert isinstance(actual, procrunner.CompletedProcess)
+    assert actual.args == tuple(command)
+    assert actual.returncode == mock_process.returncode
+    assert actual.stdout == mock.sentinel.proc_stdout
+    assert actual.stderr == mock.sentinel.proc_stderr
 
 
 @mock.patch("procrunner.subprocess")
@@ -277,3 +303,411 @@ def test_lineaggregator_aggregates_data():
     callback.assert_not_called()
     aggregator.flush()
     callback.assert_called_once_with("morestuff")
+
+
+def test_lineaggregator_splits_chunks_into_lines():
+    callback = mock.Mock()
+    printer = mock.Mock()
+    aggregator = procrunner._LineAggregator(print_line=printer, callback=callback)
+
+    aggregator.add(b"first\nsec")
+    aggregator.add(b"ond\nthird\nfourth")
+    assert callback.call_args_list == [
+        mock.call("first"),
+        mock.call("second"),
+        mock.call("third"),
+    ]
+    assert printer.write.call_args_list == [
+        mock.call(b"first\n"),
+        mock.call(b"second\nthird\n"),
+    ]
+    callback.reset_mock()
+    aggregator.flush()
+    callback.assert_called_once_with("fourth")
+    printer.write.assert_called_with(b"fourth\n")
+
+
+@pytest.mark.parametrize(
+    "policy,expected,dropped,coalesced",
+    (
+        ("drop_oldest", ["c", "d"], 2, 0),
+        ("coalesce", ["a", "b", "c", "d"], 0, 2),
+    ),
+)
+def test_callbackdispatcher_applies_policy_on_full_queue(
+    policy, expected, dropped, coalesced
+):
+    callback = mock.Mock()
+    dispatcher = procrunner.CallbackDispatcher(maxsize=2, policy=policy)
+    queue_line = dispatcher.wrap(callback)
+    for line in "abcd":
+        queue_line(line)
+    assert dispatcher.depth == 2
+    callback.assert_not_called()
+
+    dispatcher.start()
+    dispatcher.close()
+    assert callback.call_args_list == [mock.call(line) for line in expected]
+    assert dispatcher.depth == 0
+    assert dispatcher.max_depth == 2
+    assert dispatcher.dropped == dropped
+    assert dispatcher.coalesced == coalesced
+
+
+def test_callbackdispatcher_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        procrunner.CallbackDispatcher(policy="whatever")
+
+
+@pytest.mark.parametrize("batch_type", ("str", "bytes", "memoryview"))
+def test_lineaggregator_passes_batches_of_lines(batch_type):
+    batches = []
+    callback_bytes = mock.Mock()
+    aggregator = procrunner._LineAggregator(
+        callback_bytes=callback_bytes,
+        callback_batch=batches.append,
+        batch_type=batch_type,
+    )
+
+    aggregator.add(b"one\ntw")
+    aggregator.add(b"o\nthree\n\xa0")
+    aggregator.flush()
+    assert callback_bytes.call_args_list == [
+        mock.call(b"one"),
+        mock.call(b"two"),
+        mock.call(b"three"),
+        mock.call(b"\xa0"),
+    ]
+    if batch_type == "str":
+        expected = [["one"], ["two", "three"], ["\ufffd"]]
+    else:
+        expected = [[b"one"], [b"two", b"three"], [b"\xa0"]]
+    assert [
+        [bytes(line) if batch_type == "memoryview" else line for line in batch]
+        for batch in batches
+    ] == expected
+
+
+@pytest.mark.parametrize("collapse", (False, True))
+def test_lineaggregator_splits_on_universal_newlines(collapse):
+    callback = mock.Mock()
+    aggregator = procrunner._LineAggregator(
+        callback=callback, delimiter="universal", collapse_progress=collapse
+    )
+
+    aggregator.add(b"one\r\ntwo\r")
+    aggregator.add(b"\n10%\r50%\r")
+    aggregator.add(b"100%\rdone")
+    aggregator.flush()
+    if collapse:
+        expected = ["one", "two", "50%", "100%", "done"]
+    else:
+        expected = ["one", "two", "10%", "50%", "100%", "done"]
+    assert callback.call_args_list == [mock.call(line) for line in expected]
+
+
+def test_lineaggregator_splits_on_custom_delimiter():
+    callback_bytes = mock.Mock()
+    aggregator = procrunner._LineAggregator(
+        callback_bytes=callback_bytes, delimiter=b"\0\0"
+    )
+
+    aggregator.add(b"first\0")
+    aggregator.add(b"\0second\0third\0")
+    aggregator.add(b"\0")
+    assert callback_bytes.call_args_list == [
+        mock.call(b"first"),
+        mock.call(b"second\0third"),
+    ]
+    with pytest.raises(ValueError):
+        procrunner._LineAggregator(delimiter=b"")
+
+
+def _chunkings(data):
+    """Yield the data split into reads of every size, and at every offset."""
+    for size in range(1, len(data) + 1):
+        yield [data[start : start + size] for start in range(0, len(data), size)]
+    for cut in range(1, len(data)):
+        yield [data[:cut], data[cut:]]
+
+
+@pytest.mark.parametrize(
+    "data",
+    (b"a\rb\nc\n", b"x\r\r\ny\r\n\rz\n\n", b"\r\n\n\r\n", b"a\r\nb\rc"),
+)
+def test_lineaggregator_universal_newlines_do_not_depend_on_reads(data):
+    expected = re.split(rb"\r\n|\r|\n", data)
+    if expected[-1] == b"":
+        expected.pop()
+    for chunks in _chunkings(data):
+        lines = []
+        printed = []
+        aggregator = procrunner._LineAggregator(
+            print_line=mock.Mock(write=printed.append),
+            callback_bytes=lines.append,
+            delimiter="universal",
+        )
+        for chunk in chunks:
+            aggregator.add(chunk)
+        aggregator.flush()
+        assert lines == expected, chunks
+        assert b"".join(printed).rstrip(b"\n") == data.rstrip(b"\n"), chunks
+
+
+@pytest.mark.parametrize("delimiter", (b"\0\0", b"aba", b"\r\n"))
+def test_lineaggregator_custom_delimiters_do_not_depend_on_reads(delimiter):
+    data = b"x\0\0\0y\0\0\0\0z\0ababa-abaaba\r\n\r\r\nw\0\0"
+    expected = data.split(delimiter)
+    if expected[-1] == b"":
+        expected.pop()
+    for chunks in _chunkings(data):
+        lines = []
+        aggregator = procrunner._LineAggregator(
+            callback_bytes=lines.append, delimiter=delimiter
+        )
+        for chunk in chunks:
+            aggregator.add(chunk)
+        aggregator.flush()
+        assert lines == expected, chunks
+
+
+def test_lineaggregator_splits_overlong_lines():
+    callback = mock.Mock()
+    callback_bytes = mock.Mock()
+    aggregator = procrunner._LineAggregator(
+        callback=callback, callback_bytes=callback_bytes, max_line_length=4
+    )
+
+    aggregator.add(b"abc")
+    aggregator.add(b"defghij")
+    assert aggregator._pending_length <= 4
+    aggregator.add(b"k\nlmnopq\n\xc3\xa4\xc3\xb6\xc3\xbc")
+    aggregator.flush()
+    assert callback_bytes.call_args_list == [
+        mock.call(b"abcd"),
+        mock.call(b"efgh"),
+        mock.call(b"ijk"),
+        mock.call(b"lmno"),
+        mock.call(b"pq"),
+        mock.call(b"\xc3\xa4\xc3\xb6"),
+        mock.call(b"\xc3\xbc"),
+    ]
+    lines = [args[0] for args, _ in callback.call_args_list]
+    assert lines == ["abcd", "efgh", "ijk", "lmno", "pq", "\xe4\xf6", "\xfc"]
+    assert [isinstance(line, procrunner.PartialLine) for line in lines] == [
+        True,
+        True,
+        False,
+        True,
+        False,
+        True,
+        False,
+    ]
+
+
+def test_lineaggregator_truncates_overlong_lines():
+    callback = mock.Mock()
+    aggregator = procrunner._LineAggregator(
+        callback=callback, max_line_length=4, overlong_lines="truncate"
+    )
+
+    aggregator.add(b"abcdef")
+    aggregator.add(b"ghij" * 100)
+    assert aggregator._pending_length <= 5
+    aggregator.add(b"\nlmn\nopqrst\nuvwxyz")
+    aggregator.flush()
+    assert callback.call_args_list == [
+        mock.call("abcd[...]"),
+        mock.call("lmn"),
+        mock.call("opqr[...]"),
+        mock.call("uvwx[...]"),
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", (1, 3, 7, 100))
+def test_headtailbuffer_keeps_beginning_and_end_of_data(chunk_size):
+    data = bytes(range(50))
+    buffer = procrunner._HeadTailBuffer(head=5, tail=8)
+    for start in range(0, len(data), chunk_size):
+        buffer.write(data[start : start + chunk_size])
+        assert buffer.read_from(0) == (buffer.getvalue(), buffer.size)
+    assert buffer.getvalue() == data[:5] + data[-8:]
+    assert buffer.omitted == 37
+    assert buffer.read_from(3) == (data[3:5] + data[-8:], 50)
+    assert buffer.read_from(45) == (data[45:], 50)
+
+
+@pytest.mark.parametrize("chunk_size", (1, 4, 1000))
+def test_headtailbuffer_keeps_lines(chunk_size):
+    data = b"".join(b"line %d\n" % n for n in range(20)) + b"partial"
+    buffer = procrunner._HeadTailBuffer(head=2, tail=3, unit="lines")
+    for start in range(0, len(data), chunk_size):
+        buffer.write(data[start : start + chunk_size])
+    assert buffer.getvalue() == b"line 0\nline 1\nline 17\nline 18\nline 19\npartial"
+    assert buffer.omitted == len(data) - len(buffer.getvalue())
+
+
+def test_headtailbuffer_limits_unterminated_lines():
+    buffer = procrunner._HeadTailBuffer(
+        head=2, tail=3, unit="lines", max_line_length=10
+    )
+    for _ in range(1000):
+        buffer.write(b"x" * 100)
+    assert buffer.getvalue() == b"x" * 20
+    assert buffer.omitted == 100000 - 20
+    buffer.write(b"y\nline\n")
+    assert buffer.getvalue() == b"x" * 20 + b"y\nline\n"
+    assert buffer.omitted == buffer.size - len(buffer.getvalue())
+    assert buffer.read_from(0) == (buffer.getvalue(), buffer.size)
+
+    buffer = procrunner._HeadTailBuffer(
+        head=1, tail=3, unit="lines", max_line_length=10
+    )
+    buffer.write(b"head\nline 1\nline 2\n" + b"z" * 50)
+    assert buffer.getvalue() == b"head\n" + b"z" * 10
+    assert buffer.omitted == 2 * 7 + 40
+
+
+def test_compressedbuffer_compresses_data_incrementally():
+    buffer = procrunner._CompressedBuffer()
+    data = b"".join(b"log line %d\n" % n for n in range(20000))
+    received = b""
+    offset = 0
+    for start in range(0, len(data), 4096):
+        buffer.write(data[start : start + 4096])
+        chunk, offset = buffer.read_from(offset)
+        received += chunk
+    assert received == data[: len(received)]
+    assert buffer.read_from(10) == (received[10:], len(received))
+    compressed = buffer.getvalue()
+    assert len(compressed) * 4 < len(data)
+    assert zlib.decompress(compressed) == data
+
+
+@pytest.mark.parametrize(
+    "data", (b"", b"\n", b"one", b"one\n", b"one\ntwo", b"one\n\nthree\n\xa0\n")
+)
+def test_completedprocess_offers_lazy_text_and_lines(data):
+    result = procrunner.CompletedProcess([], 0, stdout=data, stderr=b"err\n")
+    expected = data.decode("utf-8", "replace")
+    assert result.stdout_text == expected
+    assert result.stderr_text == "err\n"
+    lines = result.lines()
+    assert list(lines) == expected.splitlines()
+    assert lines[-2:] == expected.splitlines()[-2:]
+    assert result.lines(text=False)[::2] == data.splitlines()[::2]
+    assert result.lines("stderr")[0] == "err"
+    with pytest.raises(IndexError):
+        lines[len(lines)]
+
+
+def test_outputindex_records_interleaved_lines():
+    index = procrunner.OutputIndex(granularity="line")
+    record_stdout = index.recorder("stdout")
+    record_stderr = index.recorder("stderr")
+    record_stdout(0, b"one\ntw")
+    record_stderr(0, b"warning\n")
+    record_stdout(6, b"o\n")
+    index.attach(stdout=b"one\ntwo\n", stderr=b"warning\n")
+
+    assert len(index) == 4
+    assert [(stream, bytes(data)) for _, stream, data in index] == [
+        ("stdout", b"one\n"),
+        ("stdout", b"tw"),
+        ("stderr", b"warning\n"),
+        ("stdout", b"o\n"),
+    ]
+    assert index.combined() == b"one\ntwwarning\no\n"
+    assert list(index.timestamps) == sorted(index.timestamps)
+    assert all(timestamp >= index.start for timestamp in index.timestamps)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="resource limits are not available")
+@mock.patch("procrunner.subprocess")
+def test_unknown_resource_limit_is_rejected_before_starting_process(mock_subprocess):
+    with pytest.raises(ValueError, match="whatever"):
+        procrunner.run(["___"], limits={"whatever": 1})
+    mock_subprocess.Popen.assert_not_called()
+
+
+def test_cpuallocator_spreads_processes_over_cores():
+    allocator = procrunner.CPUAllocator(cpus_per_process=2, cpus=[0, 1, 2, 3, 4, 5])
+    first = allocator.acquire()
+    second = allocator.acquire()
+    third = allocator.acquire()
+    assert len(first) == len(second) == len(third) == 2
+    assert first | second | third == {0, 1, 2, 3, 4, 5}
+    allocator.release(second)
+    assert allocator.acquire() == second
+    with pytest.raises(ValueError):
+        procrunner.CPUAllocator(cpus_per_process=7, cpus=[0, 1, 2, 3, 4, 5])
+
+
+def test_aggregator_decodes_with_configured_encoding():
+    lines = []
+    aggregator = procrunner._LineAggregator(
+        callback=lines.append, encoding="latin-1", print_line=False
+    )
+    aggregator.add(b"plain\ncaf\xe9\n")
+    aggregator.add(b"na\xefve")
+    aggregator.flush()
+    assert lines == ["plain", "café", "naïve"]
+
+    aggregator = procrunner._LineAggregator(
+        callback=lines.append, errors="strict", print_line=False
+    )
+    with pytest.raises(UnicodeDecodeError):
+        aggregator.add(b"\xff\n")
+
+
+def test_binary_mode_never_decodes():
+    with pytest.raises(ValueError):
+        procrunner._LineAggregator(callback=print, encoding=None)
+    lines = []
+    aggregator = procrunner._LineAggregator(
+        callback_batch=lines.extend, encoding=None, print_line=False
+    )
+    aggregator.add(b"\x00\xff\n\x80")
+    aggregator.flush()
+    assert lines == [b"\x00\xff", b"\x80"]
+
+
+def test_stream_encodings_are_validated():
+    assert procrunner._stream_encodings("UTF8", "strict") == [
+        ("utf-8", "strict"),
+        ("utf-8", "strict"),
+    ]
+    assert procrunner._stream_encodings({"stdout": None}, {"stderr": "ignore"}) == [
+        (None, "replace"),
+        ("utf-8", "ignore"),
+    ]
+    for encoding, errors in (("utf-16", "replace"), ("nope", "replace")):
+        with pytest.raises(ValueError):
+            procrunner._stream_encodings(encoding, errors)
+    with pytest.raises(ValueError):
+        procrunner._stream_encodings("utf-8", "nope")
+
+
+def test_consolewriter_passes_matching_encoding_through_unchanged():
+    buffer = mock.Mock()
+    stream = mock.Mock(buffer=buffer, encoding="UTF-8")
+    with mock.patch("sys.stdout", stream):
+        procrunner._ConsoleWriter("stdout").write("café\n".encode("utf-8"))
+        procrunner._ConsoleWriter("stdout", "latin-1").write(b"caf\xe9\n")
+    buffer.write.assert_called_once_with("café\n".encode("utf-8"))
+    stream.write.assert_called_once_with("café\n")
+
+
+def test_consolewriter_replaces_only_incomplete_trailing_utf8():
+    buffer = mock.Mock()
+    stream = mock.Mock(buffer=buffer, encoding="UTF-8")
+    writer = procrunner._ConsoleWriter("stdout")
+    with mock.patch("sys.stdout", stream):
+        writer.write(b"bad \xa0 byte\n")
+        writer.write("piece é".encode("utf-8")[:-1])
+        writer.write("piece é".encode("utf-8"))
+    assert buffer.write.call_args_list == [
+        mock.call(b"bad \xa0 byte\n"),
+        mock.call("piece \ufffd".encode("utf-8")),
+        mock.call("piece é".encode("utf-8")),
+    ]
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+from unittest import mock
+
+import pytest
+
+import procrunner
+from procrunner import __main__, benchmarking
+
+
+def test_percentiles_are_interpolated():
+    values = [4.0, 1.0, 3.0, 2.0]
+    assert benchmarking.percentile(values, 0) == 1.0
+    assert benchmarking.percentile(values, 50) == 2.5
+    assert benchmarking.percentile(values, 100) == 4.0
+    assert benchmarking.percentile([7.0], 90) == 7.0
+
+
+def test_benchmark_runs_parameter_combinations(tmp_path):
+    counter = tmp_path / "runs"
+    results = procrunner.benchmark(
+        [
+            sys.executable,
+            "-c",
+            f"open({str(counter)!r}, 'a').write('{{size}} '); print('x' * {{size}})",
+        ],
+        parameters={"size": [10, 1000]},
+        runs=3,
+        warmup=2,
+    )
+    assert counter.read_text().split() == ["10"] * 5 + ["1000"] * 5
+    assert [result.parameters for result in results] == [{"size": 10}, {"size": 1000}]
+    for result in results:
+        assert len(result.times) == 3
+        assert result.min <= result.percentile(50) <= result.max
+        assert result.returncodes == [0, 0, 0]
+        if hasattr(os, "wait4"):
+            assert len(result.max_rss) == 3
+            assert min(result.max_rss) > 2**20
+        json.dumps(result.to_dict())
+
+
+def test_benchmark_stops_on_failure():
+    with pytest.raises(subprocess.CalledProcessError):
+        procrunner.benchmark([sys.executable, "-c", "raise SystemExit(3)"], runs=2)
+    (result,) = procrunner.benchmark(
+        [sys.executable, "-c", "raise SystemExit(3)"],
+        runs=2,
+        warmup=0,
+        ignore_failure=True,
+    )
+    assert result.returncodes == [3, 3]
+
+
+def test_runs_without_resource_usage_are_counted():
+    rusage = mock.Mock(ru_utime=1.0, ru_stime=0.5, ru_maxrss=100)
+    runs = [
+        subprocess.CompletedProcess([], 0),
+        subprocess.CompletedProcess([], 0),
+        subprocess.CompletedProcess([], 0),
+    ]
+    for run, usage in zip(runs, (rusage, None, rusage)):
+        run.rusage = usage
+    with mock.patch("os.wait4", create=True), mock.patch(
+        "procrunner.run", side_effect=runs
+    ):
+        (result,) = procrunner.benchmark(["command"], runs=3, warmup=0)
+    assert len(result.times) == 3
+    assert result.user_times == [1.0, 1.0]
+    assert result.missing_rusage == 1
+    assert result.to_dict()["missing_rusage"] == 1
+    assert "No resource usage for 1 of 3 runs" in benchmarking.format_result(result)
+
+
+def test_bench_command_line_exports_json(tmp_path, capsys):
+    export = tmp_path / "results.json"
+    __main__.main(
+        [
+            "bench",
+            "--runs",
+            "2",
+            "--warmup",
+            "0",
+            "--export-json",
+            str(export),
+            "--",
+            sys.executable,
+            "-c",
+            "pass",
+        ]
+    )
+    assert "Time (mean ± σ)" in capsys.readouterr().out
+    (result,) = json.loads(export.read_text())["results"]
+    assert len(result["times"]) == 2
+    assert result["exit_codes"] == [0, 0]
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import os
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import pytest
+
+import procrunner
+from procrunner import cache, parsers
+
+
+@pytest.fixture
+def mock_run():
+    with mock.patch("procrunner.run") as mock_run:
+        mock_run.side_effect = lambda command, **kwargs: subprocess.CompletedProcess(
+            command, 0, stdout=b"out " + repr(kwargs).encode(), stderr=b""
+        )
+        yield mock_run
+
+
+def test_repeated_command_is_returned_from_cache(tmp_path, mock_run):
+    c = cache.ResultCache(tmp_path)
+    command = [sys.executable, "--version"]
+
+    first = c.run(command, stdin=b"data")
+    second = c.run(command, stdin=b"data")
+    assert mock_run.call_count == 1
+    assert not hasattr(first, "cached")
+    assert second.cached
+    assert (second.args, second.returncode, second.stdout, second.stderr) == (
+        first.args,
+        first.returncode,
+        first.stdout,
+        first.stderr,
+    )
+
+    c.run(command, stdin=b"other data")
+    c.run(command, environment_override={"LANG": "C"}, stdin=b"data")
+    c.run(command, working_directory=os.path.dirname(tmp_path), stdin=b"data")
+    c.run(command, environment_override={"UNRELATED": "1"}, stdin=b"data")
+    assert mock_run.call_count == 4
+    assert (c.hits, c.misses) == (2, 4)
+
+
+def test_failures_and_uncacheable_calls_are_not_stored(tmp_path, mock_run):
+    c = cache.ResultCache(tmp_path)
+    with mock.patch("procrunner.run") as failing_run:
+        failing_run.return_value = subprocess.CompletedProcess([], 1, b"", b"")
+        c.run(["false"])
+        c.run(["false"])
+        assert failing_run.call_count == 2
+    assert c.key(["cat"], stdin=7) is None
+    assert c.stats["size"] == 0
+
+
+def test_least_recently_used_results_are_evicted(tmp_path, mock_run):
+    c = cache.ResultCache(tmp_path)
+    c.run(["first"])
+    size = c.stats["size"]
+    c.max_size = 2 * size + size // 2
+    c.run(["second"])
+    os.utime(c._path(c.key(["first"])), (0, 0))
+    os.utime(c._path(c.key(["second"])), (1, 1))
+    c.run(["first"])
+    c.run(["third"])
+    assert c.evictions == 1
+    assert c._load(c.key(["second"])) is None
+    assert c._load(c.key(["first"])) is not None
+    assert c.stats["size"] <= c.max_size
+
+
+def test_expired_results_are_discarded(tmp_path, mock_run):
+    c = cache.ResultCache(tmp_path, max_age=60)
+    with mock.patch("time.time", return_value=time.time() - 3600):
+        c.run(["command"])
+    c.run(["command"])
+    assert (c.hits, c.misses, c.evictions) == (0, 2, 1)
+
+
+def test_output_settings_are_part_of_the_key(tmp_path):
+    c = cache.ResultCache(tmp_path)
+    keys = {
+        c.key(["command"]),
+        c.key(["command"], capture="head_tail"),
+        c.key(["command"], capture="head_tail", capture_tail=10),
+        c.key(["command"], capture_compression="zlib"),
+        c.key(["command"], encoding="latin-1"),
+        c.key(["command"], errors="strict"),
+        c.key(["command"], parse_stdout="json"),
+    }
+    assert len(keys) == 7
+    assert c.key(["command"], capture="all") == c.key(["command"])
+    assert c.key(["command"], capture_index="chunk") is None
+    assert c.key(["command"], resource_usage=True) is None
+    assert c.key(["command"], parse_stdout=parsers.JSONLinesParser()) is None
+
+
+def test_cached_result_keeps_type_and_attributes(tmp_path):
+    c = cache.ResultCache(tmp_path)
+    command = [sys.executable, "-c", "print('{\"a\": 1}')"]
+    kwargs = dict(
+        capture_compression="zlib",
+        encoding="latin-1",
+        parse_stdout="json",
+        print_stdout=False,
+    )
+    first = c.run(command, **kwargs)
+    second = c.run(command, **kwargs)
+    assert second.cached
+    assert type(second) is type(first) is procrunner.CompressedCompletedProcess
+    assert second.stdout_compressed == first.stdout_compressed
+    assert second.stdout_records == first.stdout_records == [{"a": 1}]
+    assert second.encodings == first.encodings
+    assert second.stdout_text == first.stdout_text
+
+
+def test_line_and_terminal_options_are_part_of_the_key(tmp_path, mock_run):
+    c = cache.ResultCache(tmp_path)
+    c.run(["command"])
+    c.run(["command"], pty=True)
+    c.run(["command"], line_delimiter=b"\0")
+    c.run(["command"], line_delimiter="\n")
+    assert mock_run.call_count == 3
+    assert (c.hits, c.misses) == (1, 3)
+
+
+def test_results_expire_from_when_they_were_stored(tmp_path, mock_run):
+    c = cache.ResultCache(tmp_path, max_age=60)
+    c.run(["old"])
+    old = c._path(c.key(["old"]))
+    os.utime(old, (time.time(), time.time() - 3600))
+    c.run(["new"])
+    assert not os.path.exists(old)
+    assert c.evictions == 1
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+
+import procrunner
+
+# Budgets for the cost of 'import procrunner' in a fresh interpreter
+IMPORT_TIME_BUDGET = 0.5  # seconds
+IMPORTED_MODULES_BUDGET = 60
+
+
+def test_import_stays_within_budget():
+    probe = (
+        "import json, sys, time\n"
+        "before = set(sys.modules)\n"
+        "start = time.perf_counter()\n"
+        "import procrunner\n"
+        "runtime = time.perf_counter() - start\n"
+        "print(json.dumps([runtime, sorted(set(sys.modules) - before)]))\n"
+    )
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.path.dirname(
+        os.path.dirname(os.path.abspath(procrunner.__file__))
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", probe],
+        capture_output=True,
+        check=True,
+        env=environment,
+    ).stdout
+    runtime, modules = json.loads(output)
+
+    assert "multiprocessing" not in modules
+    assert "shutil" not in modules
+    assert len(modules) <= IMPORTED_MODULES_BUDGET, modules
+    assert runtime < IMPORT_TIME_BUDGET
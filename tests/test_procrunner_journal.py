@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import procrunner
+from procrunner import __main__, journal
+
+
+@pytest.fixture
+def journal_file(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal.enable(path, flush_interval=0.05)
+    yield path
+    journal.disable()
+
+
+def test_journal_records_runs(journal_file, tmp_path):
+    procrunner.run(
+        [sys.executable, "-c", "print('x' * 99)"],
+        working_directory=tmp_path,
+        print_stdout=False,
+    )
+    with pytest.raises(subprocess.TimeoutExpired):
+        procrunner.run(
+            [sys.executable, "-c", "import time; time.sleep(5)"],
+            timeout=0.2,
+        )
+    journal.disable()
+    assert procrunner._journal is None
+
+    first, second = journal.load(journal_file)
+    assert first["executable"] == sys.executable
+    assert first["working_directory"] == os.fspath(tmp_path)
+    assert first["returncode"] == 0
+    assert first["stdout_bytes"] == 100
+    assert first["stderr_bytes"] == 0
+    assert first["start"] <= first["end"]
+    assert 0 < first["runtime"] <= first["end"] - first["start"] + 0.01
+    assert not first["timeout"]
+    if hasattr(os, "wait4"):
+        assert first["max_rss"] > 2**20
+    assert second["timeout"]
+    assert not second["killed"]
+
+
+def test_journal_without_resource_usage(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal.enable(path, resource_usage=False)
+    try:
+        result = procrunner.run([sys.executable, "-c", "pass"])
+    finally:
+        journal.disable()
+    assert not hasattr(result, "rusage")
+    (entry,) = journal.load(path)
+    assert "max_rss" not in entry
+
+
+def test_journal_writes_in_batches(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with journal.Journal(path, flush_interval=60, batch_size=3, max_queue=4) as log:
+        log.record({"n": 1})
+        log.record({"n": 2})
+        assert not path.exists()
+    assert journal.load(path) == [{"n": 1}, {"n": 2}]
+    log.record({"n": 3})
+    assert log.dropped == 1
+
+
+def test_journal_summary(tmp_path, capsys):
+    path = tmp_path / "journal.jsonl"
+    entries = [
+        {"command": ["a"], "executable": "/bin/a", "runtime": t, "timeout": t > 9}
+        for t in (1, 2, 3, 10)
+    ] + [{"command": ["b", "x"], "executable": None, "runtime": 20, "timeout": False}]
+    path.write_text("".join(f"{json.dumps(entry)}\n" for entry in entries) + '{"trunc')
+    assert journal.load(path) == entries
+
+    assert journal.slowest(entries, 2) == [entries[4], entries[3]]
+    summary = journal.summarize(entries)
+    assert list(summary) == ["b", "/bin/a"]
+    assert summary["/bin/a"]["count"] == 4
+    assert summary["/bin/a"]["total"] == 16
+    assert summary["/bin/a"]["p50"] == 2.5
+    assert summary["/bin/a"]["timeout_rate"] == 0.25
+
+    __main__.main(["journal", "--slowest", "1", str(path)])
+    output = capsys.readouterr().out
+    assert "25.0%  /bin/a" in output
+    assert "20.000s  b x" in output
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import sys
+
+import pytest
+
+import procrunner
+from procrunner import parsers
+
+
+def test_json_lines_are_parsed_line_by_line():
+    parser = parsers.JSONLinesParser()
+    parser.feed([b'{"step": 1}', b"", b"[1, 2]"])
+    parser.feed([b'{"step": 2}', b"progress: 50%", b"3"])
+    parser.feed([b"1, 2"])
+    assert parser.records == [{"step": 1}, [1, 2], {"step": 2}, 3]
+    assert parser.invalid_lines == 2
+
+
+def test_json_documents_spanning_lines_are_invalid():
+    parser = parsers.JSONLinesParser()
+    parser.feed([b"[1", b"2],3"])
+    parser.feed([b'{"a": 1', b'"b": 2}'])
+    assert parser.records == []
+    assert parser.invalid_lines == 4
+
+
+def test_key_value_pairs_are_parsed():
+    records = []
+    parser = parsers.create("keyvalue", callback=records.append)
+    assert parser.records is None
+    parser.feed([b'step=3 loss=0.25 msg="all \\"good\\"" empty=', b"no pairs here"])
+    assert records == [{"step": "3", "loss": "0.25", "msg": 'all "good"', "empty": ""}]
+    assert parser.invalid_lines == 1
+
+
+def test_csv_records_use_header_line():
+    parser = parsers.CSVParser()
+    parser.feed([b"name,size", b"a,1", b'"b, c",2'])
+    parser.feed([b"d"])
+    assert parser.fieldnames == ["name", "size"]
+    assert parser.records == [{"name": "a", "size": "1"}, {"name": "b, c", "size": "2"}]
+    assert parser.invalid_lines == 1
+
+    parser = parsers.CSVParser(header=False, delimiter=";")
+    parser.feed([b"a;1"])
+    assert parser.records == [["a", "1"]]
+
+
+def test_aggregator_feeds_complete_lines_to_parser():
+    parser = parsers.JSONLinesParser()
+    aggregator = procrunner._LineAggregator(print_line=False, parser=parser)
+    aggregator.add(b'{"a": 1}\n{"b":')
+    assert parser.records == [{"a": 1}]
+    aggregator.add(b' 2}\n{"c": 3}')
+    aggregator.flush()
+    assert parser.records == [{"a": 1}, {"b": 2}, {"c": 3}]
+
+
+def test_record_parser_requires_parse_line():
+    with pytest.raises(TypeError):
+        parsers.RecordParser()
+
+
+def test_csv_lines_are_parsed_one_by_one():
+    parser = parsers.CSVParser()
+    with pytest.raises(ValueError):
+        parser.parse_line(b"a,1")
+    parser.feed([b"name,size"])
+    assert parser.parse_line(b'"b, c",2') == {"name": "b, c", "size": "2"}
+    with pytest.raises(ValueError):
+        parser.parse_line(b"d")
+
+
+def test_parsers_decode_with_the_stream_encoding():
+    keyvalue = parsers.KeyValueParser()
+    csv = parsers.CSVParser(header=False)
+    jsonlines = parsers.JSONLinesParser()
+    for parser in (keyvalue, csv, jsonlines):
+        procrunner._LineAggregator(
+            print_line=False, parser=parser, encoding="latin-1"
+        ).add(b'caf\xe9="na\xefve"\n["caf\xe9"]\n')
+    assert keyvalue.records == [{"caf\xe9": "na\xefve"}]
+    assert csv.records[0] == ['caf\xe9="na\xefve"']
+    assert jsonlines.records == [["caf\xe9"]]
+
+    parser = parsers.KeyValueParser()
+    procrunner._LineAggregator(print_line=False, parser=parser, encoding=None).add(
+        b"caf\xc3\xa9=1\n"
+    )
+    assert parser.records == [{"caf\xe9": "1"}]
+
+
+def test_run_parses_output_in_the_stream_encoding():
+    result = procrunner.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "sys.stdout.buffer.write('name=caf\\xe9\\n'.encode('latin-1'))",
+        ],
+        parse_stdout="keyvalue",
+        encoding="latin-1",
+        print_stdout=False,
+        print_stderr=False,
+    )
+    assert result.stdout_records == [{"name": "caf\xe9"}]
+
+
+def test_unknown_formats_are_rejected():
+    with pytest.raises(ValueError):
+        parsers.create("xml")
+    with pytest.raises(ValueError):
+        parsers.create(parsers.JSONLinesParser(), callback=print)
+    with pytest.raises(ValueError):
+        procrunner.run([sys.executable, "-c", ""], callback_stdout_records=print)
+
+
+def test_run_parses_output_without_keeping_it():
+    result = procrunner.run(
+        [
+            sys.executable,
+            "-c",
+            "import json, sys\n"
+            "for n in range(1000): print(json.dumps({'n': n}))\n"
+            "print('level=warning count=3', file=sys.stderr)",
+        ],
+        parse_stdout="json",
+        parse_stderr="keyvalue",
+        capture="none",
+        print_stdout=False,
+        print_stderr=False,
+    )
+    assert result.stdout == b""
+    assert result.stdout_omitted == sum(len(f'{{"n": {n}}}\n') for n in range(1000))
+    assert result.stdout_records == [{"n": n} for n in range(1000)]
+    assert result.stderr_records == [{"level": "warning", "count": "3"}]
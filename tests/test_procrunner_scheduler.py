@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import sys
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from procrunner import scheduler
+
+
+@mock.patch("procrunner.scheduler._available_memory")
+@mock.patch("procrunner.scheduler._runnable_processes")
+def test_jobs_are_admitted_based_on_measured_load(mock_runnable, mock_memory):
+    mock_runnable.return_value = 4
+    mock_memory.return_value = 8 * 2**30
+    s = scheduler.Scheduler(cpu_capacity=4, min_parallel=1, settle_time=60)
+    s._running = {mock.Mock(cpu=1, memory=0, started=-1000)}
+
+    assert s._admissible(scheduler._Job(None, 1, 0, 0, {}))
+    assert not s._admissible(scheduler._Job(None, 2, 0, 0, {}))
+    mock_runnable.return_value = 1
+    assert s._admissible(scheduler._Job(None, 2, 0, 0, {}))
+    assert not s._admissible(scheduler._Job(None, 1, 9 * 2**30, 0, {}))
+
+    # measurements do not yet include recently started jobs
+    s._running.add(mock.Mock(cpu=2, memory=4 * 2**30, started=float("inf")))
+    assert not s._admissible(scheduler._Job(None, 3, 0, 0, {}))
+    assert not s._admissible(scheduler._Job(None, 1, 5 * 2**30, 0, {}))
+    assert s._admissible(scheduler._Job(None, 1, 3 * 2**30, 0, {}))
+
+
+@mock.patch("procrunner.scheduler._runnable_processes", return_value=None)
+def test_declared_weights_are_used_without_measurements(mock_runnable):
+    s = scheduler.Scheduler(cpu_capacity=2, min_parallel=1)
+    s._running = {mock.Mock(cpu=1.5, memory=0, started=0)}
+    assert not s._admissible(scheduler._Job(None, 1, 0, 0, {}))
+    assert s._admissible(scheduler._Job(None, 0.5, 0, 0, {}))
+
+    # suspended jobs do not count towards the CPU load
+    s._suspended = set(s._running)
+    assert s._admissible(scheduler._Job(None, 2, 0, 0, {}))
+
+
+@mock.patch("procrunner.start")
+def test_jobs_are_started_in_priority_order(mock_start):
+    started = []
+    blocking = threading.Event()
+    release = threading.Event()
+
+    def run(command, **kwargs):
+        started.append(command)
+        if command == "blocker":
+            blocking.set()
+            release.wait(5)
+        return mock.Mock(result=mock.Mock(return_value=command))
+
+    mock_start.side_effect = run
+    with scheduler.Scheduler(max_parallel=1) as s:
+        blocker = s.submit("blocker")
+        assert blocking.wait(5)
+        futures = [
+            s.submit("low", priority=-1),
+            s.submit("normal", print_stdout=False),
+            s.submit("high", priority=5),
+        ]
+        pending = s.pending
+        release.set()
+    assert pending == 3
+    assert blocker.result() == "blocker"
+    assert [future.result() for future in futures] == ["low", "normal", "high"]
+    assert started == ["blocker", "high", "normal", "low"]
+    mock_start.assert_any_call("normal", print_stdout=False)
+
+
+def test_scheduler_runs_batch_of_commands():
+    with scheduler.Scheduler(max_parallel=4) as s:
+        futures = [
+            s.submit(
+                (sys.executable, "-c", f"print({n})"),
+                print_stdout=False,
+                cpu=0.1,
+            )
+            for n in range(8)
+        ]
+    assert [future.result().stdout.strip() for future in futures] == [
+        str(n).encode() for n in range(8)
+    ]
+    with pytest.raises(RuntimeError):
+        s.submit((sys.executable, "-c", ""))
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="suspending is not supported")
+def test_low_priority_jobs_are_suspended_and_resumed():
+    with scheduler.Scheduler(min_parallel=2, max_parallel=2) as s:
+        futures = [
+            s.submit(
+                (sys.executable, "-c", "import time; time.sleep(0.5)"),
+                priority=priority,
+                print_stdout=False,
+                timeout=5,
+            )
+            for priority in (0, 5)
+        ]
+        deadline = time.monotonic() + 5
+        while not all(job.handle for job in s._running) or s.running < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert s.suspend(below_priority=5) == 1
+        assert s.suspended == 1
+        (job,) = s._suspended
+        assert job.priority == 0 and job.handle.suspended
+        assert futures[1].result().returncode == 0
+        assert not futures[0].done()
+        assert s.resume() == 1
+        assert not job.handle.suspended
+    assert futures[0].result().returncode == 0
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="suspending is not supported")
+def test_killed_jobs_are_no_longer_counted_as_suspended():
+    with scheduler.Scheduler(min_parallel=1, max_parallel=1) as s:
+        future = s.submit(
+            (sys.executable, "-c", "import time; time.sleep(10)"),
+            print_stdout=False,
+        )
+        deadline = time.monotonic() + 5
+        while not all(job.handle for job in s._running) or s.running < 1:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert s.suspend() == 1
+        (job,) = s._suspended
+        job.handle.kill()
+        assert s.suspended == 0
+        assert s.resume() == 0
+    assert future.result().returncode == -9
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 import os
+import signal
 import subprocess
 import sys
+import threading
+import time
 import timeit
+from unittest import mock
 
 import pytest
 
@@ -36,7 +40,7 @@ def test_simple_command_invocation_with_closed_stdin():
     assert result.stderr == b""
 
 
-def test_decode_invalid_utf8_input(capsys):
+def test_decode_invalid_utf8_input(capsysbinary):
     test_string = b"test\xa0string\n"
     if os.name == "nt":
         pytest.xfail("Test requires stdin feature which does not work on Windows")
@@ -51,9 +55,10 @@ def test_decode_invalid_utf8_input(capsys):
         assert result.stdout == test_string[:-1] + b"\r\n"
     else:
         assert result.stdout == test_string
-    out, err = capsys.readouterr()
-    assert out == "test\ufffdstring\n"
-    assert err == ""
+    out, err = capsysbinary.readouterr()
+    # output is passed through to the UTF-8 console without decoding it
+    assert out == test_string
+    assert err == b""
 
 
 def test_running_wget(tmp_path):
@@ -160,3 +165,499 @@ def test_timeout_behaviour(tmp_path):
     assert te.value.stderr == b""
     assert te.value.timeout == 0.1
     assert te.value.cmd == command
+
+
+def test_output_is_passed_through_to_matching_console_stream(capsys):
+    command = (
+        sys.executable,
+        "-c",
+        "import sys; print('out'); print('err', file=sys.stderr)",
+    )
+    result = procrunner.run(command)
+    assert result.returncode == 0
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ["out"]
+    assert err.splitlines() == ["err"]
+
+
+def test_slow_callbacks_are_dispatched_from_separate_thread():
+    received = []
+
+    def slow_callback(line):
+        time.sleep(0.01)
+        received.append(line)
+
+    dispatcher = procrunner.CallbackDispatcher(maxsize=5, policy="drop_oldest")
+    command = (sys.executable, "-c", "for n in range(1000): print(n)")
+    result = procrunner.run(
+        command,
+        callback_stdout=slow_callback,
+        callback_dispatcher=dispatcher,
+        print_stdout=False,
+    )
+    assert result.returncode == 0
+    assert len(result.stdout.splitlines()) == 1000
+    assert received[-1] == "999"
+    assert len(received) + dispatcher.dropped == 1000
+    assert dispatcher.dropped > 0
+
+
+def test_concurrent_runs_share_callback_dispatcher():
+    dispatcher = procrunner.CallbackDispatcher()
+    received = {0: [], 1: []}
+    handles = [
+        procrunner.start(
+            (sys.executable, "-c", f"for n in range(500): print({stream}, n)"),
+            callback_stdout=received[stream].append,
+            callback_dispatcher=dispatcher,
+            print_stdout=False,
+        )
+        for stream in (0, 1)
+    ]
+    assert [handle.result().returncode for handle in handles] == [0, 0]
+    for stream in (0, 1):
+        assert received[stream] == [f"{stream} {n}" for n in range(500)]
+    assert dispatcher._thread is None
+
+    # the dispatcher can be used again once all runs have finished
+    procrunner.run(
+        (sys.executable, "-c", "print('again')"),
+        callback_stdout=received[0].append,
+        callback_dispatcher=dispatcher,
+        print_stdout=False,
+    )
+    assert received[0][-1] == "again"
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "sched_setaffinity"), reason="CPU affinity is not available"
+)
+def test_interrupted_wait_releases_process_resources():
+    dispatcher = procrunner.CallbackDispatcher()
+    allocator = procrunner.CPUAllocator()
+    handle = procrunner.start(
+        (sys.executable, "-c", "import time; print('x', flush=True); time.sleep(10)"),
+        callback_stdout=lambda line: None,
+        callback_dispatcher=dispatcher,
+        cpu_affinity=allocator,
+        print_stdout=False,
+    )
+    with mock.patch.object(
+        handle._thread_pipe_pool[0], "poll", side_effect=KeyboardInterrupt
+    ):
+        with pytest.raises(KeyboardInterrupt):
+            handle.result()
+    assert handle._process not in procrunner._children
+    assert not any(allocator._usage.values())
+    assert dispatcher._thread is None
+    handle.wait(5)
+
+
+def test_pipeline_connects_stages():
+    result = procrunner.pipeline(
+        (sys.executable, "-c", "for n in range(10000): print(n)"),
+        (
+            sys.executable,
+            "-c",
+            "import sys; print(sum(int(l) for l in sys.stdin)); print('done', file=sys.stderr)",
+        ),
+        (sys.executable, "-c", "import sys; sys.stdout.write(sys.stdin.read()[::-1])"),
+        print_stdout=False,
+        print_stderr=False,
+    )
+    assert result.returncode == 0
+    assert result.returncodes == [0, 0, 0]
+    assert result.stdout == b"\n" + str(sum(range(10000)))[::-1].encode()
+    assert result.stderrs[0] == result.stderrs[2] == b""
+    assert result.stderrs[1].strip() == b"done"
+    assert result.stderr.strip() == b"done"
+
+
+def test_pipeline_reports_failing_stage():
+    result = procrunner.pipeline(
+        (sys.executable, "-c", "import sys; sys.exit(3)"),
+        (sys.executable, "-c", "import sys; sys.stdin.read()"),
+        print_stdout=False,
+        print_stderr=False,
+    )
+    assert result.returncodes == [3, 0]
+    assert result.returncode == 3
+    with pytest.raises(subprocess.CalledProcessError):
+        result.check_returncode()
+
+
+def test_pipeline_timeout_stops_all_stages():
+    start = timeit.default_timer()
+    with pytest.raises(subprocess.TimeoutExpired):
+        procrunner.pipeline(
+            (sys.executable, "-c", "import time; time.sleep(5)"),
+            (sys.executable, "-c", "import sys; sys.stdin.read()"),
+            timeout=0.2,
+        )
+    assert timeit.default_timer() - start < 3
+
+
+def test_output_index_preserves_order_of_streams():
+    command = (
+        sys.executable,
+        "-c",
+        "import sys, time\n"
+        "for n in range(3):\n"
+        "    print('out', n, flush=True); time.sleep(0.05)\n"
+        "    print('err', n, file=sys.stderr, flush=True); time.sleep(0.05)\n",
+    )
+    result = procrunner.run(
+        command, capture_index="line", print_stdout=False, print_stderr=False
+    )
+    assert result.returncode == 0
+    assert result.output_index.combined().split() == [
+        b"out",
+        b"0",
+        b"err",
+        b"0",
+        b"out",
+        b"1",
+        b"err",
+        b"1",
+        b"out",
+        b"2",
+        b"err",
+        b"2",
+    ]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="resource limits are not available")
+def test_resource_limits_are_applied_and_reported():
+    result = procrunner.run(
+        (
+            sys.executable,
+            "-c",
+            "import resource; print(resource.getrlimit(resource.RLIMIT_NOFILE))\n"
+            "while True: pass",
+        ),
+        limits={"cpu": 1, "nofile": (64, 64)},
+        timeout=20,
+        print_stdout=False,
+    )
+    assert result.stdout.strip() == b"(64, 64)"
+    assert result.limit_exceeded == "RLIMIT_CPU"
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="scheduling controls are Linux only"
+)
+def test_scheduling_controls_are_applied_to_process():
+    cpu = min(os.sched_getaffinity(0))
+    allocator = procrunner.CPUAllocator(cpus=[cpu])
+    result = procrunner.run(
+        (
+            sys.executable,
+            "-c",
+            "import os; print(sorted(os.sched_getaffinity(0)), os.getpriority(os.PRIO_PROCESS, 0))",
+        ),
+        cpu_affinity=allocator,
+        nice=os.getpriority(os.PRIO_PROCESS, 0) + 5,
+        ionice="idle",
+        print_stdout=False,
+    )
+    assert result.returncode == 0
+    assert result.stdout.split() == [
+        f"[{cpu}]".encode(),
+        str(os.getpriority(os.PRIO_PROCESS, 0) + 5).encode(),
+    ]
+    assert allocator._usage == {cpu: 0}
+
+
+def test_start_returns_handle_on_running_process():
+    handle = procrunner.start(
+        (
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "print('first', flush=True)\n"
+            "sys.stdin.readline()\n"
+            "print('second', file=sys.stderr)",
+        ),
+        stdin=b"go\n",
+        print_stdout=False,
+        print_stderr=False,
+    )
+    assert handle.pid
+    assert handle.wait(timeout=10) == 0
+    assert handle.poll() == 0
+    assert handle.returncode == 0
+    received = [handle.read_available()]
+    result = handle.result()
+    received.append(handle.read_available())
+    assert b"".join(stdout for stdout, _ in received) == b"first\n"
+    assert b"".join(stderr for _, stderr in received) == b"second\n"
+    assert handle.bytes_received == len(b"first\nsecond\n")
+    assert result.returncode == 0
+    assert result.stdout == b"first\n"
+    assert result.stderr == b"second\n"
+    assert handle.result() is result
+
+
+def test_start_handle_enforces_timeout_when_polled():
+    handle = procrunner.start(
+        (sys.executable, "-c", "import time; time.sleep(10)"), timeout=0.1
+    )
+    with pytest.raises(subprocess.TimeoutExpired):
+        handle.wait(timeout=0.05)
+    start = timeit.default_timer()
+    while handle.poll() is None:
+        time.sleep(0.05)
+        assert timeit.default_timer() - start < 3
+    with pytest.raises(subprocess.TimeoutExpired):
+        handle.result()
+
+
+@pytest.mark.skipif(os.name == "nt", reason="reactor is not available on Windows")
+def test_concurrent_runs_share_reactor_thread():
+    command = (
+        sys.executable,
+        "-c",
+        "import sys, time; data = sys.stdin.buffer.read(); time.sleep(0.5);"
+        "sys.stdout.buffer.write(data); print('done', file=sys.stderr)",
+    )
+    stdin = os.urandom(200000)
+    results = []
+    lines = []
+    threads_during_run = []
+
+    def run_process():
+        results.append(
+            procrunner.run(
+                command,
+                stdin=stdin,
+                reactor=True,
+                print_stdout=False,
+                print_stderr=False,
+                callback_stderr=lines.append,
+            )
+        )
+
+    threads_before = threading.active_count()
+    runners = [threading.Thread(target=run_process) for _ in range(10)]
+    for runner in runners:
+        runner.start()
+    time.sleep(0.3)
+    threads_during_run.append(threading.active_count())
+    for runner in runners:
+        runner.join()
+
+    assert len(results) == 10
+    for result in results:
+        assert result.returncode == 0
+        assert result.stdout == stdin
+        assert result.stderr == b"done\n"
+    assert lines == ["done"] * 10
+    # 10 runner threads plus at most the one reactor thread
+    assert threads_during_run[0] <= threads_before + 10 + 1
+
+
+@pytest.mark.skipif(os.name == "nt", reason="pseudo-terminals are not available")
+def test_pty_mode_delivers_lines_while_process_runs():
+    command = (
+        sys.executable,
+        "-c",
+        "import os, sys, time\n"
+        "print(sys.stdout.isatty(), os.get_terminal_size())\n"
+        "time.sleep(1)\n"
+        "print('done')",
+    )
+    received = []
+    start = timeit.default_timer()
+    result = procrunner.run(
+        command,
+        pty=True,
+        pty_size=(30, 100),
+        print_stdout=False,
+        callback_stdout=lambda line: received.append(
+            (line, timeit.default_timer() - start)
+        ),
+    )
+    assert result.returncode == 0
+    assert result.stdout == (b"True os.terminal_size(columns=100, lines=30)\ndone\n")
+    assert [line for line, _ in received] == [
+        "True os.terminal_size(columns=100, lines=30)",
+        "done",
+    ]
+    assert received[0][1] < received[1][1] - 0.5
+
+
+def test_progress_updates_are_collapsed():
+    lines = []
+    result = procrunner.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.stdout.write('start\\n10%\\r20%\\r30%\\rdone\\n')",
+        ],
+        callback_stdout=lines.append,
+        collapse_progress=True,
+        line_delimiter="universal",
+    )
+    assert result.returncode == 0
+    assert result.stdout == b"start\n10%\r20%\r30%\rdone\n"
+    assert lines == ["start", "30%", "done"]
+
+
+def test_head_tail_capture_omits_middle_of_output():
+    result = procrunner.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys\nfor n in range(10000): print(n)\nsys.stderr.write('x')",
+        ],
+        capture="head_tail",
+        capture_head=3,
+        capture_tail={"stdout": 2, "stderr": 10},
+        capture_unit="lines",
+        print_stdout=False,
+    )
+    assert result.returncode == 0
+    assert result.stdout.split() == [b"0", b"1", b"2", b"9998", b"9999"]
+    assert result.stdout_omitted == len(b"".join(b"%d\n" % n for n in range(3, 9998)))
+    assert result.stderr == b"x"
+    assert result.stderr_omitted == 0
+
+
+def test_compressed_capture_decompresses_output_lazily():
+    result = procrunner.run(
+        [sys.executable, "-c", "for n in range(10000): print('line', n)"],
+        capture_compression="zlib",
+        print_stdout=False,
+    )
+    assert isinstance(result, procrunner.CompressedCompletedProcess)
+    assert result.returncode == 0
+    assert result._stdout is None
+    assert len(result.stdout_compressed) * 4 < len(result.stdout)
+    assert result.stdout.splitlines()[-1] == b"line 9999"
+    assert result.stderr == b""
+
+
+@pytest.mark.skipif(os.name == "nt", reason="process groups are not available")
+def test_shutdown_stops_all_processes_and_their_groups():
+    ignores_terminate = [
+        sys.executable,
+        "-c",
+        "import signal, time\n"
+        "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+        "print('ready', flush=True)\n"
+        "time.sleep(30)",
+    ]
+    handles = [
+        procrunner.start(ignores_terminate, print_stdout=False) for _ in range(3)
+    ]
+    # the background sleep keeps stdout open unless the whole group is stopped
+    handles.append(
+        procrunner.start(
+            ["/bin/sh", "-c", "sleep 30 & echo ready; wait"],
+            new_process_group=True,
+            print_stdout=False,
+        )
+    )
+    for handle in handles:
+        deadline = time.monotonic() + 10
+        while b"ready" not in handle.read_available()[0]:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    start = time.monotonic()
+    assert procrunner.shutdown(grace=0.5) == 4
+    results = [handle.result() for handle in handles]
+    assert time.monotonic() - start < 3
+    assert [result.returncode for result in results] == [-9, -9, -9, -15]
+    assert procrunner.shutdown() == 0
+
+
+@pytest.mark.skipif(os.name == "nt", reason="suspending is not available")
+def test_suspended_time_does_not_count_towards_timeout():
+    handle = procrunner.start(
+        [sys.executable, "-c", "import time; time.sleep(0.3); print('done')"],
+        timeout=0.8,
+        print_stdout=False,
+    )
+    handle.suspend()
+    assert handle.suspended
+    time.sleep(1)
+    assert handle.poll() is None
+    handle.resume()
+    assert not handle.suspended
+    result = handle.result()
+    assert result.returncode == 0
+    assert result.stdout == b"done\n"
+
+
+@pytest.mark.skipif(os.name == "nt", reason="suspending is not available")
+def test_suspended_process_is_stopped_by_timeout():
+    handle = procrunner.start(
+        [sys.executable, "-c", "import time; time.sleep(10)"],
+        timeout=0.3,
+        new_process_group=True,
+    )
+    handle.suspend(pause_timeout=False)
+    start = timeit.default_timer()
+    with pytest.raises(subprocess.TimeoutExpired):
+        handle.result()
+    assert timeit.default_timer() - start < 2
+    assert handle.returncode == -15
+    assert not handle.suspended
+
+
+@pytest.mark.skipif(os.name == "nt", reason="suspending is not available")
+def test_suspension_ends_when_process_is_killed_or_ends():
+    command = [sys.executable, "-c", "import time; time.sleep(10)"]
+    handle = procrunner.start(command)
+    handle.suspend()
+    handle.kill()
+    assert not handle.suspended
+    assert handle.result().returncode == -9
+
+    handle = procrunner.start(command)
+    handle.suspend()
+    os.kill(handle.pid, signal.SIGKILL)
+    handle.wait(5)
+    assert not handle.suspended
+
+
+def test_output_is_decoded_with_stream_encoding(capsysbinary):
+    lines = []
+    result = procrunner.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "sys.stdout.buffer.write(b'caf\\xe9\\n')\n"
+            "sys.stderr.buffer.write(b'\\xff\\x00\\n')",
+        ],
+        callback_stdout=lines.append,
+        encoding={"stdout": "latin-1", "stderr": None},
+    )
+    assert lines == ["café"]
+    assert result.stdout_text == "café\n"
+    assert result.lines()[0] == "café"
+    # binary output is passed through unchanged
+    assert capsysbinary.readouterr().err == b"\xff\x00\n"
+
+
+def test_strict_decoding_error_is_raised_after_process_ends():
+    lines = []
+    start = timeit.default_timer()
+    with pytest.raises(UnicodeDecodeError):
+        procrunner.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys\n"
+                "sys.stdout.buffer.write(b'ok\\n\\xff\\n'); sys.stdout.flush()\n"
+                "for _ in range(1000): sys.stdout.write('x' * 999 + '\\n')",
+            ],
+            callback_stdout=lines.append,
+            errors="strict",
+            print_stdout=False,
+            timeout=5,
+        )
+    assert timeit.default_timer() - start < 3
+    assert "x" * 999 not in lines
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import sys
+import time
+from unittest import mock
+
+import pytest
+
+import procrunner
+from procrunner import testing
+
+COMMAND = [
+    sys.executable,
+    "-c",
+    "import sys, time\n"
+    "print('first line', flush=True)\n"
+    "sys.stderr.write('warning\\n'); sys.stderr.flush()\n"
+    "time.sleep(0.2)\n"
+    "print('second line')\n"
+    "sys.exit(3)",
+]
+
+
+@pytest.fixture
+def fixture_file(tmp_path):
+    path = tmp_path / "runs.json"
+    with testing.record(path, environment_keys=("LANG",)):
+        result = procrunner.run(COMMAND, print_stdout=False, print_stderr=False)
+    assert result.returncode == 3
+    assert not hasattr(result, "output_index")
+    return path
+
+
+def test_replay_reproduces_recorded_run_without_process(fixture_file):
+    stdout_lines = []
+    stderr_batches = []
+    with mock.patch("subprocess.Popen", side_effect=AssertionError("spawned")):
+        with testing.replay(fixture_file, environment_keys=("LANG",)) as replayer:
+            start = time.monotonic()
+            result = procrunner.run(
+                COMMAND,
+                callback_stdout=stdout_lines.append,
+                callback_stderr_batch=stderr_batches.append,
+                print_stdout=False,
+                print_stderr=False,
+            )
+            assert time.monotonic() - start < 0.2
+    assert result.replayed
+    assert result.returncode == 3
+    assert result.stdout == b"first line\nsecond line\n"
+    assert result.stderr == b"warning\n"
+    assert stdout_lines == ["first line", "second line"]
+    assert stderr_batches == [[b"warning"]]
+    assert replayer.calls == [COMMAND]
+
+
+def test_replay_keeps_recorded_timing(fixture_file):
+    with testing.replay(fixture_file, environment_keys=("LANG",), speed=2):
+        start = time.monotonic()
+        result = procrunner.run(
+            COMMAND, parse_stdout="csv", print_stdout=False, print_stderr=False
+        )
+        assert time.monotonic() - start >= 0.1
+    assert result.stdout_records == [{"first line": "second line"}]
+
+
+def test_replay_fails_on_unmatched_commands(fixture_file):
+    run = procrunner.run
+    with testing.replay(fixture_file, environment_keys=("LANG",)):
+        with pytest.raises(testing.UnmatchedCommandError, match="Recorded runs"):
+            procrunner.run(COMMAND + ["extra"])
+        with pytest.raises(testing.UnmatchedCommandError):
+            procrunner.run(COMMAND, stdin=b"input")
+        with pytest.raises(testing.UnmatchedCommandError):
+            procrunner.run(COMMAND, environment_override={"LANG": "xx_XX"})
+    assert procrunner.run is run
+
+
+@pytest.mark.parametrize(
+    "options",
+    (
+        {"capture": "none"},
+        {"capture": "head_tail", "capture_head": 3, "capture_tail": 5},
+        {"capture_compression": "zlib"},
+    ),
+)
+def test_record_and_replay_with_capture_options(tmp_path, options):
+    path = tmp_path / "runs.json"
+    with testing.record(path):
+        recorded = procrunner.run(
+            COMMAND, print_stdout=False, print_stderr=False, **options
+        )
+    with testing.replay(path):
+        replayed = procrunner.run(
+            COMMAND, print_stdout=False, print_stderr=False, **options
+        )
+        full = procrunner.run(COMMAND, print_stdout=False, print_stderr=False)
+    assert type(replayed) is type(recorded)
+    assert replayed.stdout == recorded.stdout
+    assert replayed.stderr == recorded.stderr
+    assert getattr(replayed, "stdout_omitted", None) == getattr(
+        recorded, "stdout_omitted", None
+    )
+    assert full.stdout == b"first line\nsecond line\n"
+
+
+def test_replay_rejects_processes_started_otherwise(fixture_file):
+    with testing.replay(fixture_file, environment_keys=("LANG",)):
+        with pytest.raises(testing.UnmatchedCommandError, match="start"):
+            procrunner.start(COMMAND)
+        with pytest.raises(testing.UnmatchedCommandError, match="pipeline"):
+            procrunner.pipeline(COMMAND, COMMAND)
+    assert procrunner.start.__module__ == "procrunner"